@@ -10,11 +10,17 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
 from pathlib import Path
 
+from dotenv import load_dotenv
+
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Load the .env file
+load_dotenv(BASE_DIR / ".env")
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/5.1/howto/deployment/checklist/
@@ -30,7 +36,8 @@ CSRF_TRUSTED_ORIGINS = [
     
 ]
 
-ALLOWED_HOSTS = ["127.0.0.1:8000"]
+# Host names only, Django compares them without the port
+ALLOWED_HOSTS = os.getenv("ALLOWED_HOSTS", "127.0.0.1,localhost").split(",")
 
 CORS_ALLOW_ALL_ORIGINS = False
 
@@ -89,11 +96,67 @@ WSGI_APPLICATION = "context_links.wsgi.application"
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    "default": {
-        "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "db.sqlite3",
+# Configured from the environment (or the .env file next to manage.py). SQLite is the
+# default for local work; set DB_ENGINE=postgresql in production, where SQLite's single
+# writer can't keep up with several workers saving contexts at once.
+
+DB_ENGINE = os.getenv("DB_ENGINE", "sqlite")
+
+if DB_ENGINE == "postgresql":
+    # DB_POOL uses psycopg's connection pool (one per process), otherwise connections are
+    # kept open between requests for DB_CONN_MAX_AGE seconds. Django can't combine the two.
+    DB_POOL = os.getenv("DB_POOL", "false").lower() in ("1", "true", "yes")
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.postgresql",
+            "NAME": os.getenv("DB_NAME", "context_links"),
+            "USER": os.getenv("DB_USER", "postgres"),
+            "PASSWORD": os.getenv("DB_PASSWORD", ""),
+            "HOST": os.getenv("DB_HOST", "localhost"),
+            "PORT": os.getenv("DB_PORT", "5432"),
+            "CONN_MAX_AGE": 0 if DB_POOL else int(os.getenv("DB_CONN_MAX_AGE", "60")),
+            "CONN_HEALTH_CHECKS": True,
+            "OPTIONS": {
+                "pool": {
+                    "min_size": int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+                    "max_size": int(os.getenv("DB_POOL_MAX_SIZE", "10")),
+                    "timeout": 10,
+                },
+            } if DB_POOL else {},
+        }
     }
+else:
+    DATABASES = {
+        "default": {
+            "ENGINE": "django.db.backends.sqlite3",
+            "NAME": os.getenv("DB_NAME", BASE_DIR / "db.sqlite3"),
+            "OPTIONS": {
+                # WAL lets readers run alongside the writer, IMMEDIATE takes the write lock up
+                # front instead of failing half way through a transaction with "database is locked"
+                "init_command": "PRAGMA journal_mode=WAL;",
+                "transaction_mode": "IMMEDIATE",
+                "timeout": 20,
+            },
+        }
+    }
+
+
+# Cache
+# https://docs.djangoproject.com/en/5.1/topics/cache/
+# Point "summaries" at a shared backend (Redis, database) when running several processes.
+
+SUMMARY_CACHE_TTL = 60 * 60 * 24 * 7
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "summaries": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "summaries",
+        "TIMEOUT": SUMMARY_CACHE_TTL,
+        "OPTIONS": {"MAX_ENTRIES": 10000},
+    },
 }
 
 
@@ -168,3 +231,212 @@ LOGGING = {
         },
     },
 }
+
+
+# Link fetching
+# Pages are fetched concurrently when a context is built. LINK_FETCH_TIMEOUT is
+# the per-link budget (seconds) and CONTEXT_FETCH_DEADLINE bounds the whole batch.
+
+LINK_FETCH_MAX_WORKERS = 8
+
+LINK_FETCH_PER_HOST_LIMIT = 4
+
+LINK_FETCH_TIMEOUT = 10
+
+CONTEXT_FETCH_DEADLINE = 30
+
+# Downloads stop after PAGE_MAX_BYTES and extracted text is cut at PAGE_MAX_CHARS
+
+PAGE_MAX_BYTES = 5 * 1024 * 1024
+
+PAGE_MAX_CHARS = 200000
+
+# All fetches share one keep-alive connection pool (LINK_FETCH_POOL_HOSTS hosts kept open),
+# identify as LINK_FETCH_USER_AGENT, follow at most LINK_FETCH_MAX_REDIRECTS redirects and
+# give up connecting after LINK_FETCH_CONNECT_TIMEOUT seconds. robots.txt is honoured and
+# cached for ROBOTS_CACHE_TTL. Fetches reuse DNS answers for LINK_FETCH_DNS_CACHE_TTL seconds
+# (0 disables), which is kept short because the records' own TTLs can't be seen.
+
+LINK_FETCH_CONNECT_TIMEOUT = 3
+
+LINK_FETCH_MAX_REDIRECTS = 5
+
+LINK_FETCH_USER_AGENT = "ContextLinks/1.0"
+
+LINK_FETCH_POOL_HOSTS = 32
+
+LINK_FETCH_OBEY_ROBOTS = True
+
+ROBOTS_CACHE_TTL = 60 * 60 * 24
+
+LINK_FETCH_DNS_CACHE_TTL = 60
+
+# Requests for the same page while it is being fetched wait for that fetch instead of starting
+# their own. LINK_FETCH_SHARED_FLIGHT extends this across processes through the default cache,
+# which then has to be shared (Redis, Memcached), keeping each result LINK_FETCH_SHARED_TTL seconds.
+
+LINK_FETCH_SHARED_FLIGHT = False
+
+LINK_FETCH_SHARED_TTL = 30
+
+
+# Page cache
+# Extracted page text is kept per normalized URL. Entries younger than PAGE_CACHE_TTL
+# (seconds) are used as-is, older ones are revalidated with a conditional GET. Least
+# recently used pages are evicted once the cached text exceeds PAGE_CACHE_MAX_BYTES, which
+# is checked at most every PAGE_CACHE_EVICT_INTERVAL seconds and whenever run_jobs starts.
+
+PAGE_CACHE_TTL = 60 * 60 * 24
+
+PAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+PAGE_CACHE_EVICT_INTERVAL = 60 * 5
+
+
+# Background jobs
+# "thread" runs queued jobs on an in-process pool of BACKGROUND_WORKERS threads, "db"
+# leaves them in the Job table for `python manage.py run_jobs` workers. Finished jobs
+# are kept for JOBS_RETENTION seconds. Saving a link queues extraction of its page text.
+# Every JOBS_RECOVER_INTERVAL seconds jobs running for longer than JOBS_STALE_AFTER, whose
+# worker must have stopped, are queued again, and with the thread backend jobs left queued
+# by a process that has exited are picked up.
+
+JOBS_BACKEND = "thread"
+
+BACKGROUND_WORKERS = 4
+
+JOBS_RETENTION = 60 * 60 * 24
+
+JOBS_STALE_AFTER = 60 * 30
+
+JOBS_RECOVER_INTERVAL = 60
+
+EXTRACT_ON_SAVE = True
+
+
+# Observability
+# Pipeline stages, fetches and LLM calls are measured and exported at /metrics (per process).
+# TRACING_ENABLED also wraps stages in OpenTelemetry spans, if opentelemetry is installed.
+# Request bodies, OAuth responses and LLM responses are only logged with LOG_PAYLOADS.
+
+METRICS_ENABLED = True
+
+TRACING_ENABLED = False
+
+LOG_PAYLOADS = False
+
+
+# Authentication
+# API requests are authenticated from the session Google sign in starts, or from a bearer
+# token (valid for AUTH_TOKEN_MAX_AGE seconds), and every endpoint requires it unless it says
+# otherwise. Users are cached for USER_CACHE_TTL seconds.
+
+REST_FRAMEWORK = {
+    "DEFAULT_AUTHENTICATION_CLASSES": ["users.authentication.UserAuthentication"],
+    "DEFAULT_PERMISSION_CLASSES": ["rest_framework.permissions.IsAuthenticated"],
+}
+
+AUTH_TOKEN_MAX_AGE = 60 * 60 * 24 * 30
+
+USER_CACHE_TTL = 60 * 5
+
+
+# Links
+# user_links returns USER_LINKS_PAGE_SIZE links per page, clients may ask for up to
+# USER_LINKS_MAX_PAGE_SIZE with ?page_size=.
+
+USER_LINKS_PAGE_SIZE = 50
+
+USER_LINKS_MAX_PAGE_SIZE = 500
+
+# Most links one bulk_import request may contain
+BULK_IMPORT_MAX_LINKS = 1000
+
+
+# Page summaries
+# page_summaries takes up to PAGE_SUMMARY_BATCH_MAX_LINKS links and makes at most
+# PAGE_SUMMARY_MAX_WORKERS LLM calls at once. Pages up to half of PAGE_SUMMARY_PACK_TOKENS
+# are summarized together, as many per call as fit in PAGE_SUMMARY_PACK_TOKENS. Each user
+# may have PAGE_SUMMARY_LINKS_PER_MINUTE links summarized by page_summary and page_summaries.
+
+PAGE_SUMMARY_BATCH_MAX_LINKS = 50
+
+PAGE_SUMMARY_LINKS_PER_MINUTE = 100
+
+PAGE_SUMMARY_MAX_WORKERS = 4
+
+PAGE_SUMMARY_PACK_TOKENS = 3000
+
+
+# Retrieval
+# Contexts are split into overlapping chunks of CONTEXT_CHUNK_WORDS words. Chat sends a context
+# whole when its text fits in CHAT_CONTEXT_MAX_TOKENS, otherwise the budget is shared fairly
+# between its links and filled, depending on CHAT_CONTEXT_MODE, with the chunks that best match
+# the question (BM25, "retrieve") or with cached summaries of the pages over their share
+# ("map_reduce"). Those are made by a background job, DIGEST_MAX_WORKERS at a time, waiting up to
+# DIGEST_MAX_QUEUE_WAIT seconds for the LLM budget, in pieces of DIGEST_PIECE_TOKENS or however many
+# fit LLM_TOKENS_PER_MINUTE with their answer. Until a page's summary is ready its best chunks stand in.
+
+CONTEXT_CHUNK_WORDS = 300
+
+CONTEXT_CHUNK_OVERLAP_WORDS = 50
+
+CHAT_CONTEXT_MAX_TOKENS = 2400
+
+CHAT_CONTEXT_MODE = "retrieve"
+
+DIGEST_PIECE_TOKENS = 6000
+
+DIGEST_MAX_WORKERS = 4
+
+DIGEST_MAX_QUEUE_WAIT = 60 * 5
+
+
+# Context text
+# Page text is stored once per distinct content, zlib compressed at this level (1-9),
+# and contexts and extracted links point at it. Unused text is deleted by run_jobs.
+
+TEXT_BLOB_COMPRESSION_LEVEL = 6
+
+
+# LLM
+# LLM_PROVIDER is "groq", or "fake" for deterministic local answers in tests and load tests.
+# Each request goes to the smallest of LLM_MODELS whose context window fits the estimated
+# prompt, and to the next larger one while that model is rate limited.
+
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "groq")
+
+# Another Groq compatible endpoint, e.g. the stand-in bench_api starts
+GROQ_BASE_URL = os.getenv("GROQ_BASE_URL") or None
+
+LLM_MODELS = [
+    {"name": "llama-3.1-8b-instant", "context_tokens": 8192},
+    {"name": "mixtral-8x7b-32768", "context_tokens": 32768},
+]
+
+
+# LLM budget
+# Calls to Groq are held back (up to LLM_MAX_QUEUE_WAIT seconds, then answered with a 429)
+# so that the estimated tokens and requests per minute stay within the account's limits.
+# Provider 429s with a short cooldown are retried up to LLM_MAX_RETRIES times.
+
+LLM_TOKENS_PER_MINUTE = int(os.getenv("LLM_TOKENS_PER_MINUTE", "5000"))
+
+LLM_REQUESTS_PER_MINUTE = int(os.getenv("LLM_REQUESTS_PER_MINUTE", "30"))
+
+LLM_COMPLETION_TOKENS_ESTIMATE = 500
+
+LLM_MAX_QUEUE_WAIT = 10
+
+LLM_MAX_RETRIES = 2
+
+LLM_RETRY_BASE_DELAY = 1
+
+
+# Conversation memory
+# Chat sends the newest turns of a conversation that fit in CHAT_HISTORY_MAX_TOKENS, older
+# turns are folded (by a background job) into a summary of at most CHAT_SUMMARY_MAX_TOKENS.
+
+CHAT_HISTORY_MAX_TOKENS = 1000
+
+CHAT_SUMMARY_MAX_TOKENS = 300
@@ -22,5 +22,6 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/", include("users.urls")),
     path("auth/user_info/", UserInfo.as_view(), name='user-info'),
-    path("api/index/", Index.as_view(), name='index')
+    path("api/index/", Index.as_view(), name='index'),
+    path("metrics", metrics, name='metrics'),
 ]
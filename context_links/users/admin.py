@@ -5,4 +5,12 @@ from .models import *
 # Register your models here.
 admin.site.register(User)
 admin.site.register(UserLinks)
-admin.site.register(Context)
\ No newline at end of file
+admin.site.register(Context)
+admin.site.register(PageContent)
+admin.site.register(Job)
+admin.site.register(TextBlob)
+admin.site.register(ContextSegment)
+admin.site.register(TextChunk)
+admin.site.register(LLMUsage)
+admin.site.register(Conversation)
+admin.site.register(Message)
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class UsersConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "users"
+
+    def ready(self):
+        # Registers the background job tasks, the user cache invalidation and search indexing
+        from . import authentication, search, tasks  # noqa: F401
@@ -0,0 +1,90 @@
+import logging
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework import authentication, exceptions
+from rest_framework.request import Request
+
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+
+# Where UserInfo keeps the signed in user's id in the session
+SESSION_USER_KEY = "user_id"
+
+TOKEN_SALT = "users.auth-token"
+
+
+def user_cache_key(user_id):
+    return f"user:{user_id}"
+
+
+def get_cached_user(user_id):
+    # The user for an id, from the cache when possible so authenticating costs no query
+    key = user_cache_key(user_id)
+    user = cache.get(key)
+    if user is None:
+        user = User.objects.filter(pk=user_id, is_active=True).first()
+        if user is None:
+            return None
+        cache.set(key, user, timeout=settings.USER_CACHE_TTL)
+    return user
+
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    # A deleted or deactivated user must stop authenticating straight away
+    cache.delete(user_cache_key(instance.pk))
+
+
+def issue_token(user):
+    return signing.dumps({SESSION_USER_KEY: user.pk}, salt=TOKEN_SALT, compress=True)
+
+
+def user_id_from_token(token):
+    try:
+        return signing.loads(token, salt=TOKEN_SALT, max_age=settings.AUTH_TOKEN_MAX_AGE)[SESSION_USER_KEY]
+    except (signing.BadSignature, KeyError, TypeError):
+        raise exceptions.AuthenticationFailed("Invalid or expired token.")
+
+
+class UserAuthentication(authentication.SessionAuthentication):
+    # Resolves request.user from "Authorization: Bearer <token>" (see UsersView.token), or else from
+    # the session the Google sign in started. Session requests get DRF's usual CSRF check.
+    keyword = "Bearer"
+
+    def authenticate(self, request):
+        header = authentication.get_authorization_header(request).split()
+        if header and header[0].lower() == self.keyword.lower().encode():
+            if len(header) != 2:
+                raise exceptions.AuthenticationFailed("Invalid token header.")
+            user = get_cached_user(user_id_from_token(header[1].decode(errors="replace")))
+            if user is None:
+                raise exceptions.AuthenticationFailed("User not found or inactive.")
+            return user, header[1]
+
+        user_id = request._request.session.get(SESSION_USER_KEY)
+        if user_id is None:
+            return None
+        user = get_cached_user(user_id)
+        if user is None:
+            return None
+        self.enforce_csrf(request)
+        return user, None
+
+    def authenticate_header(self, request):
+        return self.keyword
+
+
+def authenticated_user(request):
+    # For plain Django views (chat_stream): the user an API view would get, from the bearer token or
+    # the session, with the same CSRF check. Raises NotAuthenticated when the request has neither.
+    result = UserAuthentication().authenticate(Request(request))
+    if result is None:
+        raise exceptions.NotAuthenticated()
+    return result[0]
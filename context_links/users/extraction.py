@@ -0,0 +1,84 @@
+import codecs
+from html.parser import HTMLParser
+
+# Nothing inside these is readable page text
+SKIPPED_TAGS = {"script", "style", "noscript", "template", "svg", "canvas", "iframe", "nav", "footer", "aside"}
+
+HTML_CONTENT_TYPES = ("text/html", "application/xhtml+xml")
+
+
+class UnsupportedContentType(Exception):
+    pass
+
+
+def is_html(content_type):
+    # A missing Content-Type is treated as HTML, most servers that omit it are serving pages
+    if not content_type:
+        return True
+    return content_type.split(";")[0].strip().lower() in HTML_CONTENT_TYPES
+
+
+class TextExtractor(HTMLParser):
+    # Incremental HTML to text: feed() it the page piece by piece, no tree is ever built.
+    # The output matches BeautifulSoup's get_text(separator=' ', strip=True) minus boilerplate.
+
+    def __init__(self, max_chars=None):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.parts = []
+        self.length = 0
+        self.skip_stack = []
+
+    @property
+    def full(self):
+        return self.max_chars is not None and self.length >= self.max_chars
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skip_stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        # <svg/> and friends have no content to skip
+        pass
+
+    def handle_endtag(self, tag):
+        # Pop back to the matching skipped tag, tolerating sloppy nesting inside it
+        if tag in self.skip_stack:
+            while self.skip_stack and self.skip_stack.pop() != tag:
+                pass
+
+    def handle_data(self, data):
+        if self.skip_stack or self.full:
+            return
+        text = data.strip()
+        if text:
+            self.parts.append(text)
+            self.length += len(text) + 1
+
+    def get_text(self):
+        text = " ".join(self.parts)
+        if self.max_chars is not None:
+            text = text[:self.max_chars]
+        return text
+
+
+def extract_text(chunks, encoding="utf-8", max_bytes=None, max_chars=None):
+    # Reads byte chunks until the page ends, max_bytes have been read or max_chars of text
+    # have been extracted, whichever comes first
+    try:
+        decoder = codecs.getincrementaldecoder(encoding or "utf-8")(errors="replace")
+    except LookupError:
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+    extractor = TextExtractor(max_chars=max_chars)
+    downloaded = 0
+    for chunk in chunks:
+        if max_bytes is not None and downloaded + len(chunk) > max_bytes:
+            chunk = chunk[:max_bytes - downloaded]
+        downloaded += len(chunk)
+        extractor.feed(decoder.decode(chunk))
+        if extractor.full or (max_bytes is not None and downloaded >= max_bytes):
+            break
+    extractor.feed(decoder.decode(b"", final=True))
+    extractor.close()
+    return extractor.get_text()
@@ -0,0 +1,50 @@
+import hashlib
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from .ratelimit import estimate_tokens
+
+# Models that answer like a Groq rate limit, add to it to exercise fallbacks
+RATE_LIMITED_MODELS = set()
+
+# Models whose streams are cut off by a rate limit after their first token
+RATE_LIMITED_MID_STREAM_MODELS = set()
+
+
+def rate_limit_error(model_name):
+    return RuntimeError(f"Rate limit reached for model `{model_name}` on tokens per minute (TPM): Please try again in 2s.")
+
+
+class FakeChatModel(BaseChatModel):
+    # The same prompt always gets the same answer, tagged with the model that produced it
+    model_name: str = "fake"
+
+    @property
+    def _llm_type(self):
+        return "fake"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        if self.model_name in RATE_LIMITED_MODELS:
+            raise rate_limit_error(self.model_name)
+        prompt = "\n".join(str(message.content) for message in messages)
+        question = " ".join(str(messages[-1].content).split()[:20]) if messages else ""
+        content = f"[{self.model_name}] {hashlib.sha256(prompt.encode()).hexdigest()[:12]}: {question}"
+        input_tokens, output_tokens = estimate_tokens(prompt), estimate_tokens(content)
+        message = AIMessage(content=content, usage_metadata={
+            "input_tokens": input_tokens, "output_tokens": output_tokens, "total_tokens": input_tokens + output_tokens,
+        })
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        # The same answer word by word, with the usage on the last chunk like Groq sends it
+        message = self._generate(messages).generations[0].message
+        words = message.content.split(" ")
+        for index, word in enumerate(words):
+            if index == 1 and self.model_name in RATE_LIMITED_MID_STREAM_MODELS:
+                raise rate_limit_error(self.model_name)
+            last = index == len(words) - 1
+            yield ChatGenerationChunk(message=AIMessageChunk(
+                content=word if last else word + " ", usage_metadata=message.usage_metadata if last else None,
+            ))
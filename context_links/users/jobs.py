@@ -0,0 +1,120 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+
+from .models import Job
+
+logger = logging.getLogger(__name__)
+
+
+# Task name -> function, filled in by the @task decorator in tasks.py
+TASKS = {}
+
+JOBS_RECOVER_KEY = "jobs:recovered"
+
+_EXECUTOR = ThreadPoolExecutor(max_workers=settings.BACKGROUND_WORKERS, thread_name_prefix="jobs")
+
+
+class TaskError(Exception):
+    # An expected failure, data is stored as the job result so pollers can act on it
+
+    def __init__(self, message, data=None):
+        super().__init__(message)
+        self.data = data
+
+
+def task(name):
+    def register(func):
+        TASKS[name] = func
+        return func
+    return register
+
+
+def enqueue(task_name, payload, user=None):
+    if task_name not in TASKS:
+        raise ValueError(f"Unknown task {task_name}")
+    job = Job.objects.create(task=task_name, payload=payload, user=user)
+
+    # With the thread backend jobs run inside this process, with the db backend
+    # they wait in the table until a `manage.py run_jobs` worker claims them
+    if settings.JOBS_BACKEND == "thread":
+        transaction.on_commit(lambda: _EXECUTOR.submit(_run_in_thread, job.pk))
+        recover_jobs_if_due()
+    return job
+
+
+def recover_jobs():
+    # Jobs still running long after they started died with their worker (a crash or a restart) and are
+    # queued again. With the thread backend a queued job only lives in the pool of the process that queued
+    # it, ones that have waited longer than they would in any pool are submitted to this one as well
+    # (whichever pool gets to it first runs it). Returns how many jobs were requeued.
+    now = timezone.now()
+    requeued = Job.objects.filter(
+        status=Job.RUNNING, started_on__lt=now - timedelta(seconds=settings.JOBS_STALE_AFTER)
+    ).update(status=Job.QUEUED, started_on=None)
+    if requeued:
+        logger.warning(f"Requeued {requeued} jobs left running by a worker that stopped")
+    if settings.JOBS_BACKEND == "thread":
+        waiting = Job.objects.filter(status=Job.QUEUED, created_on__lt=now - timedelta(seconds=settings.JOBS_RECOVER_INTERVAL))
+        for job_id in waiting.values_list("id", flat=True):
+            _EXECUTOR.submit(_run_in_thread, job_id)
+    return requeued
+
+
+def recover_jobs_if_due():
+    if cache.add(JOBS_RECOVER_KEY, 1, timeout=settings.JOBS_RECOVER_INTERVAL):
+        return recover_jobs()
+    return 0
+
+
+def claim_next_job():
+    # The conditional update makes sure only one worker gets a job, even across processes
+    recover_jobs_if_due()
+    for job_id in Job.objects.filter(status=Job.QUEUED).order_by("id").values_list("id", flat=True)[:10]:
+        claimed = Job.objects.filter(pk=job_id, status=Job.QUEUED).update(status=Job.RUNNING, started_on=timezone.now())
+        if claimed:
+            return Job.objects.get(pk=job_id)
+    return None
+
+
+def run_job(job):
+    try:
+        result = TASKS[job.task](**job.payload)
+        job.status = Job.DONE
+        job.result = result
+    except TaskError as e:
+        job.status = Job.FAILED
+        job.error = str(e)
+        job.result = e.data
+    except Exception as e:
+        logger.error(f"Job {job.pk} ({job.task}) failed: {e}", exc_info=True)
+        job.status = Job.FAILED
+        job.error = str(e)
+    job.finished_on = timezone.now()
+    job.save(update_fields=["status", "result", "error", "finished_on"])
+    return job
+
+
+def _run_in_thread(job_id):
+    try:
+        claimed = Job.objects.filter(pk=job_id, status=Job.QUEUED).update(status=Job.RUNNING, started_on=timezone.now())
+        if claimed:
+            run_job(Job.objects.get(pk=job_id))
+    except Exception as e:
+        logger.error(f"Job {job_id} could not be run: {e}", exc_info=True)
+    finally:
+        # Worker threads open their own DB connections, don't leak them
+        close_old_connections()
+
+
+def delete_finished_jobs(older_than=None):
+    older_than = older_than or timedelta(seconds=settings.JOBS_RETENTION)
+    deleted_count, _ = Job.objects.filter(
+        status__in=[Job.DONE, Job.FAILED], finished_on__lt=timezone.now() - older_than
+    ).delete()
+    return deleted_count
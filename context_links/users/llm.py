@@ -0,0 +1,74 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .providers import get_provider, provider
+
+logger = logging.getLogger(__name__)
+
+
+class GroqProvider:
+    # One ChatGroq client per model, built the first time that model is used
+
+    def __init__(self):
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def chat_model(self, model):
+        with self._lock:
+            if model not in self._models:
+                # Imported here, langchain and the groq SDK take longer to import than the rest of the app
+                from langchain_groq import ChatGroq
+                self._models[model] = ChatGroq(temperature=0, model_name=model, base_url=settings.GROQ_BASE_URL)
+            return self._models[model]
+
+
+class FakeProvider:
+    # Deterministic answers computed locally, for tests and load tests that must not reach Groq
+
+    def chat_model(self, model):
+        from .fake_llm import FakeChatModel
+        return FakeChatModel(model_name=model)
+
+
+@provider("groq")
+def groq_provider():
+    return GroqProvider()
+
+
+@provider("fake")
+def fake_provider():
+    return FakeProvider()
+
+
+def chat_model(model):
+    return get_provider(settings.LLM_PROVIDER).chat_model(model)
+
+
+def cooldown_key(model):
+    return f"llm:cooldown:{settings.LLM_PROVIDER}:{model}"
+
+
+def cool_down_model(model, seconds):
+    # Route around a rate limited model until its cooldown is over
+    cache.set(cooldown_key(model), 1, timeout=seconds)
+
+
+def fitting_models(estimated_tokens):
+    # Every model whose context window fits the prompt, smallest (cheapest, fastest) first.
+    # A prompt too big for all of them goes to the largest, as it always did.
+    models = sorted(settings.LLM_MODELS, key=lambda model: model["context_tokens"])
+    fitting = [model["name"] for model in models if model["context_tokens"] >= estimated_tokens]
+    return fitting or [models[-1]["name"]]
+
+
+def route_models(estimated_tokens):
+    # Models to try in order, the ones still cooling down from a rate limit go last
+    models = fitting_models(estimated_tokens)
+    cooling = cache.get_many([cooldown_key(model) for model in models])
+    return (
+        [model for model in models if cooldown_key(model) not in cooling]
+        + [model for model in models if cooldown_key(model) in cooling]
+    )
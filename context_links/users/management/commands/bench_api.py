@@ -0,0 +1,333 @@
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import requests
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Share of the mixed traffic each endpoint gets, bulk_import only runs while seeding
+TRAFFIC = {"user_links": 5, "create_context": 2, "chat": 3}
+
+# Fewer requests than this and the p95 is little more than the slowest one, so the median is compared instead
+MIN_P95_REQUESTS = 30
+
+WORDS = "context link page summary retrieval token answer question model origin".split()
+
+# Run inside the benchmarked app, prints a bearer token per user
+SEED_USERS = """
+import json
+from users.authentication import issue_token
+from users.models import User
+users = [User.objects.get_or_create(email=f"bench{i}@example.com", defaults={"first_name": "Bench"})[0] for i in range({users})]
+print(json.dumps([issue_token(user) for user in users]))
+"""
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    # Stand-in for the pages users save, every path is an article of server.page_words words
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path == "/robots.txt":
+            body, content_type = b"User-agent: *\nAllow: /\n", "text/plain"
+        else:
+            time.sleep(self.server.latency)
+            words = random.Random(self.path).choices(WORDS, k=self.server.page_words)
+            paragraphs = "".join(f"<p>{' '.join(words[i:i + 50])}</p>" for i in range(0, len(words), 50))
+            body = f"<html><head><title>{self.path}</title></head><body>{paragraphs}</body></html>".encode()
+            content_type = "text/html; charset=utf-8"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class GroqHandler(BaseHTTPRequestHandler):
+    # Answers /openai/v1/chat/completions the way Groq does, after server.latency seconds
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        time.sleep(self.server.latency)
+        prompt_tokens = sum(len(str(message.get("content", ""))) for message in payload["messages"]) // 4 + 1
+        answer = "This is a stand-in answer from the benchmark."
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": 10, "total_tokens": prompt_tokens + 10}
+        completion = {"id": "chatcmpl-bench", "created": int(time.time()), "model": payload["model"]}
+
+        if not payload.get("stream"):
+            body = json.dumps({
+                **completion, "object": "chat.completion", "usage": usage,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            }).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        # Groq reports usage on the last chunk, under x_groq
+        chunks = [{"choices": [{"index": 0, "delta": {"role": "assistant", "content": word + " "}, "finish_reason": None}]}
+                  for word in answer.split()]
+        chunks.append({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}], "x_groq": {"usage": usage}})
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for chunk in chunks:
+            self.wfile.write(f"data: {json.dumps({**completion, 'object': 'chat.completion.chunk', **chunk})}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+def start_server(handler, **attributes):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    for name, value in attributes.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(sorted_values, percent):
+    # Nearest rank
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(percent / 100 * len(sorted_values)) - 1)]
+
+
+class Recorder:
+    # Latency of every request per endpoint, and how many failed
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def call(self, endpoint, session, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, timeout=120, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response, ok = None, False
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(elapsed)
+            self.errors[endpoint] = self.errors.get(endpoint, 0) + (not ok)
+        return response if ok else None
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            latencies = sorted(latencies)
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors[endpoint],
+                "throughput_rps": round(len(latencies) / elapsed, 2),
+                **{f"p{p}_ms": round(percentile(latencies, p) * 1000, 1) for p in (50, 95, 99)},
+            }
+        return endpoints
+
+
+class Command(BaseCommand):
+    help = (
+        "Starts the API against a scratch database, a stand-in origin for scraped pages and a stand-in "
+        "Groq endpoint, drives concurrent traffic and reports p50/p95/p99 latency and throughput per endpoint. "
+        "With --baseline it fails when an endpoint got slower than the committed numbers allow."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=4)
+        parser.add_argument("--links-per-user", type=int, default=40, help="Links each user bulk imports first.")
+        parser.add_argument("--links-per-context", type=int, default=5)
+        parser.add_argument("--requests", type=int, default=300, help="Requests in the mixed traffic phase.")
+        parser.add_argument("--concurrency", type=int, default=8, help="Clients sending requests at once.")
+        parser.add_argument("--origin-latency-ms", type=float, default=50)
+        parser.add_argument("--page-words", type=int, default=800)
+        parser.add_argument("--llm-latency-ms", type=float, default=300)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+        parser.add_argument("--baseline", help="Results JSON to compare against.")
+        parser.add_argument(
+            "--threshold", type=float, default=0.25,
+            help=f"Fail when an endpoint's p95 (p50 with under {MIN_P95_REQUESTS} requests) is this fraction above the baseline's.",
+        )
+
+    def handle(self, *args, **options):
+        config = {name: options[name] for name in (
+            "users", "links_per_user", "links_per_context", "requests", "concurrency",
+            "origin_latency_ms", "page_words", "llm_latency_ms", "seed",
+        )}
+        origin, origin_url = start_server(
+            OriginHandler, latency=options["origin_latency_ms"] / 1000, page_words=options["page_words"]
+        )
+        groq, groq_url = start_server(GroqHandler, latency=options["llm_latency_ms"] / 1000)
+
+        with tempfile.TemporaryDirectory() as workdir:
+            port = free_port()
+            env = {
+                **os.environ,
+                "DB_ENGINE": "sqlite",
+                "DB_NAME": str(Path(workdir) / "bench.sqlite3"),
+                "ALLOWED_HOSTS": "127.0.0.1",
+                "LLM_PROVIDER": "groq",
+                "GROQ_API_KEY": "bench",
+                "GROQ_BASE_URL": groq_url,
+                # The app's own budget would otherwise throttle the benchmark, not the stand-in
+                "LLM_TOKENS_PER_MINUTE": str(10 ** 9),
+                "LLM_REQUESTS_PER_MINUTE": str(10 ** 9),
+            }
+            self.manage(env, "migrate", "--no-input")
+            tokens = json.loads(self.manage(env, "shell", "-c", SEED_USERS.replace("{users}", str(options["users"]))))
+
+            log = open(Path(workdir) / "runserver.log", "w")
+            server = subprocess.Popen(
+                [sys.executable, "manage.py", "runserver", "--noreload", "--skip-checks", f"127.0.0.1:{port}"],
+                cwd=settings.BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+            )
+            try:
+                base = f"http://127.0.0.1:{port}"
+                self.wait_for(base, server, log.name)
+                results = self.run_traffic(base, origin_url, tokens, options)
+            finally:
+                server.terminate()
+                server.wait()
+                log.close()
+                origin.shutdown()
+                groq.shutdown()
+
+        results["config"] = config
+        self.report(results)
+        if options["output"]:
+            Path(options["output"]).write_text(json.dumps(results, indent=2) + "\n")
+            self.stdout.write(f"Wrote {options['output']}")
+        if options["baseline"]:
+            self.compare(results, json.loads(Path(options["baseline"]).read_text()), options["threshold"])
+
+    def manage(self, env, *command):
+        completed = subprocess.run(
+            [sys.executable, "manage.py", *command], cwd=settings.BASE_DIR, env=env, capture_output=True, text=True,
+        )
+        if completed.returncode != 0:
+            raise CommandError(f"manage.py {' '.join(command[:1])} failed:\n{completed.stderr[-2000:]}")
+        return completed.stdout
+
+    def wait_for(self, base, server, log_path, timeout=30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if server.poll() is not None:
+                break
+            try:
+                requests.get(f"{base}/metrics", timeout=1)
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        raise CommandError(f"runserver did not start:\n{Path(log_path).read_text()[-2000:]}")
+
+    def run_traffic(self, base, origin_url, tokens, options):
+        recorder = Recorder()
+        clients = []
+        for token in tokens:
+            session = requests.Session()
+            session.headers["Authorization"] = f"Bearer {token}"
+            clients.append({"session": session, "links": [], "contexts": [], "lock": threading.Lock()})
+
+        def seed(number):
+            client = clients[number]
+            links = [{"link": f"{origin_url}/u{number}/{i}", "name": f"Page {i}"} for i in range(options["links_per_user"])]
+            for start in range(0, len(links), 20):
+                response = recorder.call(
+                    "bulk_import", client["session"], "POST", f"{base}/api/links/bulk_import/",
+                    json={"links": links[start:start + 20], "extract": False},
+                )
+                if response is not None:
+                    client["links"].extend(result["id"] for result in response.json()["results"] if result.get("id"))
+
+        def create_context(client, pick):
+            link_ids = pick.sample(client["links"], min(options["links_per_context"], len(client["links"])))
+            response = recorder.call(
+                "create_context", client["session"], "POST", f"{base}/api/context/create_context/",
+                json={"link_ids": link_ids},
+            )
+            if response is not None:
+                with client["lock"]:
+                    client["contexts"].append(response.json()["context_id"])
+
+        def request(index):
+            pick = random.Random(f"{options['seed']}:{index}")
+            client = pick.choice(clients)
+            endpoint = pick.choices(list(TRAFFIC), weights=list(TRAFFIC.values()))[0]
+            with client["lock"]:
+                contexts = list(client["contexts"])
+            if endpoint == "user_links":
+                recorder.call("user_links", client["session"], "GET", f"{base}/api/links/user_links/")
+            elif endpoint == "create_context" or not contexts:
+                create_context(client, pick)
+            else:
+                recorder.call(
+                    "chat", client["session"], "POST", f"{base}/api/context/chat/",
+                    json={"context_id": pick.choice(contexts), "user_input": pick.choice(WORDS) + "?"},
+                )
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options["concurrency"]) as executor:
+            list(executor.map(seed, range(len(clients))))
+        seeding = recorder.summary(time.perf_counter() - started)
+
+        recorder = Recorder()
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options["concurrency"]) as executor:
+            list(executor.map(request, range(options["requests"])))
+        elapsed = time.perf_counter() - started
+        return {"endpoints": {**seeding, **recorder.summary(elapsed)}, "duration_s": round(elapsed, 2)}
+
+    def report(self, results):
+        self.stdout.write(f"{'endpoint':<16}{'requests':>9}{'errors':>8}{'rps':>8}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}")
+        for endpoint, row in results["endpoints"].items():
+            self.stdout.write(
+                f"{endpoint:<16}{row['requests']:>9}{row['errors']:>8}{row['throughput_rps']:>8}"
+                f"{row['p50_ms']:>9}{row['p95_ms']:>9}{row['p99_ms']:>9}"
+            )
+
+    def compare(self, results, baseline, threshold):
+        if baseline.get("config") != results["config"]:
+            self.stdout.write(self.style.WARNING("The baseline was recorded with other options, comparing anyway"))
+        regressions = []
+        for endpoint, before in baseline["endpoints"].items():
+            after = results["endpoints"].get(endpoint)
+            if after is None:
+                regressions.append(f"{endpoint}: no requests")
+                continue
+            percentile = "p95" if min(before["requests"], after["requests"]) >= MIN_P95_REQUESTS else "p50"
+            if after[f"{percentile}_ms"] > before[f"{percentile}_ms"] * (1 + threshold):
+                regressions.append(f"{endpoint}: {percentile} {before[f'{percentile}_ms']} ms -> {after[f'{percentile}_ms']} ms")
+            if after["errors"] > before["errors"]:
+                regressions.append(f"{endpoint}: {before['errors']} -> {after['errors']} errors")
+        if regressions:
+            raise CommandError(f"Slower than the baseline by more than {threshold:.0%}:\n  " + "\n  ".join(regressions))
+        self.stdout.write(self.style.SUCCESS(f"Within {threshold:.0%} of the baseline"))
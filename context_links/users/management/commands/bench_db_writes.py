@@ -0,0 +1,86 @@
+import statistics
+import threading
+import time
+import uuid
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connection, transaction
+
+from users.models import Context, ContextSegment, TextChunk, User, UserLinks
+from users.storage import store_texts
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures write throughput of the configured database under concurrency by saving links and "
+        "contexts (with page text and chunks) from several threads at once, the way parallel create_context calls do."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=8, help="Concurrent writer threads.")
+        parser.add_argument("--contexts", type=int, default=25, help="Contexts saved by each worker.")
+        parser.add_argument("--links", type=int, default=5, help="Links saved for, and attached to, each context.")
+        parser.add_argument("--chunks", type=int, default=20, help="Chunks saved with each page.")
+
+    def handle(self, *args, **options):
+        user = User.objects.create_user(f"loadtest-{uuid.uuid4().hex}@example.com", "Load", "Test")
+        latencies, errors = [], []
+        lock = threading.Lock()
+
+        def save_context(worker, index):
+            with transaction.atomic():
+                links = UserLinks.objects.bulk_create([
+                    UserLinks(name=f"{worker}-{index}-{n}", user=user, link=f"https://example.com/{worker}/{index}/{n}")
+                    for n in range(options["links"])
+                ])
+                context = Context.objects.create(user=user)
+                context.links.set(links)
+                blobs = store_texts([f"{link.link} " + "x " * 1000 for link in links])
+                ContextSegment.objects.bulk_create([
+                    ContextSegment(context=context, link=link, url=link.link, position=n, blob=blob)
+                    for n, (link, blob) in enumerate(zip(links, blobs.values()))
+                ])
+                TextChunk.objects.bulk_create([
+                    TextChunk(blob=blob, position=n, start=n * 250, end=n * 250 + 300, term_counts={"x": 300}, length=300)
+                    for blob in blobs.values() for n in range(options["chunks"])
+                ])
+
+        def work(worker):
+            try:
+                for index in range(options["contexts"]):
+                    started = time.perf_counter()
+                    try:
+                        save_context(worker, index)
+                    except Exception as e:
+                        with lock:
+                            errors.append(str(e))
+                        continue
+                    with lock:
+                        latencies.append(time.perf_counter() - started)
+            finally:
+                close_old_connections()
+                connection.close()
+
+        self.stdout.write(
+            f"{connection.vendor}: {options['workers']} workers x {options['contexts']} contexts "
+            f"({options['links']} links, {options['chunks']} chunks each)"
+        )
+        threads = [threading.Thread(target=work, args=(worker,)) for worker in range(options["workers"])]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        user.delete()
+
+        if latencies:
+            latencies.sort()
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+            self.stdout.write(
+                f"{len(latencies)} contexts saved in {elapsed:.2f}s: {len(latencies) / elapsed:.1f} contexts/s, "
+                f"p50 {statistics.median(latencies) * 1000:.1f} ms, p95 {p95 * 1000:.1f} ms"
+            )
+        if errors:
+            self.stdout.write(self.style.ERROR(f"{len(errors)} failed, first error: {errors[0]}"))
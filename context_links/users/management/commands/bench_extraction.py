@@ -0,0 +1,89 @@
+import time
+import tracemalloc
+from pathlib import Path
+
+from bs4 import BeautifulSoup
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from users.extraction import extract_text
+
+CHUNK_SIZE = 64 * 1024
+
+
+def beautifulsoup_text(raw):
+    # What the scraper did before users.extraction existed
+    soup = BeautifulSoup(raw.decode("utf-8", errors="replace"), 'html.parser')
+    return soup.get_text(separator=' ', strip=True)
+
+
+def streaming_text(raw, capped):
+    chunks = (raw[start:start + CHUNK_SIZE] for start in range(0, len(raw), CHUNK_SIZE))
+    if capped:
+        return extract_text(chunks, max_bytes=settings.PAGE_MAX_BYTES, max_chars=settings.PAGE_MAX_CHARS)
+    return extract_text(chunks)
+
+
+def measure(func, repeat):
+    # Best wall time over `repeat` runs, and peak Python memory of one run
+    best = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - started
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    result = func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def word_overlap(expected, actual):
+    # Share of the reference words that the new extractor also produced
+    expected_words, actual_words = set(expected.split()), set(actual.split())
+    if not expected_words:
+        return 1.0
+    return len(expected_words & actual_words) / len(expected_words)
+
+
+class Command(BaseCommand):
+    help = "Compares users.extraction with the old BeautifulSoup get_text path on a directory of saved pages."
+
+    def add_arguments(self, parser):
+        parser.add_argument("corpus", help="Directory of saved .html/.htm pages.")
+        parser.add_argument("--repeat", type=int, default=3, help="Timing runs per page, the best one is kept.")
+        parser.add_argument("--no-caps", action="store_true", help="Ignore PAGE_MAX_BYTES and PAGE_MAX_CHARS.")
+
+    def handle(self, *args, **options):
+        corpus = Path(options["corpus"])
+        pages = sorted(path for path in corpus.rglob("*") if path.suffix.lower() in (".html", ".htm"))
+        if not pages:
+            raise CommandError(f"No .html pages found in {corpus}")
+
+        self.stdout.write(f"{'page':40} {'KB':>8} {'bs4 ms':>8} {'new ms':>8} {'bs4 MB':>8} {'new MB':>8} {'overlap':>8}")
+        totals = {"bytes": 0, "bs4_time": 0, "new_time": 0, "bs4_peak": 0, "new_peak": 0, "overlap": 0}
+        for path in pages:
+            raw = path.read_bytes()
+            old_text, old_time, old_peak = measure(lambda: beautifulsoup_text(raw), options["repeat"])
+            new_text, new_time, new_peak = measure(lambda: streaming_text(raw, not options["no_caps"]), options["repeat"])
+            overlap = word_overlap(old_text, new_text)
+
+            totals["bytes"] += len(raw)
+            totals["bs4_time"] += old_time
+            totals["new_time"] += new_time
+            totals["bs4_peak"] = max(totals["bs4_peak"], old_peak)
+            totals["new_peak"] = max(totals["new_peak"], new_peak)
+            totals["overlap"] += overlap
+            self.stdout.write(
+                f"{path.name[:40]:40} {len(raw) / 1024:8.1f} {old_time * 1000:8.1f} {new_time * 1000:8.1f} "
+                f"{old_peak / 2 ** 20:8.1f} {new_peak / 2 ** 20:8.1f} {overlap:8.1%}"
+            )
+
+        self.stdout.write(
+            f"\n{len(pages)} pages, {totals['bytes'] / 2 ** 20:.1f} MB: "
+            f"bs4 {totals['bs4_time']:.2f}s, streaming {totals['new_time']:.2f}s "
+            f"({totals['bs4_time'] / max(totals['new_time'], 1e-9):.1f}x), "
+            f"peak memory {totals['bs4_peak'] / 2 ** 20:.1f} MB vs {totals['new_peak'] / 2 ** 20:.1f} MB, "
+            f"average word overlap {totals['overlap'] / len(pages):.1%}"
+        )
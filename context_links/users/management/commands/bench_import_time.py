@@ -0,0 +1,60 @@
+import subprocess
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Only needed once an LLM call or a Google sign in actually happens, importing any of these
+# at startup means something made them eager again
+LAZY_MODULES = ("langchain_core", "langchain_groq", "groq", "google.auth", "google.oauth2")
+
+
+def import_times(command):
+    # {module: (self us, cumulative us)} for a fresh `python -X importtime manage.py <command>`
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "manage.py", *command.split()],
+        cwd=settings.BASE_DIR, capture_output=True, text=True,
+    )
+    if completed.returncode != 0:
+        raise CommandError(f"manage.py {command} failed:\n{completed.stderr[-2000:]}")
+
+    times = {}
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, module = line[len("import time:"):].split("|")
+        times[module.strip()] = (int(self_us), int(cumulative_us))
+    return times
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures how long a fresh process spends importing modules to run a management command "
+        "(`check` by default) and fails if it exceeds --budget-ms or imports a module that should load lazily."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--command", default="check", help="Management command to time, with its arguments.")
+        parser.add_argument("--repeat", type=int, default=3, help="Runs to take the best of.")
+        parser.add_argument("--budget-ms", type=float, default=900, help="Fail above this total import time.")
+        parser.add_argument("--top", type=int, default=10, help="Slowest top-level imports to list.")
+
+    def handle(self, *args, **options):
+        best = None
+        for _ in range(options["repeat"]):
+            times = import_times(options["command"])
+            total = sum(self_us for self_us, _ in times.values()) / 1000
+            if best is None or total < best[0]:
+                best = total, times
+        total, times = best
+
+        self.stdout.write(f"manage.py {options['command']}: {total:.0f} ms importing {len(times)} modules")
+        for module, (_, cumulative_us) in sorted(times.items(), key=lambda item: item[1][1], reverse=True)[:options["top"]]:
+            self.stdout.write(f"  {cumulative_us / 1000:8.1f} ms  {module}")
+
+        eager = [module for module in LAZY_MODULES if module in times]
+        if eager:
+            raise CommandError(f"Imported at startup but should be lazy: {', '.join(eager)}")
+        if total > options["budget_ms"]:
+            raise CommandError(f"Import time {total:.0f} ms is over the {options['budget_ms']:.0f} ms budget")
+        self.stdout.write(self.style.SUCCESS(f"Within the {options['budget_ms']:.0f} ms budget"))
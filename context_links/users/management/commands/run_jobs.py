@@ -0,0 +1,34 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from users.jobs import claim_next_job, delete_finished_jobs, recover_jobs, run_job
+from users.scraping import PageContentCache
+from users.storage import delete_orphan_blobs
+
+
+class Command(BaseCommand):
+    help = "Runs queued background jobs (set JOBS_BACKEND = 'db' to send jobs here)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--once", action="store_true", help="Drain the queue and exit instead of polling.")
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to sleep when the queue is empty.")
+
+    def handle(self, *args, **options):
+        self.stdout.write("Waiting for jobs...")
+        delete_finished_jobs()
+        recover_jobs()
+        delete_orphan_blobs()
+        PageContentCache().evict()
+        while True:
+            close_old_connections()
+            job = claim_next_job()
+            if job is None:
+                if options["once"]:
+                    return
+                time.sleep(options["poll_interval"])
+                continue
+
+            job = run_job(job)
+            self.stdout.write(f"Job {job.pk} ({job.task}) {job.status}")
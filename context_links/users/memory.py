@@ -0,0 +1,71 @@
+from django.conf import settings
+
+from .models import Conversation, Message
+from .ratelimit import estimate_tokens
+
+
+class ConversationMemory:
+    # Keeps the prompt bounded however long a conversation runs: only the newest turns that fit
+    # max_tokens are sent verbatim, older ones are folded into the conversation's running summary
+
+    def __init__(self, conversation, max_tokens=None):
+        self.conversation = conversation
+        self.max_tokens = max_tokens or settings.CHAT_HISTORY_MAX_TOKENS
+
+    def _pending(self):
+        # Messages not yet folded into the summary, newest first
+        return self.conversation.messages.filter(id__gt=self.conversation.summarized_until).order_by("-id")
+
+    def _window(self, budget):
+        selected, used = [], 0
+        for message in self._pending().iterator():
+            if used + message.tokens > budget:
+                break
+            selected.append(message)
+            used += message.tokens
+        return selected[::-1]
+
+    def history(self):
+        from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+        messages = []
+        if self.conversation.summary:
+            messages.append(SystemMessage(content=f"Summary of the conversation so far: {self.conversation.summary}"))
+        for message in self._window(self.max_tokens):
+            if message.role == Message.HUMAN:
+                messages.append(HumanMessage(content=message.content))
+            else:
+                messages.append(AIMessage(content=message.content))
+        return messages
+
+    def last_question(self):
+        return self._pending().filter(role=Message.HUMAN).values_list("content", flat=True).first() or ""
+
+    def add_turn(self, human, ai):
+        Message.objects.bulk_create([
+            Message(conversation=self.conversation, role=Message.HUMAN, content=human, tokens=estimate_tokens(human)),
+            Message(conversation=self.conversation, role=Message.AI, content=ai, tokens=estimate_tokens(ai)),
+        ])
+
+    def needs_compaction(self):
+        return sum(self._pending().values_list("tokens", flat=True)) > self.max_tokens
+
+    def compact(self, summarize):
+        # Fold everything except the newest half-budget of turns into the summary. Keeping only half
+        # leaves room for a few more turns before the next compaction (and the next LLM call).
+        keep_ids = {message.pk for message in self._window(self.max_tokens // 2)}
+        fold = [message for message in self._pending().reverse() if message.pk not in keep_ids]
+        if not fold:
+            return False
+
+        summary = summarize(self.conversation.summary, fold)[-settings.CHAT_SUMMARY_MAX_TOKENS * 4:]
+        # Only if no other compaction got there first while the LLM was busy, or its messages would be folded in twice
+        compacted = Conversation.objects.filter(
+            pk=self.conversation.pk, summarized_until=self.conversation.summarized_until
+        ).update(summary=summary, summarized_until=fold[-1].pk)
+        if not compacted:
+            self.conversation.refresh_from_db(fields=["summary", "summarized_until"])
+            return False
+        self.conversation.summary = summary
+        self.conversation.summarized_until = fold[-1].pk
+        return True
@@ -0,0 +1,162 @@
+import bisect
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from functools import lru_cache
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+# Every metric defined below, in the order they are exported
+REGISTRY = []
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+TOKEN_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in (*zip(names, values), *extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    # Values live in this process only, each worker process exports its own
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        with self._lock:
+            values = sorted(self._values.items())
+        for key, value in values:
+            lines.extend(self._samples(key, value))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self, key, value):
+        return [f"{self.name}{_labels(self.labels, key)} {value}"]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=SECONDS_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self, key, value):
+        counts, total = value
+        samples, cumulative = [], 0
+        for bound, count in zip((*self.buckets, "+Inf"), counts):
+            cumulative += count
+            samples.append(f"{self.name}_bucket{_labels(self.labels, key, [('le', bound)])} {cumulative}")
+        samples.append(f"{self.name}_sum{_labels(self.labels, key)} {total}")
+        samples.append(f"{self.name}_count{_labels(self.labels, key)} {cumulative}")
+        return samples
+
+
+STAGE_SECONDS = Histogram(
+    "context_links_stage_seconds", "Time spent in each stage of a pipeline.", ["pipeline", "stage"]
+)
+LINK_FETCH_SECONDS = Histogram(
+    "context_links_link_fetch_seconds", "Time to download and parse one page.", ["outcome"]
+)
+LINK_PARSE_SECONDS = Histogram(
+    "context_links_link_parse_seconds", "Time spent extracting text from one page, without waiting on the network."
+)
+EXTRACTED_BYTES = Histogram(
+    "context_links_extracted_bytes", "Size of the text extracted from one page.", buckets=BYTES_BUCKETS
+)
+LINK_FETCHES_SHARED = Counter(
+    "context_links_link_fetch_shared_total", "Page fetches answered by a download another request already had running."
+)
+PAGE_CACHE_LOOKUPS = Counter(
+    "context_links_page_cache_lookups_total", "Page cache lookups by result.", ["result"]
+)
+LLM_SECONDS = Histogram(
+    "context_links_llm_request_seconds", "Latency of one call to the LLM provider.", ["model", "outcome"]
+)
+LLM_PROMPT_TOKENS = Histogram(
+    "context_links_llm_prompt_tokens", "Prompt tokens per LLM call, as reported by the provider.", ["model"],
+    buckets=TOKEN_BUCKETS,
+)
+LLM_COMPLETION_TOKENS = Histogram(
+    "context_links_llm_completion_tokens", "Completion tokens per LLM call, as reported by the provider.", ["model"],
+    buckets=TOKEN_BUCKETS,
+)
+LLM_RATE_LIMITED = Counter(
+    "context_links_llm_rate_limited_total",
+    "LLM calls rate limited, by the provider (429) or by our own budget before reaching it.", ["source", "model"],
+)
+
+
+def render_metrics():
+    # Prometheus text exposition format 0.0.4
+    return "\n".join(metric.render() for metric in REGISTRY) + "\n"
+
+
+def observe_llm_usage(model, usage):
+    if usage.get("input_tokens"):
+        LLM_PROMPT_TOKENS.observe(usage["input_tokens"], model=model)
+    if usage.get("output_tokens"):
+        LLM_COMPLETION_TOKENS.observe(usage["output_tokens"], model=model)
+
+
+@lru_cache(maxsize=1)
+def _tracer():
+    # OpenTelemetry is optional, without it (or with TRACING_ENABLED off) stages are only timed
+    try:
+        from opentelemetry import trace
+    except ImportError:
+        logger.warning("TRACING_ENABLED is set but opentelemetry is not installed")
+        return None
+    return trace.get_tracer("context_links")
+
+
+@contextmanager
+def stage(pipeline, name):
+    # Times the block into STAGE_SECONDS, and wraps it in a span when tracing is on
+    with ExitStack() as stack:
+        tracer = _tracer() if settings.TRACING_ENABLED else None
+        if tracer is not None:
+            stack.enter_context(tracer.start_as_current_span(f"{pipeline}.{name}"))
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            STAGE_SECONDS.observe(elapsed, pipeline=pipeline, stage=name)
+            logger.debug(f"pipeline={pipeline} stage={name} duration_ms={elapsed * 1000:.1f}")
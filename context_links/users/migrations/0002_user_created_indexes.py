@@ -0,0 +1,21 @@
+# Generated by Django 5.1.1 on 2026-10-18 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='context',
+            index=models.Index(fields=['user', 'created_on'], name='context_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='userlinks',
+            index=models.Index(fields=['user', 'created_on'], name='userlinks_user_created_idx'),
+        ),
+    ]
@@ -0,0 +1,83 @@
+# Generated by Django 5.1.1 on 2026-10-18 10:09
+
+import hashlib
+import zlib
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def move_context_text_to_blobs(apps, schema_editor):
+    # Existing contexts keep their text exactly as it was, as a single verbatim segment
+    Context = apps.get_model('users', 'Context')
+    ContextSegment = apps.get_model('users', 'ContextSegment')
+    TextBlob = apps.get_model('users', 'TextBlob')
+    for context in Context.objects.exclude(context='').iterator():
+        encoded = context.context.encode()
+        blob, _ = TextBlob.objects.get_or_create(
+            hash=hashlib.sha256(encoded).hexdigest(),
+            defaults={'data': zlib.compress(encoded), 'size': len(encoded)},
+        )
+        ContextSegment.objects.create(context=context, position=0, blob=blob, verbatim=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0002_user_created_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TextBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hash', models.CharField(max_length=64, unique=True)),
+                ('data', models.BinaryField()),
+                ('size', models.PositiveIntegerField(default=0)),
+                ('created_on', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ContextSegment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('url', models.TextField(blank=True)),
+                ('position', models.PositiveIntegerField()),
+                ('verbatim', models.BooleanField(default=False)),
+                ('context', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='segments', to='users.context')),
+                ('link', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='users.userlinks')),
+                ('blob', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='segments', to='users.textblob')),
+            ],
+            options={
+                'ordering': ['position'],
+            },
+        ),
+        migrations.CreateModel(
+            name='TextChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('position', models.PositiveIntegerField()),
+                ('start', models.PositiveIntegerField()),
+                ('end', models.PositiveIntegerField()),
+                ('term_counts', models.JSONField(default=dict)),
+                ('length', models.PositiveIntegerField(default=0)),
+                ('blob', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='chunks', to='users.textblob')),
+            ],
+            options={
+                'ordering': ['position'],
+            },
+        ),
+        migrations.RunPython(move_context_text_to_blobs, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='context',
+            name='context',
+        ),
+        migrations.DeleteModel(
+            name='ContextChunk',
+        ),
+        migrations.AddConstraint(
+            model_name='textchunk',
+            constraint=models.UniqueConstraint(fields=('blob', 'position'), name='textchunk_blob_position_uniq'),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.1.1 on 2026-10-18 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0003_context_text_blobs'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='userlinks',
+            index=models.Index(fields=['user', '-id'], name='userlinks_user_id_idx'),
+        ),
+    ]
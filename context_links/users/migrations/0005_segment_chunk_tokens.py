@@ -0,0 +1,61 @@
+# Generated by Django 5.1.1 on 2026-10-18 10:28
+
+import zlib
+
+from django.db import migrations, models
+
+
+def estimate_tokens(chars):
+    # Same estimate as users.ratelimit.estimate_tokens, four characters per token
+    return chars // 4 + 1
+
+
+def count_tokens(apps, schema_editor):
+    ContextSegment = apps.get_model('users', 'ContextSegment')
+    TextBlob = apps.get_model('users', 'TextBlob')
+    TextChunk = apps.get_model('users', 'TextChunk')
+
+    text_lengths = {}
+    for blob in TextBlob.objects.iterator():
+        text = zlib.decompress(blob.data).decode()
+        text_lengths[blob.pk] = len(text)
+        words = text.split()
+        chunks = list(TextChunk.objects.filter(blob=blob))
+        for chunk in chunks:
+            chunk.tokens = estimate_tokens(len(" ".join(words[chunk.start:chunk.end])))
+        TextChunk.objects.bulk_update(chunks, ['tokens'])
+
+    # What ContextSegment.render() produces for each kind of segment
+    segments = []
+    for segment in ContextSegment.objects.iterator():
+        text_length = text_lengths.get(segment.blob_id)
+        if segment.verbatim:
+            chars = text_length or 0
+        elif text_length is None:
+            chars = len(f"Link: {segment.url}, ")
+        else:
+            chars = len(f"Link: {segment.url}, Parsed content: , ") + text_length
+        segment.tokens = estimate_tokens(chars)
+        segments.append(segment)
+    ContextSegment.objects.bulk_update(segments, ['tokens'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0004_userlinks_user_id_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contextsegment',
+            name='tokens',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='textchunk',
+            name='tokens',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(count_tokens, migrations.RunPython.noop),
+    ]
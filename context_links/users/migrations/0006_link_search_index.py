@@ -0,0 +1,45 @@
+from django.db import migrations
+
+
+SQLITE_CREATE = [
+    "CREATE VIRTUAL TABLE users_linksearch USING fts5(owner, name, link, body, tokenize = 'porter unicode61')",
+    "INSERT INTO users_linksearch (rowid, owner, name, link, body) "
+    "SELECT link.id, 'u' || link.user_id, link.name, link.link, coalesce(page.text, '') "
+    "FROM users_userlinks link LEFT JOIN users_pagecontent page ON page.id = link.page_id",
+]
+
+POSTGRES_CREATE = [
+    "CREATE TABLE users_linksearch ("
+    "link_id bigint PRIMARY KEY REFERENCES users_userlinks (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED, "
+    "user_id bigint NOT NULL, document tsvector NOT NULL)",
+    "CREATE INDEX users_linksearch_document_idx ON users_linksearch USING GIN (document)",
+    "CREATE INDEX users_linksearch_user_idx ON users_linksearch (user_id)",
+    "INSERT INTO users_linksearch (link_id, user_id, document) "
+    "SELECT link.id, link.user_id, setweight(to_tsvector('english', link.name), 'A') "
+    "|| setweight(to_tsvector('simple', link.link), 'B') "
+    "|| setweight(to_tsvector('english', coalesce(page.text, '')), 'D') "
+    "FROM users_userlinks link LEFT JOIN users_pagecontent page ON page.id = link.page_id",
+]
+
+
+def create_search_index(apps, schema_editor):
+    # Only SQLite (FTS5) and Postgres (tsvector) can search, other databases go without
+    statements = {"sqlite": SQLITE_CREATE, "postgresql": POSTGRES_CREATE}.get(schema_editor.connection.vendor, [])
+    for statement in statements:
+        schema_editor.execute(statement)
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ("sqlite", "postgresql"):
+        schema_editor.execute("DROP TABLE IF EXISTS users_linksearch")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0005_segment_chunk_tokens'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
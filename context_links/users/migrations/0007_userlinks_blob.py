@@ -0,0 +1,37 @@
+import hashlib
+import zlib
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def keep_extracted_text(apps, schema_editor):
+    # Links extracted so far only point at the page cache, copy their text into blobs
+    TextBlob = apps.get_model('users', 'TextBlob')
+    UserLinks = apps.get_model('users', 'UserLinks')
+
+    links = UserLinks.objects.filter(page__status='ok').select_related('page')
+    for link in links.iterator():
+        text = link.page.text
+        blob, _ = TextBlob.objects.get_or_create(
+            hash=hashlib.sha256(text.encode()).hexdigest(),
+            defaults={'data': zlib.compress(text.encode(), settings.TEXT_BLOB_COMPRESSION_LEVEL), 'size': len(text.encode())},
+        )
+        UserLinks.objects.filter(pk=link.pk).update(blob=blob)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0006_link_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userlinks',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='user_links', to='users.textblob'),
+        ),
+        migrations.RunPython(keep_extracted_text, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.1.1 on 2026-10-18 10:49
+
+from urllib.parse import urlsplit, urlunsplit
+
+from django.db import migrations, models
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(link):
+    # Same as users.scraping.normalize_url
+    parts = urlsplit(link.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    return urlunsplit((scheme, host, parts.path or "/", parts.query, ""))
+
+
+def fill_normalized_urls(apps, schema_editor):
+    # The oldest copy of a page a user saved holds its normalized URL, later duplicates are left empty
+    UserLinks = apps.get_model('users', 'UserLinks')
+    seen = set()
+    links = []
+    for link in UserLinks.objects.order_by('id').only('id', 'user_id', 'link').iterator():
+        key = (link.user_id, normalize_url(link.link))
+        if key in seen:
+            continue
+        seen.add(key)
+        link.normalized_url = key[1]
+        links.append(link)
+    UserLinks.objects.bulk_update(links, ['normalized_url'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0007_userlinks_blob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='userlinks',
+            name='normalized_url',
+            field=models.CharField(blank=True, editable=False, max_length=255, null=True),
+        ),
+        migrations.RunPython(fill_normalized_urls, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='userlinks',
+            constraint=models.UniqueConstraint(fields=('user', 'normalized_url'), name='userlinks_user_normalized_url_uniq'),
+        ),
+    ]
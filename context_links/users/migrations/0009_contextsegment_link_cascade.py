@@ -0,0 +1,26 @@
+# Generated by Django 5.1.1 on 2026-10-18 11:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def delete_orphan_segments(apps, schema_editor):
+    # Segments of links deleted while they were kept with an empty link, their context no longer lists the link
+    ContextSegment = apps.get_model('users', 'ContextSegment')
+    ContextSegment.objects.filter(link__isnull=True, verbatim=False).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0008_userlinks_normalized_url'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='contextsegment',
+            name='link',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='users.userlinks'),
+        ),
+        migrations.RunPython(delete_orphan_segments, migrations.RunPython.noop),
+    ]
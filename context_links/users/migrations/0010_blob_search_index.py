@@ -0,0 +1,53 @@
+# Generated by Django 5.1.1 on 2026-10-18 11:47
+
+import zlib
+
+from django.db import migrations
+
+SQLITE_CREATE = [
+    "DROP TABLE users_linksearch",
+    "CREATE VIRTUAL TABLE users_linksearch USING fts5(owner, name, link, tokenize = 'porter unicode61')",
+    "CREATE VIRTUAL TABLE users_blobsearch USING fts5(body, content = '', tokenize = 'porter unicode61')",
+    "INSERT INTO users_linksearch (rowid, owner, name, link) SELECT id, 'u' || user_id, name, link FROM users_userlinks",
+]
+
+# What migration 0006 made
+SQLITE_DROP = [
+    "DROP TABLE users_blobsearch",
+    "DROP TABLE users_linksearch",
+    "CREATE VIRTUAL TABLE users_linksearch USING fts5(owner, name, link, body, tokenize = 'porter unicode61')",
+    "INSERT INTO users_linksearch (rowid, owner, name, link, body) "
+    "SELECT link.id, 'u' || link.user_id, link.name, link.link, coalesce(page.text, '') "
+    "FROM users_userlinks link LEFT JOIN users_pagecontent page ON page.id = link.page_id",
+]
+
+
+def index_blobs_once(apps, schema_editor):
+    # SQLite only: page text goes into a contentless table once per blob, instead of a copy per link
+    if schema_editor.connection.vendor != "sqlite":
+        return
+    for statement in SQLITE_CREATE:
+        schema_editor.execute(statement)
+    TextBlob = apps.get_model('users', 'TextBlob')
+    with schema_editor.connection.cursor() as cursor:
+        for blob in TextBlob.objects.filter(user_links__isnull=False).distinct().iterator():
+            cursor.execute(
+                "INSERT INTO users_blobsearch (rowid, body) VALUES (%s, %s)", [blob.pk, zlib.decompress(blob.data).decode()]
+            )
+
+
+def index_pages_per_link(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        for statement in SQLITE_DROP:
+            schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('users', '0009_contextsegment_link_cascade'),
+    ]
+
+    operations = [
+        migrations.RunPython(index_blobs_once, index_pages_per_link),
+    ]
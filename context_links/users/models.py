@@ -1,4 +1,7 @@
+import zlib
+
 from django.db import models
+from django.utils.functional import cached_property
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 
 class UserProfileManager(BaseUserManager):
@@ -52,7 +55,21 @@ class UserLinks(models.Model):
     name = models.CharField(max_length=255)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     link = models.URLField()
+    # scraping.normalize_url(link), a user saves each page once. Empty on duplicates saved before it existed.
+    normalized_url = models.CharField(max_length=255, null=True, blank=True, editable=False)
     created_on = models.DateField(auto_now_add=True)
+    page = models.ForeignKey("PageContent", null=True, blank=True, on_delete=models.SET_NULL, related_name="user_links")
+    # The text extracted when the link was saved. page is a cache entry that can be evicted, this is kept.
+    blob = models.ForeignKey("TextBlob", null=True, blank=True, on_delete=models.PROTECT, related_name="user_links")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user", "created_on"], name="userlinks_user_created_idx"),
+            models.Index(fields=["user", "-id"], name="userlinks_user_id_idx"),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=["user", "normalized_url"], name="userlinks_user_normalized_url_uniq"),
+        ]
 
     def __str__(self):
         return self.name
@@ -62,9 +79,161 @@ class Context(models.Model):
     created_on = models.DateField(auto_now_add=True)
     links = models.ManyToManyField(UserLinks)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    context = models.TextField()
-    
-    
+
+    class Meta:
+        indexes = [models.Index(fields=["user", "created_on"], name="context_user_created_idx")]
+
     def __str__(self):
         return f"{self.pk} - {self.user}"
-    
+
+    @cached_property
+    def text(self):
+        # The concatenated page text, assembled from the shared blobs only when somebody reads it
+        return "".join(segment.render() for segment in self.segments.select_related("blob"))
+
+
+class TextBlob(models.Model):
+    # Page text stored once per distinct content, zlib compressed
+    hash = models.CharField(max_length=64, unique=True)
+    data = models.BinaryField()
+    size = models.PositiveIntegerField(default=0)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.hash[:12]} ({self.size} bytes)"
+
+    @cached_property
+    def text(self):
+        return zlib.decompress(self.data).decode()
+
+
+class ContextSegment(models.Model):
+    # One link's part of a context, in order. blob is empty when the page couldn't be fetched.
+    # Verbatim segments hold text from before segments existed and are rendered as-is.
+    # Deleting a saved link takes it out of its contexts, segment and all.
+    context = models.ForeignKey(Context, on_delete=models.CASCADE, related_name="segments")
+    link = models.ForeignKey(UserLinks, null=True, blank=True, on_delete=models.CASCADE)
+    url = models.TextField(blank=True)
+    position = models.PositiveIntegerField()
+    blob = models.ForeignKey(TextBlob, null=True, blank=True, on_delete=models.PROTECT, related_name="segments")
+    verbatim = models.BooleanField(default=False)
+    tokens = models.PositiveIntegerField(default=0)  # estimated tokens of render(), counted when it is built
+
+    class Meta:
+        ordering = ["position"]
+
+    def __str__(self):
+        return f"{self.context_id} - {self.position}"
+
+    def render(self, text=None):
+        # text defaults to the whole blob, retrieval passes just the chunk it picked
+        if text is None and self.blob is not None:
+            text = self.blob.text
+        if self.verbatim:
+            return text or ""
+        if text is None:
+            return f"Link: {self.url}, "
+        return f"Link: {self.url}, Parsed content: {text}, "
+
+
+class TextChunk(models.Model):
+    # Retrieval index over a blob, built once per distinct page however many contexts use it.
+    # start and end are word offsets into the blob text.
+    blob = models.ForeignKey(TextBlob, on_delete=models.CASCADE, related_name="chunks")
+    position = models.PositiveIntegerField()
+    start = models.PositiveIntegerField()
+    end = models.PositiveIntegerField()
+    term_counts = models.JSONField(default=dict)
+    length = models.PositiveIntegerField(default=0)
+    tokens = models.PositiveIntegerField(default=0)  # estimated tokens of the chunk text
+
+    class Meta:
+        ordering = ["position"]
+        constraints = [models.UniqueConstraint(fields=["blob", "position"], name="textchunk_blob_position_uniq")]
+
+    def __str__(self):
+        return f"{self.blob_id} - {self.position}"
+
+
+class Conversation(models.Model):
+    context = models.ForeignKey(Context, on_delete=models.CASCADE, related_name="conversations")
+    summary = models.TextField(blank=True)
+    summarized_until = models.BigIntegerField(default=0)  # id of the last message folded into summary
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.pk} - context {self.context_id}"
+
+
+class Message(models.Model):
+    HUMAN = "human"
+    AI = "ai"
+    ROLE_CHOICES = [(HUMAN, "Human"), (AI, "AI")]
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name="messages")
+    role = models.CharField(max_length=16, choices=ROLE_CHOICES)
+    content = models.TextField()
+    tokens = models.PositiveIntegerField(default=0)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+
+    def __str__(self):
+        return f"{self.conversation_id} - {self.role}"
+
+
+class PageContent(models.Model):
+    FETCH_OK = "ok"
+    FETCH_FAILED = "failed"
+    FETCH_STATUS_CHOICES = [(FETCH_OK, "OK"), (FETCH_FAILED, "Failed")]
+
+    url = models.TextField()
+    url_hash = models.CharField(max_length=64, unique=True)
+    text = models.TextField(blank=True)
+    size = models.PositiveIntegerField(default=0)
+    content_hash = models.CharField(max_length=64, blank=True)
+    status = models.CharField(max_length=16, choices=FETCH_STATUS_CHOICES, default=FETCH_OK)
+    error = models.TextField(blank=True)
+    etag = models.CharField(max_length=255, blank=True)
+    last_modified = models.CharField(max_length=64, blank=True)
+    fetched_on = models.DateTimeField()
+    last_accessed = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return self.url
+
+
+class Job(models.Model):
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [(QUEUED, "Queued"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed")]
+
+    task = models.CharField(max_length=64)
+    payload = models.JSONField(default=dict)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    user = models.ForeignKey(User, null=True, blank=True, on_delete=models.CASCADE)
+    created_on = models.DateTimeField(auto_now_add=True)
+    started_on = models.DateTimeField(null=True, blank=True)
+    finished_on = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.pk} - {self.task} ({self.status})"
+
+
+class LLMUsage(models.Model):
+    # One row per minute of LLM traffic, shared by every process talking to Groq
+    window = models.BigIntegerField(unique=True)  # minutes since the epoch
+    requests = models.PositiveIntegerField(default=0)
+    tokens = models.PositiveIntegerField(default=0)
+    shed = models.PositiveIntegerField(default=0)
+    rate_limited = models.PositiveIntegerField(default=0)
+    retries = models.PositiveIntegerField(default=0)
+    cooldown_until = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.window} - {self.requests} requests, {self.tokens} tokens"
@@ -0,0 +1,55 @@
+from django.conf import settings
+from rest_framework.pagination import BasePagination, CursorPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class UserLinksPagination(CursorPagination):
+    # Keyset pagination, newest first, so a page costs the same however many links there are.
+    # The body stays a plain list, the other pages are in the Link header.
+    ordering = "-id"
+    page_size = settings.USER_LINKS_PAGE_SIZE
+    page_size_query_param = "page_size"
+    max_page_size = settings.USER_LINKS_MAX_PAGE_SIZE
+
+    def get_paginated_response(self, data):
+        links = [
+            f'<{url}>; rel="{rel}"'
+            for rel, url in (("next", self.get_next_link()), ("prev", self.get_previous_link())) if url
+        ]
+        return Response(data=data, headers={"Link": ", ".join(links)} if links else None)
+
+
+def _positive_int(value, default):
+    try:
+        return max(int(value), 1)
+    except (TypeError, ValueError):
+        return default
+
+
+class LinkSearchPagination(BasePagination):
+    # Numbered pages over ranked results, with the same plain list body and Link header as
+    # UserLinksPagination. Matches aren't counted, one extra row says whether there is a next page.
+    page_size = settings.USER_LINKS_PAGE_SIZE
+    max_page_size = settings.USER_LINKS_MAX_PAGE_SIZE
+
+    def paginate_search(self, search, request):
+        # search(limit, offset) returns that slice of the results
+        self.request = request
+        self.page = _positive_int(request.GET.get("page"), 1)
+        self.page_size = min(_positive_int(request.GET.get("page_size"), self.page_size), self.max_page_size)
+        results = search(self.page_size + 1, (self.page - 1) * self.page_size)
+        self.has_next = len(results) > self.page_size
+        return results[:self.page_size]
+
+    def get_page_link(self, page):
+        url = self.request.build_absolute_uri()
+        return remove_query_param(url, "page") if page == 1 else replace_query_param(url, "page", page)
+
+    def get_paginated_response(self, data):
+        links = []
+        if self.has_next:
+            links.append(f'<{self.get_page_link(self.page + 1)}>; rel="next"')
+        if self.page > 1:
+            links.append(f'<{self.get_page_link(self.page - 1)}>; rel="prev"')
+        return Response(data=data, headers={"Link": ", ".join(links)} if links else None)
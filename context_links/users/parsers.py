@@ -0,0 +1,25 @@
+import json
+
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser
+
+
+class NDJSONParser(BaseParser):
+    # One item per line: a JSON object, or just a URL (what most bookmark exports boil down to)
+    media_type = "application/x-ndjson"
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        encoding = (parser_context or {}).get("encoding", "utf-8")
+        items = []
+        for number, line in enumerate(stream.read().decode(encoding).splitlines(), start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith("{"):
+                items.append({"link": line})
+                continue
+            try:
+                items.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                raise ParseError(f"Line {number} is not valid JSON: {e}")
+        return {"links": items}
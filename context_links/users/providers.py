@@ -0,0 +1,33 @@
+import threading
+
+# Name -> factory, filled in by the @provider decorator. Clients are only built (and their
+# libraries only imported) the first time something asks for them, not when Django starts.
+PROVIDERS = {}
+
+_INSTANCES = {}
+_LOCK = threading.Lock()
+
+
+def provider(name):
+    def register(factory):
+        PROVIDERS[name] = factory
+        return factory
+    return register
+
+
+def get_provider(name):
+    instance = _INSTANCES.get(name)
+    if instance is None:
+        with _LOCK:
+            instance = _INSTANCES.get(name)
+            if instance is None:
+                instance = PROVIDERS[name]()
+                _INSTANCES[name] = instance
+    return instance
+
+
+def reset_providers(*names):
+    # Built clients are dropped and rebuilt on next use, all of them if no names are given
+    with _LOCK:
+        for name in names or list(_INSTANCES):
+            _INSTANCES.pop(name, None)
@@ -0,0 +1,144 @@
+import asyncio
+import logging
+import math
+import random
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import F, Sum
+
+from .models import LLMUsage
+
+logger = logging.getLogger(__name__)
+
+
+# Provider cooldowns are looked up this many windows back
+COOLDOWN_LOOKBACK = 15
+
+# Usage rows older than this many windows are deleted
+USAGE_RETENTION = 60 * 24
+
+
+def estimate_tokens(*texts):
+    # Roughly four characters per token for English text, close enough for budgeting
+    return sum(len(text) for text in texts if text) // 4 + 1
+
+
+class BudgetExhausted(Exception):
+
+    def __init__(self, retry_after):
+        super().__init__(f"LLM budget exhausted, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class LLMRateLimiter:
+    # Sliding-window limiter over tokens per minute and requests per minute. State lives in the
+    # LLMUsage table and reservations are single conditional UPDATEs, so it holds across processes.
+
+    def __init__(self, tokens_per_minute=None, requests_per_minute=None):
+        self.tokens_per_minute = tokens_per_minute or settings.LLM_TOKENS_PER_MINUTE
+        self.requests_per_minute = requests_per_minute or settings.LLM_REQUESTS_PER_MINUTE
+
+    def try_acquire(self, tokens):
+        # Returns (0, window) once the request is reserved, otherwise (seconds to wait, None)
+        now = time.time()
+        window = int(now // 60)
+        elapsed = (now % 60) / 60
+        now_dt = datetime.fromtimestamp(now, tz=dt_timezone.utc)
+
+        rows = {row.window: row for row in LLMUsage.objects.filter(window__gte=window - COOLDOWN_LOOKBACK)}
+        cooldowns = [row.cooldown_until for row in rows.values() if row.cooldown_until and row.cooldown_until > now_dt]
+        if cooldowns:
+            return (max(cooldowns) - now_dt).total_seconds(), None
+
+        if window not in rows:
+            _, created = LLMUsage.objects.get_or_create(window=window)
+            if created:
+                LLMUsage.objects.filter(window__lt=window - USAGE_RETENTION).delete()
+
+        # The previous minute still counts for the part of it that overlaps the last 60 seconds
+        previous = rows.get(window - 1)
+        carried_tokens = previous.tokens * (1 - elapsed) if previous else 0
+        carried_requests = previous.requests * (1 - elapsed) if previous else 0
+
+        # A prompt bigger than the whole budget can only go through on an idle minute
+        tokens = min(tokens, self.tokens_per_minute)
+        token_allowance = int(self.tokens_per_minute - carried_tokens - tokens)
+        request_allowance = int(self.requests_per_minute - carried_requests - 1)
+        if token_allowance >= 0 and request_allowance >= 0:
+            reserved = LLMUsage.objects.filter(
+                window=window, tokens__lte=token_allowance, requests__lte=request_allowance
+            ).update(tokens=F("tokens") + tokens, requests=F("requests") + 1)
+            if reserved:
+                return 0, window
+
+        # Either the next minute starts or enough of the previous one slides out, whichever is first
+        return max(60 - now % 60, 1), None
+
+    def _pause(self, wait, waited, max_wait):
+        wait += random.uniform(0, min(wait, 1))  # jitter, so queued callers don't all wake at once
+        if waited + wait > max_wait:
+            self.record(shed=1)
+            raise BudgetExhausted(math.ceil(wait))
+        logger.info(f"LLM budget exhausted, waiting {wait:.1f}s")
+        return wait
+
+    def acquire(self, tokens, max_wait):
+        # Blocks until the request fits the budget and returns the window it was booked in,
+        # raises BudgetExhausted when that would take longer than max_wait seconds
+        waited = 0
+        while True:
+            wait, window = self.try_acquire(tokens)
+            if not wait:
+                return window
+            wait = self._pause(wait, waited, max_wait)
+            time.sleep(wait)
+            waited += wait
+
+    async def aacquire(self, tokens, max_wait):
+        waited = 0
+        while True:
+            wait, window = await sync_to_async(self.try_acquire)(tokens)
+            if not wait:
+                return window
+            wait = await sync_to_async(self._pause)(wait, waited, max_wait)
+            await asyncio.sleep(wait)
+            waited += wait
+
+    def adjust(self, window, delta):
+        # Replace the estimate booked in `window` with the real token count once it is known
+        if window is not None and delta:
+            LLMUsage.objects.filter(window=window).update(tokens=F("tokens") + delta)
+
+    def record(self, **counters):
+        window = int(time.time() // 60)
+        LLMUsage.objects.get_or_create(window=window)
+        LLMUsage.objects.filter(window=window).update(**{name: F(name) + value for name, value in counters.items()})
+
+    def cool_down(self, seconds):
+        # The provider said stop, so every process stops until it says we can continue
+        window = int(time.time() // 60)
+        until = datetime.now(tz=dt_timezone.utc) + timedelta(seconds=seconds)
+        LLMUsage.objects.get_or_create(window=window)
+        LLMUsage.objects.filter(window=window).update(rate_limited=F("rate_limited") + 1, cooldown_until=until)
+
+    def usage(self, minutes=60):
+        window = int(time.time() // 60)
+        current = LLMUsage.objects.filter(window=window).values("requests", "tokens").first() or {"requests": 0, "tokens": 0}
+        totals = LLMUsage.objects.filter(window__gt=window - minutes).aggregate(
+            requests=Sum("requests"), tokens=Sum("tokens"), shed=Sum("shed"),
+            rate_limited=Sum("rate_limited"), retries=Sum("retries"),
+        )
+        return {
+            "tokens_per_minute": self.tokens_per_minute,
+            "requests_per_minute": self.requests_per_minute,
+            "current_minute": current,
+            f"last_{minutes}_minutes": {name: value or 0 for name, value in totals.items()},
+        }
+
+
+def backoff_delay(attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, settings.LLM_RETRY_BASE_DELAY * 2 ** attempt)
@@ -0,0 +1,93 @@
+import math
+import re
+from collections import Counter
+
+WORD_RE = re.compile(r"\w+")
+
+# BM25 parameters, the usual defaults
+K1 = 1.5
+B = 0.75
+
+
+def tokenize(text):
+    return WORD_RE.findall(text.lower())
+
+
+def chunk_spans(word_count, chunk_words, overlap_words=0):
+    # (start, end) word offsets of windows of chunk_words words, consecutive windows share overlap_words
+    step = max(chunk_words - overlap_words, 1)
+    spans = []
+    for start in range(0, word_count, step):
+        spans.append((start, min(start + chunk_words, word_count)))
+        if start + chunk_words >= word_count:
+            break
+    return spans
+
+
+def split_into_chunks(text, chunk_words, overlap_words=0):
+    # Split on whitespace into windows of chunk_words words, consecutive windows share overlap_words
+    words = text.split()
+    return [" ".join(words[start:end]) for start, end in chunk_spans(len(words), chunk_words, overlap_words)]
+
+
+def index_chunk(text):
+    # What we keep per chunk so it can be scored later without re-tokenizing
+    terms = tokenize(text)
+    return dict(Counter(terms)), len(terms)
+
+
+def bm25_scores(query, documents):
+    # documents is a list of (term_counts, length) pairs, returns one score per document
+    query_terms = set(tokenize(query))
+    if not documents or not query_terms:
+        return [0.0] * len(documents)
+
+    average_length = sum(length for _, length in documents) / len(documents) or 1
+    document_frequency = {
+        term: sum(1 for term_counts, _ in documents if term in term_counts) for term in query_terms
+    }
+
+    scores = []
+    for term_counts, length in documents:
+        score = 0.0
+        for term in query_terms:
+            frequency = term_counts.get(term, 0)
+            if not frequency:
+                continue
+            df = document_frequency[term]
+            idf = math.log(1 + (len(documents) - df + 0.5) / (df + 0.5))
+            score += idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average_length))
+        scores.append(score)
+    return scores
+
+
+def allocate_tokens(sizes, budget):
+    # Splits budget between items of the given sizes: an item smaller than an equal share keeps
+    # all it needs, and what it leaves over is shared by the bigger ones
+    shares = [0] * len(sizes)
+    pending = sorted(range(len(sizes)), key=lambda index: sizes[index])
+    remaining = budget
+    while pending and sizes[pending[0]] <= remaining // len(pending):
+        index = pending.pop(0)
+        shares[index] = sizes[index]
+        remaining -= sizes[index]
+    for index in pending:
+        shares[index] = remaining // len(pending)
+    return shares
+
+
+def select_within_budget(scores, costs, groups, shares, budget):
+    # Indexes of the best scoring items whose costs add up to at most budget. Every group (a link)
+    # first gets its best items up to its share, whatever is left goes to the best of the rest.
+    # Kept in their original order so the text still reads naturally.
+    order = sorted(range(len(scores)), key=lambda index: scores[index], reverse=True)
+    selected, used, remaining = set(), {}, budget
+    for capped in (True, False):
+        for index in order:
+            cost, group = costs[index], groups[index]
+            if index in selected or cost > remaining or (capped and used.get(group, 0) + cost > shares[group]):
+                continue
+            selected.add(index)
+            used[group] = used.get(group, 0) + cost
+            remaining -= cost
+    return sorted(selected)
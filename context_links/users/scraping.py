@@ -0,0 +1,464 @@
+import hashlib
+import logging
+import socket
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import timedelta
+from urllib.parse import urlsplit, urlunsplit
+from urllib.robotparser import RobotFileParser
+
+import requests
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Sum
+from django.utils import timezone
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NameResolutionError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+
+from .extraction import UnsupportedContentType, extract_text, is_html
+from .metrics import EXTRACTED_BYTES, LINK_FETCH_SECONDS, LINK_FETCHES_SHARED, LINK_PARSE_SECONDS, PAGE_CACHE_LOOKUPS
+from .models import PageContent
+from .providers import get_provider, provider
+from .singleflight import SingleFlight, cached_single_flight
+
+logger = logging.getLogger(__name__)
+
+
+FetchedPage = namedtuple("FetchedPage", ["text", "etag", "last_modified", "not_modified"])
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Most of a robots.txt that is read, the same limit Google uses
+ROBOTS_MAX_BYTES = 500 * 1024
+
+# How long a robots.txt that could not be fetched (5xx, timeout) counts as allowing everything
+ROBOTS_ERROR_TTL = 60 * 5
+
+# Set while the page cache was checked for eviction recently
+PAGE_CACHE_EVICT_KEY = "page_cache:evicted"
+
+
+class RobotsDisallowed(Exception):
+    pass
+
+
+# One semaphore per host, shared by every fetch running in this process
+_HOST_SEMAPHORES = {}
+_HOST_SEMAPHORES_LOCK = threading.Lock()
+
+
+def _host_semaphore(link):
+    host = urlsplit(link).netloc.lower()
+    with _HOST_SEMAPHORES_LOCK:
+        semaphore = _HOST_SEMAPHORES.get(host)
+        if semaphore is None:
+            semaphore = threading.BoundedSemaphore(settings.LINK_FETCH_PER_HOST_LIMIT)
+            _HOST_SEMAPHORES[host] = semaphore
+        return semaphore
+
+
+# Fetches running in this process, by page and validators
+_FETCH_FLIGHT = SingleFlight()
+
+
+class DNSCache:
+    # Addresses each host resolved to, reused for LINK_FETCH_DNS_CACHE_TTL seconds. getaddrinfo doesn't
+    # say how long a record may be kept, so that should stay short. The least recently used hosts make
+    # room once max_entries are cached.
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def resolve(self, host, port):
+        key = (host, port)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[0] > now:
+                self._entries.move_to_end(key)
+                return cached[1]
+
+        addresses = socket.getaddrinfo(host, port, allowed_gai_family(), socket.SOCK_STREAM)
+        with self._lock:
+            self._entries[key] = (now + settings.LINK_FETCH_DNS_CACHE_TTL, addresses)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return addresses
+
+
+_DNS_CACHE = DNSCache()
+
+
+class CachedDNSConnectionMixin:
+    # Connects to the addresses _DNS_CACHE has for the host, in order, like urllib3 does with a fresh lookup
+
+    def _new_conn(self):
+        host = self._dns_host
+        try:
+            addresses = _DNS_CACHE.resolve(host.strip("[]"), self.port)
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        error = None
+        for *_, sockaddr in addresses:
+            self._dns_host = sockaddr[0]
+            try:
+                return super()._new_conn()
+            except (ConnectTimeoutError, NewConnectionError) as e:
+                error = e
+            finally:
+                self._dns_host = host
+        raise error
+
+
+class CachedDNSHTTPConnection(CachedDNSConnectionMixin, HTTPConnection):
+    pass
+
+
+class CachedDNSHTTPSConnection(CachedDNSConnectionMixin, HTTPSConnection):
+    pass
+
+
+class CachedDNSHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+
+class CachedDNSHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+
+class CachedDNSAdapter(requests.adapters.HTTPAdapter):
+    # Only connections made through this adapter use the DNS cache, every other client in the
+    # process (Groq, cache backends, OAuth) resolves hosts as usual
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": CachedDNSHTTPConnectionPool, "https": CachedDNSHTTPSConnectionPool}
+
+
+@provider("http_session")
+def http_session():
+    # One keep-alive connection pool shared by every fetch in the process
+    session = requests.Session()
+    adapter_class = CachedDNSAdapter if settings.LINK_FETCH_DNS_CACHE_TTL else requests.adapters.HTTPAdapter
+    adapter = adapter_class(
+        pool_connections=settings.LINK_FETCH_POOL_HOSTS, pool_maxsize=settings.LINK_FETCH_PER_HOST_LIMIT, max_retries=0
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = settings.LINK_FETCH_USER_AGENT
+    session.max_redirects = settings.LINK_FETCH_MAX_REDIRECTS
+    return session
+
+
+def fetch_robots(origin):
+    # robots.txt rules for origin and how long to keep them. A missing file allows everything,
+    # and so does one we couldn't get, but that is only remembered briefly.
+    try:
+        with get_provider("http_session").get(
+            f"{origin}/robots.txt", timeout=(settings.LINK_FETCH_CONNECT_TIMEOUT, settings.LINK_FETCH_TIMEOUT), stream=True
+        ) as response:
+            if 400 <= response.status_code < 500:
+                return "", settings.ROBOTS_CACHE_TTL
+            response.raise_for_status()
+            body = b""
+            for chunk in response.iter_content(chunk_size=64 * 1024):
+                body += chunk
+                if len(body) >= ROBOTS_MAX_BYTES:
+                    break
+            return body[:ROBOTS_MAX_BYTES].decode("utf-8", errors="replace"), settings.ROBOTS_CACHE_TTL
+    except requests.RequestException as e:
+        logger.info(f"Could not fetch {origin}/robots.txt: {e}")
+        return "", ROBOTS_ERROR_TTL
+
+
+def robots_allowed(link):
+    parts = urlsplit(normalize_url(link))
+    origin = f"{parts.scheme}://{parts.netloc}"
+    key = f"robots:{hashlib.sha256(origin.encode()).hexdigest()}"
+    rules = cache.get(key)
+    if rules is None:
+        rules, ttl = fetch_robots(origin)
+        cache.set(key, rules, timeout=ttl)
+
+    parser = RobotFileParser()
+    parser.parse(rules.splitlines())
+    return parser.can_fetch(settings.LINK_FETCH_USER_AGENT, link)
+
+
+def normalize_url(link):
+    # Same page, same key: lowercase scheme and host, drop default ports and fragments
+    parts = urlsplit(link.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        host = f"{host}:{parts.port}"
+    return urlunsplit((scheme, host, parts.path or "/", parts.query, ""))
+
+
+def url_hash(link):
+    return hashlib.sha256(normalize_url(link).encode()).hexdigest()
+
+
+def fetch_page(link, timeout=None, etag="", last_modified=""):
+    timeout = timeout or settings.LINK_FETCH_TIMEOUT
+    started = time.monotonic()
+
+    if settings.LINK_FETCH_OBEY_ROBOTS and not robots_allowed(link):
+        raise RobotsDisallowed("disallowed by robots.txt")
+
+    # Revalidate what we already have instead of downloading it again
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
+
+    # Fetch the HTML content of the page
+    session = get_provider("http_session")
+    with session.get(
+        link, headers=headers, timeout=(settings.LINK_FETCH_CONNECT_TIMEOUT, timeout), stream=True
+    ) as response:
+        if response.status_code == 304:
+            return FetchedPage(None, etag, last_modified, True)
+        response.raise_for_status()  # Ensure the request was successful
+
+        content_type = response.headers.get("Content-Type", "")
+        if not is_html(content_type):
+            raise UnsupportedContentType(f"skipped non-HTML content ({content_type})")
+
+        network_seconds = 0
+
+        def chunks():
+            # The read timeout only applies between reads, so enforce the per-link deadline here.
+            # read1 hands back whatever one read got instead of waiting for a full chunk, so a
+            # server trickling bytes can't hold us past the deadline.
+            nonlocal network_seconds
+            while True:
+                read_started = time.perf_counter()
+                chunk = response.raw.read1(64 * 1024, decode_content=True)
+                network_seconds += time.perf_counter() - read_started
+                if not chunk:
+                    return
+                yield chunk
+                if time.monotonic() - started > timeout:
+                    raise TimeoutError(f"took longer than {timeout}s to download")
+
+        # Text is extracted while the page downloads, and reading stops at the size caps
+        extract_started = time.perf_counter()
+        page_text = extract_text(
+            chunks(), encoding=response.encoding, max_bytes=settings.PAGE_MAX_BYTES, max_chars=settings.PAGE_MAX_CHARS
+        )
+        LINK_PARSE_SECONDS.observe(time.perf_counter() - extract_started - network_seconds)
+        EXTRACTED_BYTES.observe(len(page_text.encode()))
+        return FetchedPage(page_text, response.headers.get("ETag", ""), response.headers.get("Last-Modified", ""), False)
+
+
+def fetch_page_coalesced(link, timeout=None, etag="", last_modified=""):
+    # fetch_page, except that callers asking for the same page with the same validators while it
+    # is being fetched share that one download (and parse) instead of starting their own
+    ran = False
+
+    def fetch():
+        nonlocal ran
+        ran = True
+        with _host_semaphore(link):
+            return fetch_page(link, timeout=timeout, etag=etag, last_modified=last_modified)
+
+    validators = hashlib.sha256(f"{etag}|{last_modified}".encode()).hexdigest()[:16]
+    key = f"fetch:{url_hash(link)}:{validators}"
+    if settings.LINK_FETCH_SHARED_FLIGHT:
+        # Other processes wait on the cache lock and pick the result up from the cache
+        lock_timeout = settings.LINK_FETCH_CONNECT_TIMEOUT + (timeout or settings.LINK_FETCH_TIMEOUT)
+        fetched = cached_single_flight(
+            cache, key, fetch, timeout=settings.LINK_FETCH_SHARED_TTL, flight=_FETCH_FLIGHT, lock_timeout=lock_timeout
+        )
+    else:
+        fetched = _FETCH_FLIGHT.do(key, fetch)
+    if not ran:
+        LINK_FETCHES_SHARED.inc()
+    return fetched
+
+
+class PageContentCache:
+
+    def __init__(self, ttl=None, max_bytes=None):
+        self.ttl = timedelta(seconds=ttl or settings.PAGE_CACHE_TTL)
+        self.max_bytes = max_bytes or settings.PAGE_CACHE_MAX_BYTES
+
+    def get_many(self, links):
+        hashes = {url_hash(link) for link in links}
+        return {entry.url_hash: entry for entry in PageContent.objects.filter(url_hash__in=hashes)}
+
+    def is_fresh(self, entry):
+        return entry.status == PageContent.FETCH_OK and entry.fetched_on + self.ttl > timezone.now()
+
+    def touch(self, entries, revalidated=False):
+        if not entries:
+            return
+        now = timezone.now()
+        updates = {"last_accessed": now}
+        if revalidated:
+            updates["fetched_on"] = now
+        PageContent.objects.filter(pk__in=[entry.pk for entry in entries]).update(**updates)
+
+    def store(self, link, fetched):
+        now = timezone.now()
+        encoded = fetched.text.encode()
+        entry, _ = PageContent.objects.update_or_create(
+            url_hash=url_hash(link),
+            defaults={
+                "url": normalize_url(link),
+                "text": fetched.text,
+                "size": len(encoded),
+                "content_hash": hashlib.sha256(encoded).hexdigest(),
+                "status": PageContent.FETCH_OK,
+                "error": "",
+                "etag": fetched.etag,
+                "last_modified": fetched.last_modified,
+                "fetched_on": now,
+                "last_accessed": now,
+            },
+        )
+        return entry
+
+    def mark_failed(self, link, error):
+        # Keep whatever text we had, it just won't count as fresh until a fetch succeeds again
+        now = timezone.now()
+        entry, _ = PageContent.objects.update_or_create(
+            url_hash=url_hash(link),
+            defaults={"status": PageContent.FETCH_FAILED, "error": str(error)[:1000], "fetched_on": now},
+            create_defaults={
+                "url": normalize_url(link),
+                "status": PageContent.FETCH_FAILED,
+                "error": str(error)[:1000],
+                "fetched_on": now,
+                "last_accessed": now,
+            },
+        )
+        return entry
+
+    def evict_if_due(self):
+        # Summing the sizes reads the whole table, so stores only check once per PAGE_CACHE_EVICT_INTERVAL
+        if cache.add(PAGE_CACHE_EVICT_KEY, 1, timeout=settings.PAGE_CACHE_EVICT_INTERVAL):
+            return self.evict()
+        return 0
+
+    def evict(self):
+        # Drop the least recently used pages until the cache is back under its size budget
+        total = PageContent.objects.aggregate(total=Sum("size"))["total"] or 0
+        if total <= self.max_bytes:
+            return 0
+
+        evict_ids = []
+        for pk, size in PageContent.objects.order_by("last_accessed").values_list("pk", "size").iterator():
+            if total <= self.max_bytes:
+                break
+            evict_ids.append(pk)
+            total -= size
+        deleted_count, _ = PageContent.objects.filter(pk__in=evict_ids).delete()
+        logger.info(f"Evicted {deleted_count} pages from the page cache")
+        return deleted_count
+
+
+class ConcurrentLinkFetcher:
+
+    def __init__(self, max_workers=None, link_timeout=None, deadline=None, cache=None):
+        self.max_workers = max_workers or settings.LINK_FETCH_MAX_WORKERS
+        self.link_timeout = link_timeout or settings.LINK_FETCH_TIMEOUT
+        self.deadline = deadline or settings.CONTEXT_FETCH_DEADLINE
+        self.cache = cache or PageContentCache()
+
+    def _fetch(self, link, entry):
+        started = time.perf_counter()
+        try:
+            if entry is None:
+                fetched = fetch_page_coalesced(link, timeout=self.link_timeout)
+            else:
+                fetched = fetch_page_coalesced(
+                    link, timeout=self.link_timeout, etag=entry.etag, last_modified=entry.last_modified
+                )
+        except Exception:
+            LINK_FETCH_SECONDS.observe(time.perf_counter() - started, outcome="failed")
+            raise
+        LINK_FETCH_SECONDS.observe(time.perf_counter() - started, outcome="not_modified" if fetched.not_modified else "ok")
+        return fetched
+
+    def fetch_all(self, links):
+        # Page text for every link in the original order, None where the fetch failed
+        results = [None] * len(links)
+        if not links:
+            return results
+
+        # Fresh cache hits are served straight from the database, everything else goes to the network.
+        # All DB work stays on this thread, the pool threads only do HTTP and parsing.
+        cached = self.cache.get_many(links)
+        hits, pending = [], {}
+        for index, link in enumerate(links):
+            key = url_hash(link)
+            entry = cached.get(key)
+            if entry is not None and self.cache.is_fresh(entry):
+                results[index] = entry.text
+                hits.append(entry)
+            elif key in pending:
+                # The same page listed twice is only downloaded once
+                pending[key][2].append(index)
+            else:
+                pending[key] = (link, entry, [index])
+        self.cache.touch(hits)
+        PAGE_CACHE_LOOKUPS.inc(len(hits), result="hit")
+        PAGE_CACHE_LOOKUPS.inc(len(links) - len(hits), result="miss")
+        if not pending:
+            return results
+
+        executor = ThreadPoolExecutor(max_workers=min(self.max_workers, len(pending)))
+        futures = {executor.submit(self._fetch, link, entry): (link, entry, indexes) for link, entry, indexes in pending.values()}
+        done, not_done = wait(futures, timeout=self.deadline)
+
+        revalidated, stored = [], False
+        for future in done:
+            link, entry, indexes = futures[future]
+            try:
+                fetched = future.result()
+            except Exception as e:
+                logger.info(f"Failed to process link {link}: {e}")
+                self.cache.mark_failed(link, e)
+                continue
+            if fetched.not_modified:
+                page_text = entry.text
+                revalidated.append(entry)
+            else:
+                page_text = fetched.text
+                self.cache.store(link, fetched)
+                stored = True
+            for index in indexes:
+                results[index] = page_text
+        for future in not_done:
+            link = futures[future][0]
+            logger.info(f"Failed to process link {link}: context deadline of {self.deadline}s exceeded")
+            self.cache.mark_failed(link, f"context deadline of {self.deadline}s exceeded")
+
+        # Don't hold the request open for stragglers, they finish (or time out) on their own
+        executor.shutdown(wait=False, cancel_futures=True)
+
+        self.cache.touch(revalidated, revalidated=True)
+        if stored:
+            self.cache.evict_if_due()
+        return results
+
+
+def build_context_text(links, page_texts):
+    concatenated_content = ""
+    for link, page_text in zip(links, page_texts):
+        # Concatenate the link with the parsed content
+        if page_text is None:
+            concatenated_content += f"Link: {link}, "
+        else:
+            concatenated_content += f"Link: {link}, Parsed content: {page_text}, "
+    return concatenated_content
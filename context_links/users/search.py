@@ -0,0 +1,197 @@
+import logging
+
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import TextBlob, UserLinks
+from .retrieval import WORD_RE
+
+logger = logging.getLogger(__name__)
+
+
+# Created by migration 0006, an FTS5 table on SQLite and a tsvector table on Postgres
+SEARCH_TABLE = "users_linksearch"
+
+# Created by migration 0010 on SQLite, the page text index, one row per text blob
+BODY_TABLE = "users_blobsearch"
+
+# Words in the snippet shown with each result
+SNIPPET_WORDS = 16
+
+
+def query_terms(query):
+    # Words only, so nothing the user types is read as query syntax
+    return WORD_RE.findall(query.lower())
+
+
+def blob_texts(blob_ids):
+    return {blob.pk: blob.text for blob in TextBlob.objects.filter(pk__in=blob_ids)}
+
+
+class SQLiteSearch:
+    # FTS5 over link name and URL, ranked with bm25. Every row also holds its owner as a token ("u42"), so
+    # a user's search is answered from the index instead of filtering everybody's matches. Page text is
+    # indexed once per text blob, however many links share it, in a contentless table: only the index is
+    # kept, the text itself stays compressed in the blob.
+
+    def index(self, rows):
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [(row[0],) for row in rows])
+            cursor.executemany(
+                f"INSERT INTO {SEARCH_TABLE} (rowid, owner, name, link) VALUES (%s, %s, %s, %s)",
+                [(link_id, f"u{user_id}", name, link) for link_id, user_id, name, link, _ in rows],
+            )
+            blob_ids = list({blob_id for *_, blob_id in rows if blob_id})
+            if not blob_ids:
+                return
+            cursor.execute(f"SELECT rowid FROM {BODY_TABLE} WHERE rowid IN ({', '.join(['%s'] * len(blob_ids))})", blob_ids)
+            indexed = {blob_id for blob_id, in cursor.fetchall()}
+            cursor.executemany(
+                f"INSERT INTO {BODY_TABLE} (rowid, body) VALUES (%s, %s)",
+                list(blob_texts([blob_id for blob_id in blob_ids if blob_id not in indexed]).items()),
+            )
+
+    def delete(self, link_ids):
+        with connection.cursor() as cursor:
+            cursor.executemany(f"DELETE FROM {SEARCH_TABLE} WHERE rowid = %s", [(link_id,) for link_id in link_ids])
+
+    def delete_blob(self, blob):
+        # A contentless table can only forget a row given the text it indexed
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT rowid FROM {BODY_TABLE} WHERE rowid = %s", [blob.pk])
+            if cursor.fetchone():
+                cursor.execute(f"INSERT INTO {BODY_TABLE} ({BODY_TABLE}, rowid, body) VALUES ('delete', %s, %s)", [blob.pk, blob.text])
+
+    def search(self, user_id, terms, limit, offset):
+        # Every term has to match the name, URL or page text, the last one as a prefix so results show up
+        # while typing. Ranked by how well the whole query matches the name and URL, and the page text.
+        quoted = [f'"{term}"' for term in terms]
+        quoted[-1] += "*"
+        owner = f'owner:"u{user_id}"'
+        term_matches = " AND ".join(
+            f"(link.id IN (SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s) "
+            f"OR link.blob_id IN (SELECT rowid FROM {BODY_TABLE} WHERE {BODY_TABLE} MATCH %s))"
+            for _ in terms
+        )
+        params = [f"{owner} AND {{name link}}: ({' '.join(quoted)})", " ".join(quoted), user_id, user_id]
+        for term in quoted:
+            params += [f"{owner} AND {{name link}}: {term}", term]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"WITH name_hits AS (SELECT rowid AS link_id, -bm25({SEARCH_TABLE}, 0, 10, 2) AS rank "
+                f"FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH %s), "
+                f"body_hits AS (SELECT rowid AS blob_id, -bm25({BODY_TABLE}) AS rank FROM {BODY_TABLE} "
+                f"WHERE {BODY_TABLE} MATCH %s AND rowid IN (SELECT blob_id FROM users_userlinks WHERE user_id = %s)) "
+                "SELECT link.id, coalesce(name_hits.rank, 0) + coalesce(body_hits.rank, 0) AS rank "
+                "FROM users_userlinks link LEFT JOIN name_hits ON name_hits.link_id = link.id "
+                "LEFT JOIN body_hits ON body_hits.blob_id = link.blob_id "
+                f"WHERE link.user_id = %s AND {term_matches} ORDER BY rank DESC, link.id DESC LIMIT %s OFFSET %s",
+                params + [limit, offset],
+            )
+            return cursor.fetchall()
+
+
+class PostgresSearch:
+    # One weighted tsvector per link behind a GIN index: name (A) outranks the URL (B), which
+    # outranks page text (D). The text itself isn't copied, only its tsvector is stored.
+
+    def index(self, rows):
+        texts = blob_texts({blob_id for *_, blob_id in rows if blob_id})
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f"INSERT INTO {SEARCH_TABLE} (link_id, user_id, document) VALUES (%s, %s, "
+                "setweight(to_tsvector('english', %s), 'A') || setweight(to_tsvector('simple', %s), 'B') "
+                "|| setweight(to_tsvector('english', %s), 'D')) "
+                "ON CONFLICT (link_id) DO UPDATE SET user_id = EXCLUDED.user_id, document = EXCLUDED.document",
+                [(link_id, user_id, name, link, texts.get(blob_id, "")) for link_id, user_id, name, link, blob_id in rows],
+            )
+
+    def delete(self, link_ids):
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE link_id = ANY(%s)", [list(link_ids)])
+
+    def delete_blob(self, blob):
+        # Nothing is kept per blob, a blob is only deleted once no link uses it
+        pass
+
+    def search(self, user_id, terms, limit, offset):
+        match = " & ".join(terms) + ":*"
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT link_id, ts_rank_cd(document, query) AS rank FROM {SEARCH_TABLE}, to_tsquery('english', %s) query "
+                "WHERE user_id = %s AND document @@ query ORDER BY rank DESC, link_id DESC LIMIT %s OFFSET %s",
+                [match, user_id, limit, offset],
+            )
+            return cursor.fetchall()
+
+
+BACKENDS = {"sqlite": SQLiteSearch, "postgresql": PostgresSearch}
+
+
+def search_backend():
+    backend = BACKENDS.get(connection.vendor)
+    return backend() if backend else None
+
+
+def index_links(link_ids):
+    # (Re)indexes links after they are saved or their page is extracted. Page text is the text kept with
+    # the link when it was extracted, links that haven't been are found by name and URL.
+    backend = search_backend()
+    if backend is None or not link_ids:
+        return
+    backend.index(list(UserLinks.objects.filter(pk__in=link_ids).values_list("pk", "user_id", "name", "link", "blob_id")))
+
+
+def snippet(text, terms):
+    # About SNIPPET_WORDS words of text from the first one that matches a term, matches in [brackets].
+    # Matching is by prefix, a little shorter than long terms so "elections" finds "election" too.
+    prefixes = tuple(term if len(term) <= 4 else term[:-2] for term in terms)
+
+    def matches(word):
+        return any(part.startswith(prefixes) for part in WORD_RE.findall(word.lower()))
+
+    words = text.split()
+    first = next((index for index, word in enumerate(words) if matches(word)), 0)
+    start = max(first - SNIPPET_WORDS // 4, 0)
+    end = start + SNIPPET_WORDS
+    parts = [f"[{word}]" if matches(word) else word for word in words[start:end]]
+    return ("…" if start else "") + " ".join(parts) + ("…" if end < len(words) else "")
+
+
+def search_links(user, query, limit, offset=0):
+    # The user's links that match every word of query, best first, as dicts of the link's fields
+    # plus its rank and a snippet of the page text where it matched
+    backend = search_backend()
+    terms = query_terms(query)
+    if backend is None or not terms:
+        return []
+    hits = backend.search(user.pk, terms, limit, offset)
+    links = UserLinks.objects.filter(pk__in=[link_id for link_id, _ in hits]).select_related("blob").in_bulk()
+    return [
+        {
+            "id": link_id, "name": links[link_id].name, "link": links[link_id].link,
+            "created_on": links[link_id].created_on, "rank": round(rank, 4),
+            "snippet": snippet(links[link_id].blob.text, terms) if links[link_id].blob else "",
+        }
+        for link_id, rank in hits if link_id in links
+    ]
+
+
+@receiver(post_save, sender=UserLinks)
+def index_saved_link(sender, instance, **kwargs):
+    index_links([instance.pk])
+
+
+@receiver(post_delete, sender=UserLinks)
+def unindex_deleted_link(sender, instance, **kwargs):
+    backend = search_backend()
+    if backend is not None:
+        backend.delete([instance.pk])
+
+
+@receiver(post_delete, sender=TextBlob)
+def unindex_deleted_blob(sender, instance, **kwargs):
+    backend = search_backend()
+    if backend is not None:
+        backend.delete_blob(instance)
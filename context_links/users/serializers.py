@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import *
+from .scraping import normalize_url
 
 class UserSerializer(serializers.ModelSerializer):
     
@@ -13,10 +14,25 @@ class UseLinksSerializer(serializers.ModelSerializer):
     class Meta:
         model = UserLinks
         fields = "__all__"
+        read_only_fields = ["page", "blob"]
+
+    def validate(self, attrs):
+        if "link" in attrs:
+            attrs["normalized_url"] = normalize_url(attrs["link"])
+        return attrs
         
 
 class UserContextSerializer(serializers.ModelSerializer):
-    
+    # Assembled from the stored page text when a context is read
+    context = serializers.CharField(source="text", read_only=True)
+
     class Meta:
         model = Context
         fields = "__all__"
+
+
+class JobSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = Job
+        fields = ["id", "task", "status", "result", "error", "created_on", "started_on", "finished_on"]
@@ -0,0 +1,717 @@
+import asyncio
+import hashlib
+import logging
+import math
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.validators import URLValidator
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Max, Sum
+
+from .jobs import enqueue
+from .llm import chat_model, cool_down_model, fitting_models, route_models
+from .memory import ConversationMemory
+from .metrics import LLM_RATE_LIMITED, LLM_SECONDS, observe_llm_usage, stage
+from .models import Context, ContextSegment, Conversation, Job, TextChunk, UserLinks
+from .ratelimit import BudgetExhausted, LLMRateLimiter, backoff_delay, estimate_tokens
+from .retrieval import allocate_tokens, bm25_scores, chunk_spans, select_within_budget
+from .scraping import ConcurrentLinkFetcher, build_context_text, normalize_url
+from .search import index_links
+from .serializers import UserContextSerializer
+from .singleflight import SingleFlight, cached_single_flight
+from .storage import index_blobs, store_texts, text_hash
+
+logger = logging.getLogger(__name__)
+
+
+# Bump whenever the prompt changes, so cached summaries made with the old prompt are not reused
+SUMMARY_PROMPT_VERSION = 1
+DIGEST_PROMPT_VERSION = 1
+
+# Smallest page digest asked for, however many links share the budget
+DIGEST_MIN_TOKENS = 64
+
+# "[2]" on a line of its own starts the summary of the second page in a packed answer
+PACKED_SECTION_RE = re.compile(r"^\s*\[(\d+)\]\s*$", re.MULTILINE)
+
+_SUMMARY_FLIGHT = SingleFlight()
+
+LIMITER = LLMRateLimiter()
+
+
+class LLMRateLimited(Exception):
+
+    def __init__(self, retry_after):
+        super().__init__(f"Token limit reached, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class LLMError(Exception):
+    pass
+
+
+def _in_worker_thread(func, *args):
+    try:
+        return func(*args)
+    finally:
+        # Worker threads open their own DB connections, don't leak them
+        close_old_connections()
+
+
+def parse_rate_limit_cooldown(error_message):
+    # Seconds to wait if this is a Groq TPM rate limit error, None for any other error
+    if not ("Rate limit reached" in error_message and ("(TPM)" in error_message or "(RPM)" in error_message)):
+        return None
+
+    # Extract the cooldown time from the error message, "1m2.5s" or just "7.66s"
+    cooldown_match = re.search(r"Please try again in (?:(\d+)m)?(\d+(?:\.\d+)?)s", error_message)
+    if cooldown_match:
+        minutes, seconds = cooldown_match.groups()
+        return int(minutes or 0) * 60 + float(seconds)
+    return 600  # Default to 10 minutes if we can't parse the time
+
+
+def build_prompt():
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+    # Define the system and human messages
+    system_message = ""
+    human_message = f""
+
+    # Construct the chat prompt template, earlier turns of a conversation go between the two
+    return ChatPromptTemplate.from_messages([
+        ("system", system_message), MessagesPlaceholder("history", optional=True), ("human", human_message)
+    ])
+
+
+def llm_exception(e):
+    # Callers log it, a rate limit another model takes over is no error
+    error_message = str(e)
+    cooldown_seconds = parse_rate_limit_cooldown(error_message)
+    if cooldown_seconds is not None:
+        return LLMRateLimited(int(cooldown_seconds))
+    return LLMError(error_message)
+
+
+def estimate_request_tokens(context, variables):
+    return estimate_tokens(context, *[str(value) for value in variables.values()]) + settings.LLM_COMPLETION_TOKENS_ESTIMATE
+
+
+def invoke_routed(prompt, inputs, estimated_tokens):
+    # The smallest model that fits the prompt, falling back to the next one while a model is rate limited.
+    # Raises LLMRateLimited only once every fitting model has been.
+    error = None
+    for model in route_models(estimated_tokens):
+        started = time.perf_counter()
+        try:
+            response = (prompt | chat_model(model)).invoke(inputs)
+        except Exception as e:
+            error = llm_exception(e)
+            if not isinstance(error, LLMRateLimited):
+                logger.error(f"AI processing failed: {error}")
+                LLM_SECONDS.observe(time.perf_counter() - started, model=model, outcome="error")
+                raise error from e
+            LLM_SECONDS.observe(time.perf_counter() - started, model=model, outcome="rate_limited")
+            LLM_RATE_LIMITED.inc(source="provider", model=model)
+            cool_down_model(model, error.retry_after + 1)
+            logger.info(f"{model} is rate limited, trying the next model")
+            continue
+        LLM_SECONDS.observe(time.perf_counter() - started, model=model, outcome="ok")
+        observe_llm_usage(model, getattr(response, "usage_metadata", None) or {})
+        return response
+    raise error
+
+
+def invoke_llm(context, prompt=None, max_wait=None, **variables):
+    # max_wait is how long to queue for the token budget, LLM_MAX_QUEUE_WAIT unless a background job can wait longer
+    prompt = prompt or build_prompt()
+    estimated_tokens = estimate_request_tokens(context, variables)
+    max_wait = settings.LLM_MAX_QUEUE_WAIT if max_wait is None else max_wait
+
+    for attempt in range(settings.LLM_MAX_RETRIES + 1):
+        # Wait for room in the shared TPM/RPM budget rather than letting Groq reject the call
+        try:
+            window = LIMITER.acquire(estimated_tokens, max_wait=max_wait)
+        except BudgetExhausted as e:
+            LLM_RATE_LIMITED.inc(source="budget")
+            raise LLMRateLimited(e.retry_after) from e
+
+        # Invoke the AI model to get the response
+        try:
+            response = invoke_routed(prompt, {"text": context, **variables}, estimated_tokens)
+        except LLMRateLimited as error:
+            # Every model is rate limited, our estimate was off or someone else shares the key:
+            # pause everybody, then retry if the provider's cooldown is short enough to wait out
+            LIMITER.cool_down(error.retry_after + 1)
+            if attempt == settings.LLM_MAX_RETRIES or error.retry_after > max_wait:
+                logger.warning(f"Every model is rate limited, retry after {error.retry_after}s")
+                raise
+            LIMITER.record(retries=1)
+            time.sleep(backoff_delay(attempt))
+            continue
+
+        usage = getattr(response, "usage_metadata", None) or {}
+        if usage.get("total_tokens"):
+            LIMITER.adjust(window, usage["total_tokens"] - estimated_tokens)
+        logger.info("AI response successfully generated.")
+        if settings.LOG_PAYLOADS:
+            logger.info(f"the response is {response}, {type(response)}")
+        return response.content
+
+
+async def astream_routed(prompt, inputs, estimated_tokens, usage):
+    # invoke_routed for streams, but only until the first token: half an answer from one model can't be
+    # finished by another. The token usage the model reports is put in `usage`.
+    models = await sync_to_async(route_models)(estimated_tokens)
+    for index, model in enumerate(models):
+        streamed, model_usage = False, {}
+        started = time.perf_counter()
+        try:
+            async for chunk in (prompt | chat_model(model)).astream(inputs):
+                model_usage = getattr(chunk, "usage_metadata", None) or model_usage
+                if chunk.content:
+                    streamed = True
+                    yield chunk.content
+        except Exception as e:
+            error = llm_exception(e)
+            if not isinstance(error, LLMRateLimited):
+                logger.error(f"AI processing failed: {error}")
+                LLM_SECONDS.observe(time.perf_counter() - started, model=model, outcome="error")
+                raise error from e
+            LLM_SECONDS.observe(time.perf_counter() - started, model=model, outcome="rate_limited")
+            LLM_RATE_LIMITED.inc(source="provider", model=model)
+            await sync_to_async(cool_down_model)(model, error.retry_after + 1)
+            if streamed:
+                logger.warning(f"{model} was rate limited partway through an answer")
+                raise error from e
+            if index == len(models) - 1:
+                raise error from e
+            logger.info(f"{model} is rate limited, trying the next model")
+            continue
+        LLM_SECONDS.observe(time.perf_counter() - started, model=model, outcome="ok")
+        observe_llm_usage(model, model_usage)
+        usage.update(model_usage)
+        return
+
+
+async def astream_llm(context, **variables):
+    # Yields the response text piece by piece as the model produces it. Budgeted and retried like
+    # invoke_llm, except that nothing is retried once part of the answer has gone out.
+    prompt = build_prompt()
+    estimated_tokens = estimate_request_tokens(context, variables)
+
+    for attempt in range(settings.LLM_MAX_RETRIES + 1):
+        try:
+            window = await LIMITER.aacquire(estimated_tokens, max_wait=settings.LLM_MAX_QUEUE_WAIT)
+        except BudgetExhausted as e:
+            LLM_RATE_LIMITED.inc(source="budget")
+            raise LLMRateLimited(e.retry_after) from e
+
+        streamed, usage = False, {}
+        try:
+            async for token in astream_routed(prompt, {"text": context, **variables}, estimated_tokens, usage):
+                streamed = True
+                yield token
+        except LLMRateLimited as error:
+            # Same as invoke_llm: pause everybody, then retry if nothing went out and the cooldown is short
+            await sync_to_async(LIMITER.cool_down)(error.retry_after + 1)
+            if streamed:
+                raise
+            if attempt == settings.LLM_MAX_RETRIES or error.retry_after > settings.LLM_MAX_QUEUE_WAIT:
+                logger.warning(f"Every model is rate limited, retry after {error.retry_after}s")
+                raise
+            await sync_to_async(LIMITER.record)(retries=1)
+            await asyncio.sleep(backoff_delay(attempt))
+            continue
+
+        if usage.get("total_tokens"):
+            await sync_to_async(LIMITER.adjust)(window, usage["total_tokens"] - estimated_tokens)
+        logger.info("AI response successfully streamed.")
+        return
+
+
+def build_context_segments(context, user_links, page_texts, start=0):
+    # One segment per link pointing at the shared page text, which is stored and indexed
+    # for retrieval only the first time any context uses it
+    blobs = store_texts([page_text for page_text in page_texts if page_text is not None])
+    segments = []
+    for (link_id, link), page_text in zip(user_links, page_texts):
+        blob = None if page_text is None else blobs[text_hash(page_text)]
+        segment = ContextSegment(context=context, link_id=link_id, url=link, position=start + len(segments), blob=blob)
+        # Counted once here, so chat can tell whether the context fits without reading the text
+        segment.tokens = estimate_tokens(segment.render())
+        segments.append(segment)
+    ContextSegment.objects.bulk_create(segments)
+    index_blobs(list(blobs.values()))
+
+
+def context_tokens(context):
+    return context.segments.aggregate(tokens=Sum("tokens"))["tokens"] or 0
+
+
+def enqueue_digests(context):
+    # In map-reduce mode a context too big to send whole has its pages summarized in the background,
+    # ahead of the chat turns that use them. One job per context at a time.
+    if settings.CHAT_CONTEXT_MODE != "map_reduce" or context_tokens(context) <= settings.CHAT_CONTEXT_MAX_TOKENS:
+        return
+    pending = Job.objects.filter(task="digest_context", payload__context_id=context.pk, status__in=[Job.QUEUED, Job.RUNNING])
+    if not pending.exists():
+        enqueue("digest_context", {"context_id": context.pk}, user=context.user)
+
+
+def fetch_link_texts(user_links):
+    # Page text for (id, link) pairs, in order. Links keep the text extracted when they were saved and that
+    # is used as it is, only the links without it are fetched, concurrently and through the page cache.
+    saved = {
+        link.pk: link.blob.text
+        for link in UserLinks.objects.filter(pk__in=[link_id for link_id, _ in user_links], blob__isnull=False).select_related("blob")
+    }
+    missing = [(link_id, link) for link_id, link in user_links if link_id not in saved]
+    if missing:
+        page_texts = ConcurrentLinkFetcher().fetch_all([link for _, link in missing])
+        saved.update((link_id, page_text) for (link_id, _), page_text in zip(missing, page_texts))
+    return [saved[link_id] for link_id, _ in user_links]
+
+
+def build_context(user, link_ids):
+    user_links = list(UserLinks.objects.filter(id__in=link_ids, user_id=user.pk).values_list('id', 'link'))
+
+    # Fetch all the pages concurrently, results come back in the same order as links
+    with stage("create_context", "fetch"):
+        page_texts = fetch_link_texts(user_links)
+
+    user_context_data = {
+        "links":link_ids,
+        "user": user.pk,
+    }
+
+    serializer = UserContextSerializer(data=user_context_data)
+    if serializer.is_valid():
+        with stage("create_context", "store"), transaction.atomic():
+            context = serializer.save()
+            build_context_segments(context, user_links, page_texts)
+        enqueue_digests(context)
+        return context
+    logger.error(f"The errors are {serializer._errors}")
+    return None
+
+
+def add_links_to_context(context, link_ids):
+    # Fetches only the links that are new to the context and appends their segments,
+    # nothing already in the context is fetched or rewritten. Returns the ids added.
+    user_links = list(
+        UserLinks.objects.filter(id__in=link_ids, user_id=context.user_id)
+        .exclude(id__in=context.links.values("id")).order_by("id").values_list('id', 'link')
+    )
+    if not user_links:
+        return []
+    with stage("add_links", "fetch"):
+        page_texts = fetch_link_texts(user_links)
+
+    with stage("add_links", "store"), transaction.atomic():
+        last_position = context.segments.aggregate(last=Max("position"))["last"]
+        build_context_segments(context, user_links, page_texts, start=0 if last_position is None else last_position + 1)
+        context.links.add(*[link_id for link_id, _ in user_links])
+    enqueue_digests(context)
+    return [link_id for link_id, _ in user_links]
+
+
+def remove_links_from_context(context, link_ids):
+    # Drops the links' segments, the rest of the context is left as it is. Returns the ids removed.
+    removed = list(context.links.filter(id__in=link_ids).values_list("id", flat=True))
+    with transaction.atomic():
+        context.segments.filter(link_id__in=removed).delete()
+        context.links.remove(*removed)
+    return removed
+
+
+def import_user_links(user, items):
+    # Saves a batch of {"link", "name"} items for user in one insert. Returns one result per item, in
+    # order: "created", "duplicate" (already saved, or earlier in the batch) or "invalid".
+    validate_url = URLValidator()
+    max_length = UserLinks._meta.get_field("link").max_length
+    results, new_links = [], {}
+    for index, item in enumerate(items):
+        link = str(item.get("link") or "").strip() if isinstance(item, dict) else ""
+        try:
+            validate_url(link)
+            if len(link) > max_length:
+                raise ValidationError(f"Links can be at most {max_length} characters.")
+        except ValidationError as e:
+            results.append({"index": index, "link": link, "status": "invalid", "error": " ".join(e.messages)})
+            continue
+        key = normalize_url(link)
+        if key in new_links:
+            results.append({"index": index, "link": link, "status": "duplicate", "key": key})
+            continue
+        new_links[key] = UserLinks(user=user, link=link, normalized_url=key, name=str(item.get("name") or link)[:255])
+        results.append({"index": index, "link": link, "status": "created", "key": key})
+
+    # Links the user already has count as duplicates. An import running at the same time can save
+    # some of them between our check and our insert, the unique constraint stops that and we check again.
+    for attempt in range(2):
+        existing = dict(UserLinks.objects.filter(user=user, normalized_url__in=new_links).values_list("normalized_url", "id"))
+        try:
+            # bulk_create inserts the batch in a single transaction, and sends no post_save to index the links
+            with transaction.atomic():
+                created = UserLinks.objects.bulk_create([link for key, link in new_links.items() if key not in existing])
+            break
+        except IntegrityError:
+            if attempt:
+                raise
+            for link in new_links.values():
+                link.pk = None
+    index_links([link.pk for link in created])
+
+    for result in results:
+        key = result.pop("key", None)
+        if key is None:
+            continue
+        if key in existing:
+            result.update(status="duplicate", id=existing[key])
+        else:
+            result["id"] = new_links[key].pk
+    return results, [link.pk for link in created]
+
+
+def retrieve_context_text(segments, shares, user_input, budget):
+    # The chunks that best match the question, each link getting up to its share of the budget first
+    blobs = {segment.blob_id: segment.blob for segment in segments if segment.blob_id}
+    index_blobs(list(blobs.values()))  # Only does anything for text stored before indexing existed
+
+    chunks_by_blob = {}
+    for chunk in TextChunk.objects.filter(blob__in=blobs).values_list("blob_id", "start", "end", "term_counts", "length", "tokens"):
+        chunks_by_blob.setdefault(chunk[0], []).append(chunk)
+    chunks = [
+        (group, segment, chunk) for group, segment in enumerate(segments) for chunk in chunks_by_blob.get(segment.blob_id, [])
+    ]
+    if not chunks:
+        return "".join(segment.render() for segment in segments)
+
+    # Every chunk is sent as its own "Link: ..., Parsed content: ..." part
+    overheads = [estimate_tokens(segment.render("")) for segment in segments]
+    scores = bm25_scores(user_input, [(term_counts, length) for _, _, (_, _, _, term_counts, length, _) in chunks])
+    selected = select_within_budget(
+        scores, [tokens + overheads[group] for group, _, (*_, tokens) in chunks],
+        [group for group, _, _ in chunks], shares, budget,
+    )
+    logger.info(f"Sending {len(selected)} of {len(chunks)} chunks for context_id: {segments[0].context_id}")
+    words = {}
+    parts = []
+    for index in selected:
+        _, segment, (blob_id, start, end, _, _, _) = chunks[index]
+        if blob_id not in words:
+            words[blob_id] = segment.blob.text.split()
+        parts.append(segment.render(" ".join(words[blob_id][start:end])))
+    return "".join(parts)
+
+
+def build_digest_prompt():
+    from langchain_core.prompts import ChatPromptTemplate
+
+    return ChatPromptTemplate.from_messages([
+        ("system", "Summarize this part of a web page for someone who will ask questions about it. Keep facts, "
+                   "names, numbers and conclusions, and answer with the summary only, in at most {max_words} words."),
+        ("human", "{text}"),
+    ])
+
+
+def digest_tokens(share):
+    # Digests come in power of two sizes, so contexts that share a page mostly share its digest too
+    return max(2 ** int(math.log2(max(share, 1))), DIGEST_MIN_TOKENS)
+
+
+def digest_piece_tokens():
+    # A piece and its answer have to fit the largest model's window and a minute of the token budget,
+    # a bigger one would use up the budget by itself and leave every other call waiting
+    largest_window = max(model["context_tokens"] for model in settings.LLM_MODELS)
+    room = min(settings.LLM_TOKENS_PER_MINUTE, largest_window) - settings.LLM_COMPLETION_TOKENS_ESTIMATE
+    return max(min(settings.DIGEST_PIECE_TOKENS, room), DIGEST_MIN_TOKENS)
+
+
+def digest_pieces(blob):
+    # blob's text in pieces of about digest_piece_tokens(), counted the way the limiter counts them
+    words = blob.text.split()
+    piece_words = max(digest_piece_tokens() * len(words) // estimate_tokens(blob.text), 1)
+    return [" ".join(words[start:end]) for start, end in chunk_spans(len(words), piece_words)] or [""]
+
+
+def digest_cache_key(blob, max_tokens, pieces):
+    model = fitting_models(estimate_request_tokens(pieces[0], {}))[0]
+    return f"digest:{blob.hash}:{max_tokens}:{settings.LLM_PROVIDER}:{model}:v{DIGEST_PROMPT_VERSION}"
+
+
+def page_digest(blob, max_tokens, max_wait=None):
+    # A summary of blob's page in about max_tokens, made once per page and size and kept in the summary
+    # cache. A page too long for one call is summarized in pieces that each get their part of max_tokens.
+    pieces = digest_pieces(blob)
+
+    def summarize():
+        prompt = build_digest_prompt()
+        max_words = max_tokens * 3 // 4 // len(pieces)
+        return " ".join(invoke_llm(piece, prompt=prompt, max_wait=max_wait, max_words=max_words) for piece in pieces)
+
+    return cached_single_flight(
+        caches["summaries"], digest_cache_key(blob, max_tokens, pieces), summarize,
+        timeout=settings.SUMMARY_CACHE_TTL, flight=_SUMMARY_FLIGHT,
+    )
+
+
+def pages_to_digest(segments, shares):
+    # Index of every segment whose page is over its share -> (blob, digest size)
+    return {
+        index: (segment.blob, digest_tokens(share))
+        for index, (segment, share) in enumerate(zip(segments, shares))
+        if segment.blob_id and segment.blob.size and segment.tokens > share
+    }
+
+
+def make_digests(context):
+    # Makes the digests a context's chat turns use, several pages at once. Run by the digest_context job,
+    # which can wait for the token budget much longer than a chat request. Returns how many there are.
+    segments = list(context.segments.select_related("blob"))
+    shares = allocate_tokens([segment.tokens for segment in segments], settings.CHAT_CONTEXT_MAX_TOKENS)
+    digests = pages_to_digest(segments, shares)
+    with ThreadPoolExecutor(max_workers=settings.DIGEST_MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(_in_worker_thread, page_digest, blob, max_tokens, settings.DIGEST_MAX_QUEUE_WAIT)
+            for blob, max_tokens in digests.values()
+        ]
+    for future in futures:
+        future.result()
+    return len(digests)
+
+
+def digest_context_text(segments, shares, user_input):
+    # Map: every page over its share is sent as its digest. Reduce: the digests, and the pages small enough
+    # to go whole, make up the context in link order. A digest the background job hasn't made yet isn't
+    # waited for, the page's chunks that best match the question stand in for it.
+    # Returns the text and whether every digest was ready.
+    parts = [segment.render() for segment in segments]
+    digests = pages_to_digest(segments, shares)
+    keys = {
+        index: digest_cache_key(blob, max_tokens, digest_pieces(blob)) for index, (blob, max_tokens) in digests.items()
+    }
+    ready = caches["summaries"].get_many(list(keys.values()))
+    missing = [index for index, key in keys.items() if key not in ready]
+    for index, key in keys.items():
+        if key in ready:
+            parts[index] = segments[index].render(ready[key])
+        else:
+            parts[index] = retrieve_context_text([segments[index]], [shares[index]], user_input, shares[index])
+    logger.info(
+        f"Sending {len(keys) - len(missing)} digests, {len(missing)} retrieved pages and {len(segments) - len(keys)} "
+        f"whole pages for context_id: {segments[0].context_id}"
+    )
+    return "".join(parts), not missing
+
+
+def context_for_chat(context, user_input):
+    # A context that fits in CHAT_CONTEXT_MAX_TOKENS is sent whole. A bigger one is cut down to that
+    # budget, shared fairly between its links, by retrieval or map-reduce as CHAT_CONTEXT_MODE says.
+    # Decided from the token counts stored when the context was built.
+    segments = list(context.segments.select_related("blob"))
+    budget = settings.CHAT_CONTEXT_MAX_TOKENS
+    if sum(segment.tokens for segment in segments) <= budget:
+        return "".join(segment.render() for segment in segments)
+
+    shares = allocate_tokens([segment.tokens for segment in segments], budget)
+    if settings.CHAT_CONTEXT_MODE == "map_reduce":
+        text, ready = digest_context_text(segments, shares, user_input)
+        if not ready:
+            enqueue_digests(context)
+        return text
+    return retrieve_context_text(segments, shares, user_input, budget)
+
+
+def get_conversation(context, conversation_id=None):
+    # Raises Conversation.DoesNotExist if conversation_id doesn't belong to this context
+    if conversation_id:
+        return Conversation.objects.get(id=conversation_id, context=context)
+    return Conversation.objects.create(context=context)
+
+
+def prepare_chat(context, memory, user_input):
+    # Follow-ups like "tell me more" say little on their own, so retrieval also looks at the previous question
+    query = f"{memory.last_question()} {user_input}"
+    return context_for_chat(context, query), memory.history()
+
+
+def finish_turn(memory, user_input, ai_response):
+    memory.add_turn(user_input, ai_response)
+    if memory.needs_compaction():
+        enqueue("compact_conversation", {"conversation_id": memory.conversation.pk}, user=memory.conversation.context.user)
+
+
+def summarize_conversation(summary, messages):
+    from langchain_core.prompts import ChatPromptTemplate
+
+    transcript = "\n".join(f"{message.role}: {message.content}" for message in messages)
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", "You maintain a running summary of a conversation about a set of web pages. "
+                   "Merge the new messages into the summary, keep facts, names and open questions, "
+                   "and answer with the updated summary only, in at most {max_words} words."),
+        ("human", "Summary so far:\n{summary}\n\nNew messages:\n{text}"),
+    ])
+    try:
+        return invoke_llm(transcript, prompt=prompt, summary=summary or "(empty)", max_words=settings.CHAT_SUMMARY_MAX_TOKENS * 3 // 4)
+    except (LLMRateLimited, LLMError):
+        # Still have to bound the prompt, so keep the tail of the raw transcript instead
+        return f"{summary} {transcript}".strip()
+
+
+def chat_with_context(user, context_id, user_input, conversation_id=None):
+    # Raises Context.DoesNotExist / Conversation.DoesNotExist for unknown ids, and contexts of other users
+    context = Context.objects.get(id=context_id, user=user)
+    logger.info(f"Successfully retrieved context for context_id: {context_id}")
+    memory = ConversationMemory(get_conversation(context, conversation_id))
+
+    with stage("chat", "retrieve"):
+        context_text, history = prepare_chat(context, memory, user_input)
+    with stage("chat", "llm"):
+        ai_response = invoke_llm(context_text, history=history, user_input=user_input)
+    with stage("chat", "save"):
+        finish_turn(memory, user_input, ai_response)
+    return ai_response, memory.conversation
+
+
+def summary_cache_key(context):
+    content_hash = hashlib.sha256(context.encode()).hexdigest()
+    model = fitting_models(estimate_request_tokens(context, {}))[0]
+    return f"summary:{content_hash}:{settings.LLM_PROVIDER}:{model}:v{SUMMARY_PROMPT_VERSION}"
+
+
+def summarize_context(context):
+    # An unchanged page is answered from the summary cache, and concurrent requests
+    # for the same page wait for a single LLM call instead of making their own
+    return cached_single_flight(
+        caches["summaries"], summary_cache_key(context), lambda: invoke_llm(context),
+        timeout=settings.SUMMARY_CACHE_TTL, flight=_SUMMARY_FLIGHT,
+    )
+
+
+def summarize_page(link):
+    # Goes through the page cache, so a recently fetched page is not downloaded again
+    with stage("page_summary", "fetch"):
+        page_texts = ConcurrentLinkFetcher().fetch_all([link])
+    context = build_context_text([link], page_texts)
+    with stage("page_summary", "llm"):
+        if page_texts[0] is None:
+            return invoke_llm(context)
+        return summarize_context(context)
+
+
+def build_packed_prompt():
+    from langchain_core.prompts import ChatPromptTemplate
+
+    return ChatPromptTemplate.from_messages([
+        ("system", "Summarize each of the numbered web pages below on its own. Answer with one section per page, "
+                   "in the same order, each starting with the page's number in square brackets on a line of its "
+                   "own, like [1], followed by the summary of that page only."),
+        ("human", "{text}"),
+    ])
+
+
+def summarize_packed(contexts):
+    # Summaries of several small pages from one LLM call, each cached as the summary of its own page.
+    # If the answer can't be split back into pages they are summarized one at a time instead.
+    if len(contexts) == 1:
+        return [summarize_context(contexts[0])]
+
+    text = "\n\n".join(f"[{number}]\n{context}" for number, context in enumerate(contexts, 1))
+    parts = PACKED_SECTION_RE.split(invoke_llm(text, prompt=build_packed_prompt()))
+    sections = {int(number): section.strip() for number, section in zip(parts[1::2], parts[2::2]) if section.strip()}
+    if set(sections) != set(range(1, len(contexts) + 1)):
+        logger.info(f"Could not split the summary of {len(contexts)} packed pages, summarizing them one at a time")
+        return [summarize_context(context) for context in contexts]
+
+    summaries = [sections[number] for number in range(1, len(contexts) + 1)]
+    caches["summaries"].set_many(
+        {summary_cache_key(context): summary for context, summary in zip(contexts, summaries)},
+        timeout=settings.SUMMARY_CACHE_TTL,
+    )
+    return summaries
+
+
+def summarize_pages(links):
+    # Yields a result per link as soon as it is ready, {"index", "link"} and either "ai_response" or
+    # "error": cached summaries right after the pages are fetched, the rest as their LLM calls finish.
+    # The pages are fetched concurrently and small ones share an LLM call.
+    with stage("page_summaries", "fetch"):
+        page_texts = ConcurrentLinkFetcher().fetch_all(links)
+
+    # Summary cache key -> (page context, indexes of the links that are that page)
+    pending = {}
+    for index, (link, page_text) in enumerate(zip(links, page_texts)):
+        if page_text is None:
+            yield {"index": index, "link": link, "error": "Could not fetch the page"}
+            continue
+        context = build_context_text([link], [page_text])
+        pending.setdefault(summary_cache_key(context), (context, []))[1].append(index)
+
+    for key, summary in caches["summaries"].get_many(list(pending)).items():
+        for index in pending.pop(key)[1]:
+            yield {"index": index, "link": links[index], "ai_response": summary}
+
+    # Small pages are packed in order until the next one doesn't fit, big ones get a call each
+    calls, pack, pack_tokens = [], [], 0
+    for key, (context, _) in pending.items():
+        tokens = estimate_tokens(context)
+        if tokens > settings.PAGE_SUMMARY_PACK_TOKENS // 2:
+            calls.append([key])
+            continue
+        if pack and pack_tokens + tokens > settings.PAGE_SUMMARY_PACK_TOKENS:
+            calls.append(pack)
+            pack, pack_tokens = [], 0
+        pack.append(key)
+        pack_tokens += tokens
+    if pack:
+        calls.append(pack)
+    if not calls:
+        return
+
+    executor = ThreadPoolExecutor(max_workers=min(settings.PAGE_SUMMARY_MAX_WORKERS, len(calls)))
+    try:
+        futures = {
+            executor.submit(_in_worker_thread, summarize_packed, [pending[key][0] for key in keys]): keys for keys in calls
+        }
+        for future in as_completed(futures):
+            keys = futures[future]
+            try:
+                results = [{"ai_response": summary} for summary in future.result()]
+            except LLMRateLimited as e:
+                results = [{"error": "Token limit reached. Please try again later.", "retry_after": e.retry_after}] * len(keys)
+            except LLMError as e:
+                results = [{"error": f"AI processing failed: {e}"}] * len(keys)
+            for key, result in zip(keys, results):
+                for index in pending[key][1]:
+                    yield {"index": index, "link": links[index], **result}
+    finally:
+        # A client that goes away doesn't wait for the calls still queued
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+async def astream_chat_with_context(user, context_id, user_input, conversation_id=None):
+    # Raises Context.DoesNotExist / Conversation.DoesNotExist for unknown ids, and contexts of other users
+    context = await Context.objects.aget(id=context_id, user=user)
+    logger.info(f"Successfully retrieved context for context_id: {context_id}")
+    conversation = await sync_to_async(get_conversation)(context, conversation_id)
+    memory = ConversationMemory(conversation)
+    with stage("chat_stream", "retrieve"):
+        context_text, history = await sync_to_async(prepare_chat)(context, memory, user_input)
+
+    async def tokens():
+        parts = []
+        async for token in astream_llm(context_text, history=history, user_input=user_input):
+            parts.append(token)
+            yield token
+        # Only a completed answer becomes part of the conversation
+        await sync_to_async(finish_turn)(memory, user_input, "".join(parts))
+
+    return conversation, tokens()
@@ -0,0 +1,74 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    # At most one call per key runs at a time in this process, callers that arrive while it
+    # is running wait for it and get the same result (or the same exception)
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._calls[key] = future
+        if not leader:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+
+def cached_single_flight(cache, key, compute, timeout, flight, lock_timeout=60, poll_interval=0.1):
+    # Cache lookup with stampede protection: one caller per process through `flight`, and one
+    # process at a time through an add()-based lock in `cache` (shared if the cache backend is)
+    value = cache.get(key)
+    if value is not None:
+        return value
+
+    def fill():
+        value = cache.get(key)
+        if value is not None:
+            return value
+
+        lock_key = f"{key}:lock"
+        deadline = time.monotonic() + lock_timeout
+        locked = cache.add(lock_key, 1, timeout=lock_timeout)
+        while not locked:
+            # Another process is computing it, use its result once it lands
+            time.sleep(poll_interval)
+            value = cache.get(key)
+            if value is not None:
+                return value
+            if time.monotonic() > deadline:
+                logger.info(f"Gave up waiting for {lock_key}, computing it here")
+                break
+            locked = cache.add(lock_key, 1, timeout=lock_timeout)
+
+        try:
+            value = compute()
+            cache.set(key, value, timeout=timeout)
+            return value
+        finally:
+            if locked:
+                cache.delete(lock_key)
+
+    return flight.do(key, fill)
@@ -0,0 +1,67 @@
+import hashlib
+import logging
+import zlib
+
+from django.conf import settings
+
+from .models import TextBlob, TextChunk
+from .ratelimit import estimate_tokens
+from .retrieval import chunk_spans, index_chunk
+
+logger = logging.getLogger(__name__)
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def compress_text(text):
+    return zlib.compress(text.encode(), settings.TEXT_BLOB_COMPRESSION_LEVEL)
+
+
+def store_texts(texts):
+    # Blob for every distinct text, keyed by its hash. Texts that are already stored are reused,
+    # so a page saved into many contexts takes up space once.
+    by_hash = {text_hash(text): text for text in texts}
+    blobs = {blob.hash: blob for blob in TextBlob.objects.filter(hash__in=by_hash).defer("data")}
+    missing = [
+        TextBlob(hash=content_hash, data=compress_text(text), size=len(text.encode()))
+        for content_hash, text in by_hash.items() if content_hash not in blobs
+    ]
+    if missing:
+        # Another request may store the same page at the same time, the unique hash keeps one copy
+        TextBlob.objects.bulk_create(missing, ignore_conflicts=True)
+        blobs.update({blob.hash: blob for blob in TextBlob.objects.filter(hash__in=[blob.hash for blob in missing]).defer("data")})
+    for content_hash, blob in blobs.items():
+        # We have the text already, no need to load and decompress it again
+        blob.__dict__["text"] = by_hash[content_hash]
+    return blobs
+
+
+def index_blobs(blobs):
+    # Chunk and index blobs that have not been indexed yet, each distinct page is only done once
+    indexed = set(TextChunk.objects.filter(blob__in=blobs).values_list("blob_id", flat=True).distinct())
+    chunks = []
+    for blob in blobs:
+        if blob.pk in indexed:
+            continue
+        words = blob.text.split()
+        for position, (start, end) in enumerate(
+            chunk_spans(len(words), settings.CONTEXT_CHUNK_WORDS, settings.CONTEXT_CHUNK_OVERLAP_WORDS)
+        ):
+            chunk_text = " ".join(words[start:end])
+            term_counts, length = index_chunk(chunk_text)
+            chunks.append(TextChunk(
+                blob=blob, position=position, start=start, end=end, term_counts=term_counts, length=length,
+                tokens=estimate_tokens(chunk_text),
+            ))
+    TextChunk.objects.bulk_create(chunks, ignore_conflicts=True)
+
+
+def delete_orphan_blobs():
+    # Blobs no context or saved link points at any more, left behind when they are deleted
+    _, deleted = TextBlob.objects.filter(segments__isnull=True, user_links__isnull=True).delete()
+    deleted_count = deleted.get(TextBlob._meta.label, 0)
+    if deleted_count:
+        logger.info(f"Deleted {deleted_count} unused text blobs")
+    return deleted_count
@@ -0,0 +1,118 @@
+import logging
+
+from .jobs import TaskError, task
+from .memory import ConversationMemory
+from .models import Context, Conversation, PageContent, User, UserLinks
+from .scraping import ConcurrentLinkFetcher, url_hash
+from .search import index_links
+from .services import (
+    LLMError, LLMRateLimited, add_links_to_context, build_context, chat_with_context, make_digests,
+    summarize_conversation, summarize_page
+)
+from .storage import store_texts, text_hash
+
+logger = logging.getLogger(__name__)
+
+
+def _llm_task_error(e):
+    if isinstance(e, LLMRateLimited):
+        return TaskError("Token limit reached. Please try again later.", data={"retry_after": e.retry_after})
+    return TaskError(f"AI processing failed: {e}")
+
+
+def extract_links(user_links):
+    # Fetches (id, link) pairs concurrently, through the page cache so a link somebody else already saved
+    # is not fetched again, and keeps each page's text with its link. A failed fetch keeps what was there.
+    page_texts = ConcurrentLinkFetcher().fetch_all([link for _, link in user_links])
+    blobs = store_texts([page_text for page_text in page_texts if page_text is not None])
+    pages = {
+        page.url_hash: page
+        for page in PageContent.objects.filter(url_hash__in={url_hash(link) for _, link in user_links}).only("pk", "url_hash", "status")
+    }
+    statuses = {}
+    for (link_id, link), page_text in zip(user_links, page_texts):
+        page = pages.get(url_hash(link))
+        updates = {"page": page}
+        if page_text is not None:
+            updates["blob"] = blobs[text_hash(page_text)]
+        UserLinks.objects.filter(pk=link_id).update(**updates)
+        statuses[link_id] = page.status if page else None
+    index_links([link_id for link_id, _ in user_links])
+    return statuses
+
+
+@task("extract_link_content")
+def extract_link_content(link_id):
+    user_links = list(UserLinks.objects.filter(pk=link_id).values_list("pk", "link"))
+    if not user_links:
+        return None
+    status = extract_links(user_links)[link_id]
+    logger.info(f"Extracted content for link {link_id} ({status or 'missing'})")
+    return {"status": status}
+
+
+@task("extract_links_content")
+def extract_links_content(link_ids):
+    # Same as extract_link_content for a whole imported batch, the pages are fetched concurrently
+    user_links = list(UserLinks.objects.filter(pk__in=link_ids).values_list("pk", "link"))
+    statuses = extract_links(user_links)
+    logger.info(f"Extracted content for {len(user_links)} links")
+    return {"statuses": statuses}
+
+
+@task("create_context")
+def create_context(user_id, link_ids):
+    context = build_context(User.objects.get(pk=user_id), link_ids)
+    if context is None:
+        raise TaskError("Failed to create the context!")
+    return {"context_id": context.pk}
+
+
+@task("add_context_links")
+def add_context_links(context_id, link_ids):
+    context = Context.objects.filter(pk=context_id).first()
+    if not context:
+        raise TaskError("Context not found!")
+    return {"context_id": context.pk, "added": add_links_to_context(context, link_ids)}
+
+
+@task("digest_context")
+def digest_context(context_id):
+    # Makes the page digests of a context too big to send whole, chat turns use them once they are ready
+    context = Context.objects.filter(pk=context_id).first()
+    if not context:
+        return None
+    try:
+        digests = make_digests(context)
+    except (LLMRateLimited, LLMError) as e:
+        raise _llm_task_error(e)
+    return {"context_id": context.pk, "digests": digests}
+
+
+@task("chat")
+def chat(user_id, context_id, user_input, conversation_id=None):
+    try:
+        ai_response, conversation = chat_with_context(User.objects.get(pk=user_id), context_id, user_input, conversation_id)
+        return {"ai_response": ai_response, "conversation_id": conversation.pk}
+    except Context.DoesNotExist:
+        raise TaskError("Context not found!")
+    except Conversation.DoesNotExist:
+        raise TaskError("Conversation not found!")
+    except (LLMRateLimited, LLMError) as e:
+        raise _llm_task_error(e)
+
+
+@task("page_summary")
+def page_summary(link):
+    try:
+        return {"ai_response": summarize_page(link)}
+    except (LLMRateLimited, LLMError) as e:
+        raise _llm_task_error(e)
+
+
+@task("compact_conversation")
+def compact_conversation(conversation_id):
+    conversation = Conversation.objects.filter(pk=conversation_id).first()
+    if not conversation:
+        return None
+    return {"compacted": ConversationMemory(conversation).compact(summarize_conversation)}
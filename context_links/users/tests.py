@@ -1,3 +1,875 @@
-from django.test import TestCase
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import skipUnless
+from unittest.mock import MagicMock, patch
 
-# Create your tests here.
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache, caches
+from django.db import connection
+from django.test import AsyncClient, Client, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from . import fake_llm
+from .authentication import SESSION_USER_KEY, issue_token
+from .jobs import claim_next_job, recover_jobs
+from .llm import route_models
+from .memory import ConversationMemory
+from .models import Context, Conversation, Job, PageContent, User, UserLinks
+from .retrieval import allocate_tokens, select_within_budget
+from .providers import get_provider
+from .ratelimit import BudgetExhausted, LLMRateLimiter
+from .scraping import (
+    ConcurrentLinkFetcher, DNSCache, PageContentCache, RobotsDisallowed, fetch_page, fetch_page_coalesced, url_hash
+)
+from .search import BODY_TABLE, index_links, search_links
+from .services import (
+    LIMITER, LLMRateLimited, astream_llm, build_context, build_context_segments, chat_with_context, context_for_chat,
+    digest_pieces, estimate_request_tokens, import_user_links, invoke_llm
+)
+from .singleflight import SingleFlight, cached_single_flight
+from .storage import delete_orphan_blobs, store_texts, text_hash
+from .tasks import digest_context, extract_link_content
+
+PAGE = b"<html><head><script>var x = 1;</script></head><body><p>Hello stub</p></body></html>"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # A small origin with the misbehaviours fetch_page has to survive
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def handle(self):
+        try:
+            super().handle()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client gave up (size cap, timeout, closed keep-alive), that's what some tests are about
+            pass
+
+    def send_body(self, body, status=200, content_type="text/html; charset=utf-8", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get("User-Agent"), self.client_address))
+        if self.server.down:
+            self.send_body(b"unavailable", status=503, content_type="text/plain")
+        elif self.path == "/robots.txt":
+            self.send_body(b"User-agent: *\nDisallow: /private\n", content_type="text/plain")
+        elif self.path == "/page" or self.path == "/private":
+            self.send_body(PAGE)
+        elif self.path == "/big":
+            self.send_body(b"<html><body>" + b"<p>word word word word</p>" * 100000 + b"</body></html>")
+        elif self.path == "/slow":
+            time.sleep(0.3)
+            self.send_body(PAGE)
+        elif self.path == "/slow-headers":
+            time.sleep(2)
+            self.send_body(PAGE)
+        elif self.path == "/trickle":
+            # Every byte arrives well within the read timeout, the whole page never does
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", "100000")
+            self.end_headers()
+            try:
+                for _ in range(100):
+                    self.wfile.write(b"<p>x</p>")
+                    self.wfile.flush()
+                    time.sleep(0.1)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        elif self.path == "/loop":
+            self.send_body(b"", status=302, headers={"Location": "/loop"})
+        elif self.path == "/image":
+            self.send_body(b"\x89PNG", content_type="image/png")
+        else:
+            self.send_body(b"not found", status=404, content_type="text/plain")
+
+
+class StubServerMixin:
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        cls.server.daemon_threads = True
+        cls.server.requests = []
+        cls.server.down = False
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base = f"http://127.0.0.1:{cls.server.server_address[1]}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.server.requests.clear()
+        self.server.down = False
+
+
+@override_settings(LINK_FETCH_TIMEOUT=1, PAGE_MAX_BYTES=64 * 1024)
+class FetchPageTests(StubServerMixin, SimpleTestCase):
+
+    def test_fetches_text_with_user_agent(self):
+        fetched = fetch_page(f"{self.base}/page")
+        self.assertEqual(fetched.text, "Hello stub")
+        user_agents = {user_agent for _, user_agent, _ in self.server.requests}
+        self.assertEqual(user_agents, {"ContextLinks/1.0"})
+
+    def test_dns_cache_is_only_used_by_fetches(self):
+        with patch("socket.getaddrinfo", wraps=socket.getaddrinfo) as getaddrinfo:
+            dns_cache = DNSCache(max_entries=2)
+            for host in ["localhost", "localhost", "127.0.0.2", "127.0.0.3", "localhost"]:
+                dns_cache.resolve(host, 80)
+        # localhost was answered from the cache once, then made room for the others
+        self.assertEqual(getaddrinfo.call_count, 4)
+
+        get_provider("http_session").close()  # every connection is made again
+        self.assertEqual(fetch_page(f"{self.base.replace('127.0.0.1', 'localhost')}/page").text, "Hello stub")
+        self.assertEqual(socket.getaddrinfo.__module__, "socket")
+
+    def test_reuses_connections_and_robots(self):
+        for _ in range(3):
+            fetch_page(f"{self.base}/page")
+        paths = [path for path, _, _ in self.server.requests]
+        self.assertEqual(paths.count("/robots.txt"), 1)
+        self.assertEqual(len({address for _, _, address in self.server.requests}), 1)
+
+    def test_robots_disallowed(self):
+        with self.assertRaises(RobotsDisallowed):
+            fetch_page(f"{self.base}/private")
+        self.assertNotIn("/private", [path for path, _, _ in self.server.requests])
+
+    def test_body_is_capped(self):
+        fetched = fetch_page(f"{self.base}/big")
+        self.assertLess(len(fetched.text), 64 * 1024)
+        self.assertTrue(fetched.text.startswith("word word"))
+
+    def test_read_timeout(self):
+        started = time.monotonic()
+        with self.assertRaises(requests.exceptions.ReadTimeout):
+            fetch_page(f"{self.base}/slow-headers")
+        self.assertLess(time.monotonic() - started, 1.9)
+
+    def test_slow_body_hits_deadline(self):
+        started = time.monotonic()
+        with self.assertRaises(TimeoutError):
+            fetch_page(f"{self.base}/trickle")
+        self.assertLess(time.monotonic() - started, 2)
+
+    def test_redirect_loop(self):
+        with self.assertRaises(requests.exceptions.TooManyRedirects):
+            fetch_page(f"{self.base}/loop")
+
+
+@override_settings(LINK_FETCH_TIMEOUT=1)
+class CoalescedFetchTests(StubServerMixin, SimpleTestCase):
+
+    def fetch_concurrently(self, links):
+        with ThreadPoolExecutor(len(links)) as executor:
+            return [fetched.text for fetched in executor.map(fetch_page_coalesced, links)]
+
+    def page_requests(self):
+        return [path for path, _, _ in self.server.requests if path != "/robots.txt"]
+
+    def test_concurrent_fetches_share_one_download(self):
+        # Spelled differently, still the same page
+        links = [f"{self.base}/slow", f"{self.base.upper()}/slow#top"] * 4
+        self.assertEqual(self.fetch_concurrently(links), ["Hello stub"] * 8)
+        self.assertEqual(self.page_requests(), ["/slow"])
+
+    def test_later_fetches_download_again(self):
+        fetch_page_coalesced(f"{self.base}/slow")
+        fetch_page_coalesced(f"{self.base}/slow")
+        self.assertEqual(self.page_requests(), ["/slow", "/slow"])
+
+    @override_settings(LINK_FETCH_SHARED_FLIGHT=True)
+    def test_shared_flight_reuses_result_from_cache(self):
+        # What another process waiting on the cache lock would pick up
+        fetch_page_coalesced(f"{self.base}/slow")
+        self.assertEqual(fetch_page_coalesced(f"{self.base}/slow").text, "Hello stub")
+        self.assertEqual(self.page_requests(), ["/slow"])
+
+
+@override_settings(LINK_FETCH_TIMEOUT=1, CONTEXT_FETCH_DEADLINE=5)
+class ConcurrentLinkFetcherTests(StubServerMixin, TestCase):
+
+    def test_failures_do_not_block_the_batch(self):
+        links = [f"{self.base}/page", f"{self.base}/slow-headers", f"{self.base}/private", f"{self.base}/image"]
+        started = time.monotonic()
+        page_texts = ConcurrentLinkFetcher().fetch_all(links)
+        self.assertLess(time.monotonic() - started, 3)
+        self.assertEqual(page_texts, ["Hello stub", None, None, None])
+        self.assertEqual(PageContent.objects.filter(status=PageContent.FETCH_FAILED).count(), 3)
+
+
+@override_settings(LINK_FETCH_OBEY_ROBOTS=False)
+class PageCacheTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def page(self, url, accessed_ago, size=60, **fields):
+        fetched_on = timezone.now() - timedelta(seconds=accessed_ago)
+        return PageContent.objects.create(
+            url_hash=url_hash(url), url=url, text="Old text", size=size, status=PageContent.FETCH_OK,
+            fetched_on=fetched_on, last_accessed=fetched_on, **fields,
+        )
+
+    def test_stale_page_is_revalidated(self):
+        url = "https://example.com/stale"
+        page = self.page(url, settings.PAGE_CACHE_TTL + 60, etag='"v1"', last_modified="Mon, 12 Oct 2026 08:00:00 GMT")
+        session = MagicMock()
+        session.get.return_value.__enter__.return_value.status_code = 304
+        with patch("users.scraping.get_provider", return_value=session):
+            self.assertEqual(ConcurrentLinkFetcher().fetch_all([url]), ["Old text"])
+
+        headers = session.get.call_args.kwargs["headers"]
+        self.assertEqual(headers, {"If-None-Match": '"v1"', "If-Modified-Since": "Mon, 12 Oct 2026 08:00:00 GMT"})
+        # Fresh again, without being downloaded
+        self.assertTrue(PageContentCache().is_fresh(PageContent.objects.get(pk=page.pk)))
+
+    def test_least_recently_used_pages_go_first(self):
+        for index, age in enumerate([30, 10, 20]):
+            self.page(f"https://example.com/{index}", age)
+        page_cache = PageContentCache(max_bytes=100)
+        self.assertEqual(page_cache.evict_if_due(), 2)
+        self.assertEqual(list(PageContent.objects.values_list("url", flat=True)), ["https://example.com/1"])
+
+        # The table is only summed once per PAGE_CACHE_EVICT_INTERVAL
+        self.page("https://example.com/3", 0)
+        self.assertEqual(page_cache.evict_if_due(), 0)
+        self.assertEqual(page_cache.evict(), 1)
+
+
+@override_settings(LINK_FETCH_TIMEOUT=1)
+class ExtractedTextTests(StubServerMixin, TestCase):
+
+    def test_text_outlives_the_page_cache(self):
+        user = User.objects.create_user("saver@example.com", "Ada", "Saver")
+        link = UserLinks.objects.create(user=user, name="Stub", link=f"{self.base}/page")
+        extract_link_content(link.pk)
+        self.assertEqual(UserLinks.objects.get(pk=link.pk).blob.text, "Hello stub")
+
+        # Evicted from the page cache while the site is down, the context gets the saved text without fetching it
+        PageContent.objects.all().delete()
+        self.server.down = True
+        self.server.requests.clear()
+        context = build_context(user, [link.pk])
+        self.assertEqual(context.text, f"Link: {self.base}/page, Parsed content: Hello stub, ")
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(self.names_found(user, "hello"), ["Stub"])
+
+    def names_found(self, user, query):
+        index_links(list(UserLinks.objects.filter(user=user).values_list("pk", flat=True)))
+        return [result["name"] for result in search_links(user, query, limit=10)]
+
+
+@override_settings(LINK_FETCH_TIMEOUT=1)
+class ContextLinksTests(StubServerMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("editor@example.com", "Ada", "Editor")
+        self.links = [
+            UserLinks.objects.create(user=self.user, name=path, link=f"{self.base}{path}") for path in ["/page", "/slow", "/private"]
+        ]
+        self.context = build_context(self.user, [self.links[0].pk])
+
+    def post(self, action, link_ids):
+        return self.client.post(
+            f"/api/context/{self.context.pk}/{action}/", {"link_ids": link_ids}, content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {issue_token(self.user)}",
+        )
+
+    def urls(self):
+        return list(self.context.segments.values_list("url", flat=True))
+
+    def test_adds_only_new_links_and_removes_them_again(self):
+        self.server.requests.clear()
+        self.assertEqual(self.post("add_links", [link.pk for link in self.links]).json()["added"], [self.links[1].pk, self.links[2].pk])
+        self.assertEqual(self.urls(), [link.link for link in self.links])
+        self.assertNotIn("/page", [path for path, _, _ in self.server.requests])
+
+        self.assertEqual(self.post("remove_links", [self.links[1].pk]).json()["removed"], [self.links[1].pk])
+        self.assertEqual(self.urls(), [self.links[0].link, self.links[2].link])
+        self.assertEqual(set(self.context.links.values_list("pk", flat=True)), {self.links[0].pk, self.links[2].pk})
+
+    def test_deleting_a_saved_link_takes_it_out_of_its_contexts(self):
+        self.post("add_links", [self.links[1].pk])
+        self.links[0].delete()
+        self.assertEqual(self.urls(), [self.links[1].link])
+
+    def test_contexts_stored_in_one_piece_keep_their_links(self):
+        self.context.segments.update(verbatim=True)
+        self.assertEqual(self.post("remove_links", [self.links[0].pk]).status_code, 409)
+        self.assertEqual(self.urls(), [self.links[0].link])
+
+
+class JobsViewTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("poller@example.com", "Ada", "Poller")
+        self.job = Job.objects.create(task="chat", payload={}, user=self.user, result={"ai_response": "secret"})
+
+    def get(self, user=None):
+        headers = {"HTTP_AUTHORIZATION": f"Bearer {issue_token(user)}"} if user else {}
+        return self.client.get(f"/api/jobs/{self.job.pk}/", **headers)
+
+    def test_only_the_owner_sees_a_job(self):
+        self.assertEqual(self.get(self.user).json()["result"], {"ai_response": "secret"})
+        self.assertEqual(self.get(User.objects.create_user("other@example.com", "Bob", "Other")).status_code, 404)
+        self.assertEqual(self.get().status_code, 401)
+
+
+class JobRecoveryTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def job(self, status, age):
+        job = Job.objects.create(task="page_summary", payload={"link": "https://example.com"}, status=status)
+        started = timezone.now() - timedelta(seconds=age)
+        Job.objects.filter(pk=job.pk).update(created_on=started, started_on=started if status == Job.RUNNING else None)
+        return job
+
+    @override_settings(JOBS_BACKEND="db", JOBS_STALE_AFTER=600)
+    def test_jobs_left_running_by_a_dead_worker_run_again(self):
+        stale, running = self.job(Job.RUNNING, 601), self.job(Job.RUNNING, 60)
+        self.assertEqual(claim_next_job().pk, stale.pk)
+        self.assertEqual(Job.objects.get(pk=running.pk).status, Job.RUNNING)
+
+    @override_settings(JOBS_BACKEND="thread", JOBS_RECOVER_INTERVAL=60)
+    def test_jobs_queued_by_an_exited_process_are_picked_up(self):
+        waiting, queued = self.job(Job.QUEUED, 61), self.job(Job.QUEUED, 1)
+        with patch("users.jobs._EXECUTOR.submit") as submit:
+            recover_jobs()
+        self.assertEqual([call.args[1] for call in submit.call_args_list], [waiting.pk])
+
+
+@override_settings(LLM_PROVIDER="fake")
+class APIAuthenticationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user("owner@example.com", "Ada", "Owner")
+        self.other = User.objects.create_user("other@example.com", "Bob", "Other")
+        self.link = UserLinks.objects.create(user=self.owner, name="Owned", link="https://example.com/owned")
+        self.context = Context.objects.create(user=self.owner)
+
+    def bearer(self, user):
+        return {"HTTP_AUTHORIZATION": f"Bearer {issue_token(user)}"}
+
+    def session_client(self, user):
+        client = Client(enforce_csrf_checks=True)
+        session = SessionStore()
+        session[SESSION_USER_KEY] = user.pk
+        session.save()
+        client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        return client
+
+    def chat(self, client, **headers):
+        return client.post(
+            "/api/context/chat/", {"context_id": self.context.pk, "user_input": "What is it about?"},
+            content_type="application/json", **headers,
+        )
+
+    def test_anonymous_requests_are_refused(self):
+        self.assertEqual(self.client.get("/api/links/").status_code, 401)
+        self.assertEqual(self.client.get(f"/api/context/{self.context.pk}/").status_code, 401)
+        self.assertEqual(self.chat(self.client).status_code, 401)
+        # Users are never listed, for anyone
+        self.assertEqual(self.client.get("/api/users/", **self.bearer(self.owner)).status_code, 404)
+
+    def test_bearer_token(self):
+        response = self.client.get("/api/links/user_links/", **self.bearer(self.owner))
+        self.assertEqual([link["name"] for link in response.json()], ["Owned"])
+        self.assertEqual(self.client.get("/api/links/", HTTP_AUTHORIZATION="Bearer forged").status_code, 401)
+        # No CSRF token needed, the browser doesn't send the header on its own
+        self.assertEqual(self.chat(Client(enforce_csrf_checks=True), **self.bearer(self.owner)).status_code, 200)
+
+    def test_bad_cursor_is_not_found(self):
+        response = self.client.get("/api/links/user_links/?cursor=garbage", **self.bearer(self.owner))
+        self.assertEqual(response.status_code, 404)
+
+    def test_unchanged_links_are_not_sent_again(self):
+        etag = self.client.get("/api/links/user_links/", **self.bearer(self.owner))["ETag"]
+        response = self.client.get("/api/links/user_links/", HTTP_IF_NONE_MATCH=etag, **self.bearer(self.owner))
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        UserLinks.objects.create(user=self.owner, name="New", link="https://example.com/new")
+        response = self.client.get("/api/links/user_links/", HTTP_IF_NONE_MATCH=etag, **self.bearer(self.owner))
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_session_needs_csrf_token_for_unsafe_methods(self):
+        client = self.session_client(self.owner)
+        self.assertEqual(client.get("/api/links/user_links/").status_code, 200)
+        self.assertEqual(self.chat(client).status_code, 403)
+
+        # The header has to match the csrftoken cookie
+        token = "csrf" * 8
+        client.cookies[settings.CSRF_COOKIE_NAME] = token
+        self.assertEqual(self.chat(client, HTTP_X_CSRFTOKEN=token).status_code, 200)
+
+    def test_only_the_owner_sees_links_and_contexts(self):
+        headers = self.bearer(self.other)
+        self.assertEqual(self.client.get("/api/links/", **headers).json(), [])
+        self.assertEqual(self.client.get(f"/api/links/{self.link.pk}/", **headers).status_code, 404)
+        self.assertEqual(self.client.get(f"/api/context/{self.context.pk}/", **headers).status_code, 404)
+        self.assertEqual(self.chat(self.client, **headers).status_code, 404)
+        self.assertEqual(self.client.get(f"/api/context/{self.context.pk}/", **self.bearer(self.owner)).status_code, 200)
+
+    def test_links_are_created_for_the_caller(self):
+        self.client.post(
+            "/api/links/", {"user": self.owner.pk, "name": "Planted", "link": "https://example.com/planted"},
+            content_type="application/json", **self.bearer(self.other),
+        )
+        self.assertEqual(UserLinks.objects.get(name="Planted").user, self.other)
+
+
+@override_settings(LLM_PROVIDER="fake")
+class ChatStreamTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.owner = User.objects.create_user("owner@example.com", "Ada", "Owner")
+        self.context = Context.objects.create(user=self.owner)
+
+    async def stream(self, user=None, client=None):
+        headers = {"Authorization": f"Bearer {issue_token(user)}"} if user else {}
+        return await (client or self.async_client).post(
+            "/api/context/chat_stream/", {"context_id": self.context.pk, "user_input": "What is it about?"},
+            content_type="application/json", headers=headers,
+        )
+
+    async def test_streams_to_the_owner(self):
+        response = await self.stream(self.owner)
+        self.assertEqual(response.status_code, 200)
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertIn("event: done", body)
+
+    async def test_other_users_and_anonymous_clients_are_refused(self):
+        other = await User.objects.acreate(email="other@example.com", first_name="Bob", last_name="Other")
+        self.assertEqual((await self.stream(other)).status_code, 404)
+        self.assertEqual((await self.stream()).status_code, 401)
+
+    async def test_session_requests_need_a_csrf_token(self):
+        client = AsyncClient(enforce_csrf_checks=True)
+        session = SessionStore()
+        session[SESSION_USER_KEY] = self.owner.pk
+        await session.asave()
+        client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        self.assertEqual((await self.stream(client=client)).status_code, 403)
+
+
+class ConversationMemoryTests(TestCase):
+
+    def setUp(self):
+        user = User.objects.create_user("talker@example.com", "Ada", "Talker")
+        self.conversation = Conversation.objects.create(context=Context.objects.create(user=user))
+        self.memory = ConversationMemory(self.conversation, max_tokens=100)
+        for turn in range(6):
+            # 25 tokens a message
+            self.memory.add_turn(f"question {turn} ".ljust(96, "q"), f"answer {turn} ".ljust(96, "a"))
+
+    def summarize(self, summary, messages):
+        return f"{summary} {' '.join(message.content.split()[1] for message in messages)}".strip()
+
+    def test_history_is_the_newest_turns_that_fit(self):
+        history = [message.content.split()[:2] for message in self.memory.history()]
+        self.assertEqual(history, [["question", "4"], ["answer", "4"], ["question", "5"], ["answer", "5"]])
+        self.assertTrue(self.memory.needs_compaction())
+        self.assertTrue(self.memory.last_question().startswith("question 5"))
+
+    def test_compaction_folds_older_turns_into_the_summary(self):
+        self.assertTrue(self.memory.compact(self.summarize))
+        self.assertEqual(self.conversation.summary, "0 0 1 1 2 2 3 3 4 4")
+        self.assertFalse(self.memory.needs_compaction())
+        history = self.memory.history()
+        self.assertEqual(history[0].content, "Summary of the conversation so far: 0 0 1 1 2 2 3 3 4 4")
+        self.assertEqual(len(history), 3)
+
+    def test_back_to_back_compactions_fold_each_message_once(self):
+        # Both jobs loaded the conversation before either saved
+        other = ConversationMemory(Conversation.objects.get(pk=self.conversation.pk), max_tokens=100)
+        self.assertTrue(self.memory.compact(self.summarize))
+        self.assertFalse(other.compact(self.summarize))
+        self.assertEqual(Conversation.objects.get(pk=self.conversation.pk).summary, "0 0 1 1 2 2 3 3 4 4")
+        self.assertEqual(other.conversation.summary, "0 0 1 1 2 2 3 3 4 4")
+
+
+class LinkImportTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user("importer@example.com", "Ada", "Importer")
+
+    def test_links_already_saved_are_duplicates_however_they_are_spelled(self):
+        _, created_ids = import_user_links(self.user, [{"link": "https://Example.com/a#intro"}])
+        results, _ = import_user_links(self.user, [{"link": "https://example.com/a"}, {"link": "https://example.com/b"}])
+        self.assertEqual([result["status"] for result in results], ["duplicate", "created"])
+        self.assertEqual(results[0]["id"], created_ids[0])
+
+    def save(self, link):
+        return self.client.post(
+            "/api/links/save_user_link/", {"name": "A", "link": link}, content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {issue_token(self.user)}",
+        )
+
+    def bulk_import(self, data, **extra):
+        return self.client.post(
+            "/api/links/bulk_import/", data, content_type="application/json",
+            HTTP_AUTHORIZATION=f"Bearer {issue_token(self.user)}", **extra,
+        )
+
+    def test_extract_flag(self):
+        for index, extract in enumerate(["False", "no", 0, False]):
+            response = self.bulk_import({"links": [{"link": f"https://example.com/{index}"}], "extract": extract})
+            self.assertEqual(response.status_code, 201)
+            self.assertNotIn("job_id", response.json())
+        response = self.bulk_import({"links": [{"link": "https://example.com/yes"}], "extract": "yes"})
+        self.assertIn("job_id", response.json())
+
+        response = self.bulk_import({"links": [{"link": "https://example.com/maybe"}], "extract": "maybe"})
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.bulk_import([{"link": "https://example.com/list"}]).status_code, 400)
+        self.assertFalse(UserLinks.objects.filter(link__in=["https://example.com/maybe", "https://example.com/list"]).exists())
+
+    @override_settings(EXTRACT_ON_SAVE=False)
+    def test_saving_the_same_page_again_conflicts(self):
+        self.assertEqual(self.save("https://example.com/a").status_code, 201)
+        self.assertEqual(self.save("https://EXAMPLE.com:443/a#top").status_code, 409)
+        self.assertEqual(UserLinks.objects.filter(user=self.user).count(), 1)
+
+
+@override_settings(
+    LLM_PROVIDER="fake", LLM_MAX_QUEUE_WAIT=1,
+    LLM_MODELS=[{"name": "small", "context_tokens": 1000}, {"name": "large", "context_tokens": 100000}],
+)
+class LLMRoutingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()  # model cooldowns
+
+    def tearDown(self):
+        fake_llm.RATE_LIMITED_MODELS.clear()
+        fake_llm.RATE_LIMITED_MID_STREAM_MODELS.clear()
+
+    async def stream(self, text):
+        return "".join([token async for token in astream_llm(text)])
+
+    def test_prompts_go_to_the_smallest_model_that_fits(self):
+        self.assertTrue(invoke_llm("a short page").startswith("[small]"))
+        self.assertTrue(invoke_llm("word " * 1000).startswith("[large]"))
+
+    def test_rate_limited_model_falls_back_and_cools_down(self):
+        fake_llm.RATE_LIMITED_MODELS.add("small")
+        with self.assertLogs("users.services", "INFO") as logs:
+            self.assertTrue(invoke_llm("a short page").startswith("[large]"))
+        self.assertIn("small is rate limited, trying the next model", logs.output[0])
+        self.assertEqual([record.levelname for record in logs.records], ["INFO", "INFO"])
+        self.assertEqual(route_models(100), ["large", "small"])
+
+    def test_every_model_rate_limited_is_a_429(self):
+        fake_llm.RATE_LIMITED_MODELS.update({"small", "large"})
+        user = User.objects.create_user("limited@example.com", "Ada", "Limited")
+        context = Context.objects.create(user=user)
+        response = self.client.post(
+            "/api/context/chat/", {"context_id": context.pk, "user_input": "What is it about?"},
+            content_type="application/json", HTTP_AUTHORIZATION=f"Bearer {issue_token(user)}",
+        )
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "2")
+
+    async def test_streams_fall_back_only_before_the_first_token(self):
+        fake_llm.RATE_LIMITED_MODELS.add("small")
+        self.assertTrue((await self.stream("a short page")).startswith("[large]"))
+
+        # Half an answer from one model can't be finished by another
+        await sync_to_async(cache.clear)()
+        fake_llm.RATE_LIMITED_MODELS.clear()
+        fake_llm.RATE_LIMITED_MID_STREAM_MODELS.add("small")
+        with self.assertRaises(LLMRateLimited):
+            await self.stream("a short page")
+
+    async def test_rate_limited_streams_pause_everybody(self):
+        fake_llm.RATE_LIMITED_MODELS.update({"small", "large"})
+        with self.assertRaises(LLMRateLimited):
+            await self.stream("a short page")
+        wait, _ = await sync_to_async(LIMITER.try_acquire)(10)
+        self.assertGreater(wait, 2)
+
+    def test_usage_is_for_admins(self):
+        user = User.objects.create_user("user@example.com", "Ada", "User")
+        admin = User.objects.create_superuser("admin@example.com", "Bob", "Admin")
+        for caller, status_code in [(user, 403), (admin, 200)]:
+            response = self.client.get("/api/context/llm_usage/", HTTP_AUTHORIZATION=f"Bearer {issue_token(caller)}")
+            self.assertEqual(response.status_code, status_code)
+
+
+class LLMRateLimiterTests(TestCase):
+
+    def setUp(self):
+        self.limiter = LLMRateLimiter(tokens_per_minute=1000, requests_per_minute=5)
+        self.minute = int(time.time() // 60) * 60
+
+    def at(self, seconds):
+        # Seconds into the current minute
+        return patch("users.ratelimit.time.time", return_value=self.minute + seconds)
+
+    def test_previous_minute_counts_while_it_overlaps_the_window(self):
+        with self.at(50):
+            self.assertEqual(self.limiter.try_acquire(600)[0], 0)
+            self.assertEqual(self.limiter.try_acquire(600)[0], 10)
+        # 80% of the previous minute's 600 tokens are still in the window, then 40%
+        with self.at(72):
+            self.assertGreater(self.limiter.try_acquire(600)[0], 0)
+        with self.at(96):
+            self.assertEqual(self.limiter.try_acquire(600)[0], 0)
+
+    def test_requests_per_minute(self):
+        with self.at(10):
+            for _ in range(5):
+                self.assertEqual(self.limiter.try_acquire(1)[0], 0)
+            self.assertEqual(self.limiter.try_acquire(1)[0], 50)
+
+    def test_sheds_callers_that_would_wait_too_long(self):
+        with self.at(10):
+            self.limiter.acquire(1000, max_wait=0)
+            with self.assertRaises(BudgetExhausted):
+                self.limiter.acquire(100, max_wait=5)
+            self.assertEqual(self.limiter.usage()["last_60_minutes"]["shed"], 1)
+
+    def test_adjust_books_the_real_token_count(self):
+        with self.at(10):
+            window = self.limiter.acquire(900, max_wait=0)
+            self.assertGreater(self.limiter.try_acquire(300)[0], 0)
+            self.limiter.adjust(window, -600)
+            self.assertEqual(self.limiter.usage()["current_minute"]["tokens"], 300)
+            self.assertEqual(self.limiter.try_acquire(300)[0], 0)
+
+    def test_cool_down_stops_every_caller(self):
+        self.limiter.cool_down(30)
+        wait, window = self.limiter.try_acquire(1)
+        self.assertIsNone(window)
+        self.assertAlmostEqual(wait, 30, delta=1)
+        self.assertEqual(self.limiter.usage()["last_60_minutes"]["rate_limited"], 1)
+
+
+@override_settings(LLM_PROVIDER="fake", CHAT_CONTEXT_MODE="map_reduce", JOBS_BACKEND="db")
+class MapReduceTests(TransactionTestCase):
+    # With the default token budget. Digest jobs wait for a worker, so the tests decide when they run
+
+    def setUp(self):
+        cache.clear()
+        caches["summaries"].clear()
+        self.user = User.objects.create_user("digester@example.com", "Ada", "Digester")
+
+    def context(self, words):
+        link = UserLinks.objects.create(user=self.user, name="Long read", link="https://example.com/long")
+        context = Context.objects.create(user=self.user)
+        build_context_segments(context, [(link.pk, link.link)], [" ".join(f"fact{i % 700}" for i in range(words))])
+        return context
+
+    def test_chat_does_not_wait_for_the_digests(self):
+        context = self.context(4000)
+        pieces = digest_pieces(context.segments.get().blob)
+        self.assertGreater(len(pieces), 1)
+        for piece in pieces:
+            self.assertLessEqual(estimate_request_tokens(piece, {}), settings.LLM_TOKENS_PER_MINUTE)
+
+        # The page's best chunks stand in until the background job has summarized it
+        ai_response, _ = chat_with_context(self.user, context.pk, "What is fact12?")
+        self.assertTrue(ai_response.startswith("[llama-3.1-8b-instant]"))
+        context_for_chat(context, "And fact13?")
+        self.assertEqual(Job.objects.filter(task="digest_context", payload__context_id=context.pk).count(), 1)
+
+    def test_chat_sends_the_digests_once_they_are_made(self):
+        context = self.context(1800)
+        self.assertEqual(digest_context(context.pk), {"context_id": context.pk, "digests": 1})
+        self.assertIn("Parsed content: [llama-3.1-8b-instant]", context_for_chat(context, "What is fact12?"))
+        self.assertTrue(chat_with_context(self.user, context.pk, "What is fact12?")[0])
+        self.assertFalse(Job.objects.filter(task="digest_context").exists())
+
+
+@override_settings(PAGE_SUMMARY_LINKS_PER_MINUTE=3)
+class PageSummariesTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user("summaries@example.com", "Ada", "Summaries")
+
+    def summarize(self, links, user=None):
+        headers = {"HTTP_AUTHORIZATION": f"Bearer {issue_token(user)}"} if user else {}
+        return self.client.post("/api/context/page_summaries/", {"links": links}, content_type="application/json", **headers)
+
+    def test_needs_authentication(self):
+        self.assertEqual(self.summarize(["https://example.com/a"]).status_code, 401)
+
+    def test_every_link_counts_against_the_users_budget(self):
+        self.assertEqual(self.summarize(["https://example.com/a", "https://example.com/b"], self.user).status_code, 200)
+        response = self.summarize(["https://example.com/c", "https://example.com/d"], self.user)
+        self.assertEqual(response.status_code, 429)
+        self.assertIn("Retry-After", response)
+        # Somebody else's budget is their own
+        other = User.objects.create_user("other@example.com", "Bob", "Other")
+        self.assertEqual(self.summarize(["https://example.com/c"], other).status_code, 200)
+
+
+class SummaryCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.cache = caches["summaries"]
+        self.cache.clear()
+        self.calls = []
+
+    def summarize(self, delay=0, error=None):
+        def compute():
+            self.calls.append(1)
+            time.sleep(delay)
+            if error:
+                raise error
+            return "summary"
+        return compute
+
+    def cached(self, compute):
+        return cached_single_flight(self.cache, "summary:page", compute, timeout=60, flight=SingleFlight())
+
+    def test_cached_summaries_are_not_made_again(self):
+        self.assertEqual(self.cached(self.summarize()), "summary")
+        self.assertEqual(self.cached(self.summarize()), "summary")
+        self.assertEqual(len(self.calls), 1)
+
+    def test_concurrent_callers_share_one_call(self):
+        flight = SingleFlight()
+        with ThreadPoolExecutor(8) as executor:
+            futures = [
+                executor.submit(cached_single_flight, self.cache, "summary:page", self.summarize(delay=0.2), 60, flight)
+                for _ in range(8)
+            ]
+        self.assertEqual([future.result() for future in futures], ["summary"] * 8)
+        self.assertEqual(len(self.calls), 1)
+
+    def test_a_failed_call_releases_the_lock(self):
+        with self.assertRaises(LLMRateLimited):
+            self.cached(self.summarize(error=LLMRateLimited(5)))
+        self.assertIsNone(self.cache.get("summary:page:lock"))
+        # The next caller makes the call itself instead of waiting out the lock
+        started = time.monotonic()
+        self.assertEqual(self.cached(self.summarize()), "summary")
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual(len(self.calls), 2)
+
+
+class TokenBudgetTests(SimpleTestCase):
+
+    def test_small_links_keep_everything_and_big_ones_share_the_rest(self):
+        self.assertEqual(allocate_tokens([10, 500, 3000, 40], 1000), [10, 475, 475, 40])
+        self.assertEqual(allocate_tokens([100, 100], 1000), [100, 100])
+        self.assertEqual(allocate_tokens([], 1000), [])
+
+    def test_each_link_gets_its_share_before_the_best_chunks_fill_the_rest(self):
+        # Link 0 has the best chunks but only a share of 100, link 1 still gets its best one in
+        scores, costs, groups = [9, 8, 7, 1, 0], [100] * 5, [0, 0, 0, 1, 1]
+        self.assertEqual(select_within_budget(scores, costs, groups, [100, 100], 200), [0, 3])
+        self.assertEqual(select_within_budget(scores, costs, groups, [100, 100], 300), [0, 1, 3])
+        self.assertEqual(select_within_budget(scores, costs, groups, [100, 100], 50), [])
+
+
+class LinkSearchTests(TestCase):
+    # Run against whichever search backend the database has, DB_ENGINE=postgresql for the tsvector one
+
+    def setUp(self):
+        self.user = User.objects.create_user("reader@example.com", "Ada", "Reader")
+        self.other = User.objects.create_user("other@example.com", "Bob", "Other")
+
+    def extracted(self, url, text):
+        # What extracting a link leaves: the cached page and the text kept with the link
+        now = timezone.now()
+        page = PageContent.objects.create(
+            url_hash=url_hash(url), url=url, text=text, status=PageContent.FETCH_OK, fetched_on=now, last_accessed=now
+        )
+        return {"page": page, "blob": store_texts([text])[text_hash(text)]}
+
+    def names(self, user, query):
+        return [result["name"] for result in search_links(user, query, limit=10)]
+
+    def test_finds_saved_links_by_name_and_page_text(self):
+        UserLinks.objects.create(
+            user=self.user, name="Quantum computing primer", link="https://example.com/qc",
+            **self.extracted("https://example.com/qc", "An introduction to qubits and entanglement"),
+        )
+        UserLinks.objects.create(user=self.user, name="Gardening", link="https://example.com/garden")
+        self.assertEqual(self.names(self.user, "quantum"), ["Quantum computing primer"])
+        self.assertEqual(self.names(self.user, "entangle"), ["Quantum computing primer"])
+        self.assertEqual(self.names(self.user, '") OR * NEAR('), [])
+        # Every word has to match, in the name, the URL or the page text
+        self.assertEqual(self.names(self.user, "quantum entangle"), ["Quantum computing primer"])
+        self.assertEqual(self.names(self.user, "gardening entangle"), [])
+
+    def test_snippets_come_from_the_saved_text(self):
+        text = "Ballots were counted overnight. " * 5 + "The elections were close, officials said on Monday. " * 3
+        UserLinks.objects.create(user=self.user, name="Results", link="https://example.com/r", **self.extracted("https://example.com/r", text))
+        PageContent.objects.all().delete()
+        snippet = search_links(self.user, "election", limit=10)[0]["snippet"]
+        self.assertTrue(snippet.startswith("…were counted overnight. The [elections] were close"), snippet)
+
+    @skipUnless(connection.vendor == "sqlite", "Page text is indexed per link on Postgres")
+    def test_page_text_is_indexed_once(self):
+        extracted = self.extracted("https://example.com/shared", "A page about tidal energy")
+        for user in [self.user, self.other]:
+            UserLinks.objects.create(user=user, name="Shared", link="https://example.com/shared", **extracted)
+        self.assertEqual(self.names(self.other, "tidal"), ["Shared"])
+        with connection.cursor() as cursor:
+            cursor.execute(f"SELECT count(*) FROM {BODY_TABLE}")
+            self.assertEqual(cursor.fetchone(), (1,))
+
+            # Forgotten with the blob, without corrupting the index
+            UserLinks.objects.all().delete()
+            delete_orphan_blobs()
+            cursor.execute(f"SELECT count(*) FROM {BODY_TABLE}")
+            self.assertEqual(cursor.fetchone(), (0,))
+            cursor.execute(f"INSERT INTO {BODY_TABLE} ({BODY_TABLE}) VALUES ('integrity-check')")
+
+    def test_only_searches_the_users_own_links(self):
+        UserLinks.objects.create(user=self.other, name="Quantum for others", link="https://example.com/other")
+        self.assertEqual(self.names(self.user, "quantum"), [])
+
+    def test_name_matches_rank_above_text_matches(self):
+        UserLinks.objects.create(
+            user=self.user, name="Weekly notes", link="https://example.com/b",
+            **self.extracted("https://example.com/b", "a page that mentions elections once"),
+        )
+        UserLinks.objects.create(user=self.user, name="Elections explained", link="https://example.com/c")
+        self.assertEqual(self.names(self.user, "elections"), ["Elections explained", "Weekly notes"])
+
+    def test_index_follows_imports_edits_and_deletes(self):
+        _, created_ids = import_user_links(self.user, [{"link": "https://example.com/senate", "name": "Senate race"}])
+        self.assertEqual(self.names(self.user, "senate"), ["Senate race"])
+
+        link = UserLinks.objects.get(pk=created_ids[0])
+        link.name = "Governor race"
+        link.save()
+        self.assertEqual(self.names(self.user, "governor"), ["Governor race"])
+
+        UserLinks.objects.filter(pk=link.pk).delete()
+        self.assertEqual(self.names(self.user, "governor"), [])
@@ -0,0 +1,26 @@
+from django.conf import settings
+from rest_framework import throttling
+
+
+class SummaryLinksThrottle(throttling.UserRateThrottle):
+    # Each user gets PAGE_SUMMARY_LINKS_PER_MINUTE links summarized, however they are split into
+    # requests, so a batch of 50 costs what 50 page_summary calls do
+
+    scope = "page_summary_links"
+
+    def get_rate(self):
+        return f"{settings.PAGE_SUMMARY_LINKS_PER_MINUTE}/min"
+
+    def allow_request(self, request, view):
+        links = request.data.get("links")
+        cost = len(links) if isinstance(links, list) else 1
+        self.key = self.get_cache_key(request, view)
+        self.history = self.cache.get(self.key, [])
+        self.now = self.timer()
+        while self.history and self.history[-1] <= self.now - self.duration:
+            self.history.pop()
+        if len(self.history) + cost > self.num_requests:
+            return self.throttle_failure()
+        self.history[:0] = [self.now] * cost
+        self.cache.set(self.key, self.history, self.duration)
+        return True
@@ -7,8 +7,10 @@ router = DefaultRouter()
 router.register(r'users', UsersView, basename='users')
 router.register(r'links',UserLinksView, basename='user_links')
 router.register(r'context',UserContextView,basename='user_context')
+router.register(r'jobs',JobsView,basename='jobs')
 
 
 urlpatterns = [
+    path('context/chat_stream/', chat_stream, name='chat-stream'),
     path('', include(router.urls)),
 ]
@@ -1,61 +1,168 @@
+import hashlib
+import json
 import logging
 import random
 import os
 import requests
-from bs4 import BeautifulSoup
-from .models import UserLinks, User, Context
+from asgiref.sync import sync_to_async
+from .models import UserLinks, User, Context, Conversation, Job
 from .serializers import *
-from dotenv import load_dotenv
 from .utility_classes import *
+from .authentication import SESSION_USER_KEY, authenticated_user, issue_token
+from .jobs import enqueue
+from .metrics import render_metrics
+from .pagination import LinkSearchPagination, UserLinksPagination
+from .parsers import NDJSONParser
+from .search import search_backend, search_links
+from .services import (
+    LIMITER, LLMError, LLMRateLimited, add_links_to_context, astream_chat_with_context, build_context, chat_with_context,
+    import_user_links, remove_links_from_context, summarize_page, summarize_pages
+)
+from .throttling import SummaryLinksThrottle
+from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.db.models import Q
 from django.shortcuts import render
 from rest_framework.views import APIView
-from django.http import HttpResponseRedirect
-from rest_framework import viewsets, permissions, status
+from django.http import Http404, HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse
+from django.views.decorators.http import require_POST
+from rest_framework import mixins, viewsets, permissions, status
 from rest_framework.authtoken.views import ObtainAuthToken
 from rest_framework.authtoken.models import Token
 from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
-from rest_framework.exceptions import APIException
-from google.auth.transport import requests as google_requests
+from rest_framework.exceptions import APIException, ValidationError
+from rest_framework.fields import BooleanField
 from django.shortcuts import redirect
-from google.oauth2 import id_token
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_groq import ChatGroq
 from django.middleware.csrf import get_token
-import re
-from rest_framework.exceptions import Throttled
+from django.utils.http import parse_etags, quote_etag
 
 
 logger = logging.getLogger(__name__)
 
 
-# Get the path to the directory where manage.py is located
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-
-# Load the .env file
-load_dotenv(os.path.join(BASE_DIR, '.env'))
-
+# settings has loaded .env into the environment
 GOOGLE_OAUTH_CLIENT_ID = os.getenv('GOOGLE_OAUTH_CLIENT_ID')
 GOOGLE_REDIRECT_URI = os.getenv('GOOGLE_REDIRECT_URI')
 GOOGLE_OAUTH_CLIENT_SECRET = os.getenv('GOOGLE_OAUTH_CLIENT_SECRET')
 TOKEN_URL = os.getenv('GOOGLE_TOKEN_URL')
-GROQ_KEY = os.getenv('GROQ_API_KEY')
-CHAT= ChatGroq(temperature=0, model_name="mixtral-8x7b-32768")
+
+
+class LinkAlreadySaved(APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = "Link already saved!"
+
+
+def rate_limited_response(e):
+    return Response(
+        {
+            "error": "Token limit reached. Please try again later.",
+            "cooldown_period": "10 minutes",
+            "retry_after": e.retry_after
+        },
+        status=status.HTTP_429_TOO_MANY_REQUESTS,
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+
+def sse_event(data, event=None):
+    message = f"event: {event}\n" if event else ""
+    return f"{message}data: {json.dumps(data)}\n\n"
+
+
+def metrics(request):
+    # Prometheus scrape endpoint, the numbers are for this process only
+    if not settings.METRICS_ENABLED:
+        raise Http404()
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@csrf_exempt
+@require_POST
+async def chat_stream(request):
+    # Same input as UserContextView.chat, but the answer is sent as server-sent events while the
+    # model generates it. Async so that under ASGI a long stream doesn't pin a worker thread.
+    # Bearer requests need no CSRF token, so Django's check is skipped and session requests get DRF's.
+    try:
+        user = await sync_to_async(authenticated_user)(request)
+    except APIException as e:
+        return JsonResponse({"detail": str(e.detail)}, status=e.status_code)
+
+    try:
+        data = json.loads(request.body or b"{}")
+    except json.JSONDecodeError:
+        return JsonResponse({"Error": "Invalid JSON body!"}, status=status.HTTP_400_BAD_REQUEST)
+    context_id = data.get('context_id')
+    human = data.get('user_input')
+    conversation_id = data.get('conversation_id')
+
+    if not (context_id and human):
+        logger.error("Missing context_id or user_input in the request.")
+        return JsonResponse({"Error": "Missing context_id or user_input!"}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        conversation, tokens = await astream_chat_with_context(user, context_id, human, conversation_id)
+        # Wait for the first token before committing to a 200, so rate limits still come back as a 429
+        first_token = await anext(tokens, None)
+    except Context.DoesNotExist:
+        logger.error(f"Context with id {context_id} not found.")
+        return JsonResponse({"Error": "Context not found!"}, status=status.HTTP_404_NOT_FOUND)
+    except Conversation.DoesNotExist:
+        logger.error(f"Conversation with id {conversation_id} not found for context {context_id}.")
+        return JsonResponse({"Error": "Conversation not found!"}, status=status.HTTP_404_NOT_FOUND)
+    except LLMRateLimited as e:
+        return JsonResponse(
+            {
+                "error": "Token limit reached. Please try again later.",
+                "cooldown_period": "10 minutes",
+                "retry_after": e.retry_after
+            },
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+            headers={"Retry-After": str(e.retry_after)}
+        )
+    except LLMError as e:
+        return JsonResponse({"Error": f"AI processing failed: {e}"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    async def events():
+        if first_token is not None:
+            yield sse_event({"token": first_token})
+        try:
+            async for token in tokens:
+                yield sse_event({"token": token})
+        except LLMRateLimited as e:
+            yield sse_event({"error": "Token limit reached. Please try again later.", "retry_after": e.retry_after}, event="error")
+            return
+        except LLMError as e:
+            yield sse_event({"Error": f"AI processing failed: {e}"}, event="error")
+            return
+        yield sse_event({"conversation_id": conversation.pk}, event="done")
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # stop nginx from buffering the stream
+    return response
 
 
 class Index(APIView):
+    permission_classes = [permissions.AllowAny]
     
     def get(self,request):
         return render(request, 'users/index.html')
         
 class UserInfo(APIView):
+    # Google redirects here to sign the user in, so nobody is authenticated yet
+    permission_classes = [permissions.AllowAny]
     
     user_register_obj = RegisterUserViaSSO()
     
     def get(self, request):
+        # Only this view needs google-auth, so it's imported here rather than at startup
+        from google.auth.transport import requests as google_requests
+        from google.oauth2 import id_token
+
         code = request.GET.get('code')
         token_url = TOKEN_URL
         token_data = {
@@ -66,22 +173,30 @@ class UserInfo(APIView):
             'grant_type': 'authorization_code',
         }
         token_response = requests.post(token_url, data=token_data)
-        logger.info(f"token is {token_response.json()}")
+        if settings.LOG_PAYLOADS:
+            logger.info(f"token is {token_response.json()}")
         token_json = token_response.json()
         id_info = id_token.verify_oauth2_token(token_json['id_token'], google_requests.Request(), GOOGLE_OAUTH_CLIENT_ID)
-        logger.info(f"the id_info is {id_info}")
+        if settings.LOG_PAYLOADS:
+            logger.info(f"the id_info is {id_info}")
         if id_info:
             user_email = id_info.get('email',None)
             given_name = id_info.get('given_name', None)
             family_name = id_info.get('family_name', None)
         
-        if not User.objects.filter(email=user_email).exists():
+        user = User.objects.filter(email=user_email).first()
+        if user is None:
             create_user_data = {"email": user_email, "first_name":given_name,"last_name": family_name}
             if not self.user_register_obj.create_user(data=create_user_data):
                 response = HttpResponseRedirect('/api/loginError.html/')  
                 return response
+            user = User.objects.get(email=user_email)
         else:
             logger.info(f"the user already exists! {type(user_email)}")
+
+        # API requests are authenticated from this session from now on (see UserAuthentication)
+        request.session.cycle_key()
+        request.session[SESSION_USER_KEY] = user.pk
         
         response = HttpResponseRedirect('/api/index/')  
         response.set_cookie('user_email', user_email, secure=True, httponly=True, samesite='Lax')
@@ -99,28 +214,28 @@ class UserInfo(APIView):
     
 
 # Create your views here.
-class UsersView(viewsets.ModelViewSet):
-    
+class UsersView(viewsets.GenericViewSet):
+    # Only the actions below, users are created by signing in and never listed
     queryset = User.objects.all()
     serializer_class = UserSerializer
     
-    @action(detail=False, methods=["POST"])
+    @action(detail=False, methods=["POST"], permission_classes=[permissions.IsAuthenticated])
     def delete_account(self, request):
-        user_email = request.data.get('email')
-        email = user_email.strip('"')
-        logger.info(f"the user email is{email}")
+        logger.info(f"the user email is{request.user.email}")
         try:
-            delete_obj = User.objects.filter(email=email).first()
-            if delete_obj:
-                delete_obj.delete()
-                return Response(data={"Success": "User Deleted!"},status=status.HTTP_200_OK)
-            else:
-                return Response(data={"Error": "User not found!"}, status=status.HTTP_404_NOT_FOUND)
+            request.user.delete()
+            request.session.flush()
+            return Response(data={"Success": "User Deleted!"},status=status.HTTP_200_OK)
         except Exception as e:
             logger.error(f"The following exception occurred {e}", exc_info=True)
             return Response(data={"Error": "Internal Server Error while deleting the user!"},status=status.HTTP_500_INTERNAL_SERVER_ERROR)
             
-    @action(detail=False, methods=["GET"])
+    @action(detail=False, methods=["GET"], permission_classes=[permissions.IsAuthenticated])
+    def token(self, request):
+        # Bearer token for clients that would rather not send the session cookie
+        return Response(data={"token": issue_token(request.user)}, status=status.HTTP_200_OK)
+
+    @action(detail=False, methods=["GET"], permission_classes=[permissions.AllowAny])
     def get_google_sso(self, request):
 
         url = (
@@ -141,21 +256,67 @@ class UsersView(viewsets.ModelViewSet):
 class UserLinksView(viewsets.ModelViewSet):
     queryset = UserLinks.objects.all()
     serializer_class = UseLinksSerializer
-    
 
-    @action(detail=False, methods=["GET"])
-    def user_links(self, request):
+    def get_queryset(self):
+        return self.queryset.filter(user=self.request.user)
+
+    def perform_create(self, serializer):
+        self.save_link(serializer)
+
+    def perform_update(self, serializer):
+        self.save_link(serializer)
+
+    def save_link(self, serializer):
+        # The unique (user, normalized_url) constraint is what stops two requests saving the same page
         try:
-            user_email = request.GET.get('email')
-            processed_email = user_email.strip('"')
-            user = User.objects.get(email=processed_email)
-            user_links = self.queryset.filter(user=user).values("id","link","name")
-            return Response(data=user_links, status=status.HTTP_200_OK)
-        except Exception as e:
-            logger.error(f"the exception is {e}", exc_info=True)
-            return Response(data={"Error": "Error occurred in fetching links!"}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            with transaction.atomic():
+                return serializer.save(user=self.request.user)
+        except IntegrityError:
+            raise LinkAlreadySaved()
+
+    # Fields user_links can return, ?fields=id,link,name picks some of them
+    user_link_fields = ("id", "name", "link", "created_on", "page")
 
-    @action(detail=False, methods=["POST"])
+    @action(detail=False, methods=["GET"], permission_classes=[permissions.IsAuthenticated])
+    def user_links(self, request):
+        fields = [field for field in request.GET.get('fields', 'id,link,name').split(',') if field]
+        if not set(fields) <= set(self.user_link_fields):
+            return Response(
+                data={"Error": f"fields must be some of {', '.join(self.user_link_fields)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if "id" not in fields:
+            fields.append("id")  # the cursor is built from it
+        # A bad cursor is a 404 from the paginator, like any other unknown page
+        paginator = UserLinksPagination()
+        page = paginator.paginate_queryset(self.queryset.filter(user=request.user).values(*fields), request, view=self)
+        response = paginator.get_paginated_response(page)
+
+        # Unchanged page, nothing to download again
+        etag = quote_etag(hashlib.sha256(json.dumps([page, response.get("Link", "")], default=str).encode()).hexdigest())
+        headers = {"ETag": etag, "Cache-Control": "private, no-cache", "Vary": "Authorization, Cookie"}
+        if etag in parse_etags(request.META.get("HTTP_IF_NONE_MATCH", "")):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        for header, value in headers.items():
+            response[header] = value
+        return response
+
+    @action(detail=False, methods=["GET"], permission_classes=[permissions.IsAuthenticated])
+    def search(self, request):
+        # ?q=words, every word has to match the link's name, URL or page text. Best matches first.
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return Response(data={"Error": "No search query provided"}, status=status.HTTP_400_BAD_REQUEST)
+        if search_backend() is None:
+            return Response(data={"Error": "Search is not available on this database"}, status=status.HTTP_501_NOT_IMPLEMENTED)
+
+        paginator = LinkSearchPagination()
+        page = paginator.paginate_search(lambda limit, offset: search_links(request.user, query, limit, offset), request)
+        response = paginator.get_paginated_response(page)
+        response["Cache-Control"] = "private, no-cache"
+        return response
+
+    @action(detail=False, methods=["POST"], permission_classes=[permissions.IsAuthenticated])
     def delete_links(self, request):
         logger.info(f"the request is here!")
         del_ids = request.data.get('link_ids')
@@ -164,7 +325,7 @@ class UserLinksView(viewsets.ModelViewSet):
             return Response(data={"Error": "No link IDs provided"}, status=status.HTTP_400_BAD_REQUEST)
         
         # Perform the delete operation
-        deleted_count, _ = self.queryset.filter(id__in=del_ids).delete()
+        deleted_count, _ = self.queryset.filter(id__in=del_ids, user=request.user).delete()
 
         # Check if the deletion was successful
         if deleted_count > 0:
@@ -173,94 +334,95 @@ class UserLinksView(viewsets.ModelViewSet):
             return Response(data={"Error": "No links were deleted. Check the provided IDs."}, status=status.HTTP_400_BAD_REQUEST)
 
 
-    @action(detail=False, methods=["POST"])
+    @action(detail=False, methods=["POST"], permission_classes=[permissions.IsAuthenticated])
     def save_user_link(self, request):
         # raw_body = request.body
         try:
-            data = request.data
-            logger.info(f"the request is {data}")
-            user_email = data.get('email', None)
-            
-            if not user_email:
-                logger.info('hehe')
-                return Response(data={"Error": "User email not found in the request payload!"}, status=status.HTTP_400_BAD_REQUEST)
-            user_email_ = user_email.strip('"')
-            logger.info(f"the user email is {user_email_}")
-            user_obj = User.objects.filter(email=user_email_).first()
-            if not user_obj:
-                logger.info("hihi")
-                return Response(data={"Error": "User not found in the database!"}, status=status.HTTP_400_BAD_REQUEST)
-            else:
-                data.pop('email')
-                data['user'] = user_obj.pk
+            data = request.data.copy()
+            if settings.LOG_PAYLOADS:
+                logger.info(f"the request is {data}")
+            user_obj = request.user
+            data.pop('email', None)
+            data['user'] = user_obj.pk
             
             serializer = self.serializer_class(data=data)
             if serializer.is_valid():
-                serializer.save()
+                try:
+                    user_link = self.save_link(serializer)
+                except LinkAlreadySaved:
+                    return Response(data={"Error": "Link already saved!"}, status=status.HTTP_409_CONFLICT)
+                if settings.EXTRACT_ON_SAVE:
+                    # Fetch and parse the page now, so building a context later doesn't have to
+                    enqueue("extract_link_content", {"link_id": user_link.pk}, user=user_obj)
                 return Response(data={"Success": "Saved user link!"}, status=status.HTTP_201_CREATED)
             else:
                 logger.error(f"the following error occurred while saving the user link {serializer._errors}",exc_info=True)
                 return Response(data={"Error": "Failed to save user link!"}, status=status.HTTP_400_BAD_REQUEST)
         except:
             logger.error(exc_info=True)
-            
-            
-            
-    
-class UserContextView(viewsets.ModelViewSet):
+
+    @action(detail=False, methods=["POST"], permission_classes=[permissions.IsAuthenticated], parser_classes=[JSONParser, NDJSONParser])
+    def bulk_import(self, request):
+        # {"links": [{"link": ..., "name": ...}, ...], "extract": true}, or application/x-ndjson
+        # with one link per line and ?extract=1
+        if not isinstance(request.data, dict):
+            return Response(data={"Error": "Expected a JSON object"}, status=status.HTTP_400_BAD_REQUEST)
+        items = request.data.get('links')
+        if not isinstance(items, list) or not items:
+            return Response(data={"Error": "No links provided"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(items) > settings.BULK_IMPORT_MAX_LINKS:
+            return Response(
+                data={"Error": f"At most {settings.BULK_IMPORT_MAX_LINKS} links per request!"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            extract = BooleanField().to_internal_value(request.data.get('extract', request.GET.get('extract', settings.EXTRACT_ON_SAVE)))
+        except ValidationError:
+            return Response(data={"Error": "extract must be true or false"}, status=status.HTTP_400_BAD_REQUEST)
+
+        results, created_ids = import_user_links(request.user, items)
+        data = {
+            "created": len(created_ids),
+            "duplicate": sum(1 for result in results if result["status"] == "duplicate"),
+            "invalid": sum(1 for result in results if result["status"] == "invalid"),
+            "results": results,
+        }
+
+        if created_ids and extract:
+            # One job fetches the whole batch concurrently
+            job = enqueue("extract_links_content", {"link_ids": created_ids}, user=request.user)
+            data["job_id"] = job.pk
+        return Response(data=data, status=status.HTTP_201_CREATED if created_ids else status.HTTP_200_OK)
+
+
+class UserContextView(mixins.ListModelMixin, mixins.RetrieveModelMixin, mixins.DestroyModelMixin, viewsets.GenericViewSet):
+    # Contexts are only made by create_context, which fetches their pages
     queryset = Context.objects.all()
     serializer_class = UserContextSerializer
+
+    def get_queryset(self):
+        return self.queryset.filter(user=self.request.user)
     
-    @action(detail=False, methods=["POST"])
+    @action(detail=False, methods=["POST"], permission_classes=[permissions.IsAuthenticated])
     def create_context(self, request):
         link_ids = request.data.get('link_ids')
-        email = request.data.get('email')
-        user_email = email.strip('"')
-        user = User.objects.get(email=user_email)
-        
-        links = list(UserLinks.objects.filter(id__in=link_ids, user_id=user.pk).values_list('link', flat=True))
+        user = request.user
         
-        concatenated_content = ""
-    
-        for link in links:
-            try:
-                # Fetch the HTML content of the page
-                response = requests.get(link)
-                response.raise_for_status()  # Ensure the request was successful
-                
-                # Parse the HTML content using BeautifulSoup
-                soup = BeautifulSoup(response.text, 'html.parser')
-                
-                # Extract all the text from the HTML
-                page_text = soup.get_text(separator=' ', strip=True)
-                
-                # Concatenate the link with the parsed content
-                concatenated_content += f"Link: {link}, Parsed content: {page_text}, "
-            except Exception as e:
-                concatenated_content += f"Link: {link}, "
-                logger.info(f"Failed to process link {link}: {e}")
-        context = concatenated_content
-        
-        user_context_data = {
-            "links":link_ids,
-            "user": user.pk,
-            "context": context
-        }
+        if request.data.get('async'):
+            job = enqueue("create_context", {"user_id": user.pk, "link_ids": link_ids}, user=user)
+            return Response(data={"job_id": job.pk}, status=status.HTTP_202_ACCEPTED)
         
-        serializer = self.serializer_class(data=user_context_data)
-        if serializer.is_valid():
-            serializer.save()
-            return Response(data={"context_id": serializer.data.get('id')}, status=status.HTTP_201_CREATED)
+        context = build_context(user, link_ids)
+        if context is not None:
+            return Response(data={"context_id": context.pk}, status=status.HTTP_201_CREATED)
         else:
-            logger.error(f"The errors are {serializer._errors}")
             return Response(data={"Error": "Failed to save user link!"}, status=status.HTTP_400_BAD_REQUEST)
         
         
         
-    @action(detail=False, methods=["POST"])
+    @action(detail=False, methods=["POST"], permission_classes=[permissions.IsAuthenticated])
     def chat(self, request):
-        
-        logger.info("here I am ")
+
         context_id = request.data.get('context_id')
         human = request.data.get('user_input')
 
@@ -268,127 +430,130 @@ class UserContextView(viewsets.ModelViewSet):
             logger.error("Missing context_id or user_input in the request.")
             return Response(data={"Error": "Failed to save user link!"}, status=status.HTTP_400_BAD_REQUEST)
 
+        # Optional, without it a new conversation is started and its id returned
+        conversation_id = request.data.get('conversation_id')
+
+        if request.data.get('async'):
+            job = enqueue(
+                "chat",
+                {"user_id": request.user.pk, "context_id": context_id, "user_input": human, "conversation_id": conversation_id},
+                user=request.user
+            )
+            return Response(data={"job_id": job.pk}, status=status.HTTP_202_ACCEPTED)
+
         try:
-            # Fetch the context using the context_id
-            context_data = self.queryset.get(id=context_id).context
-            logger.info(f"Successfully retrieved context for context_id: {context_id}")
+            ai_response, conversation = chat_with_context(request.user, context_id, human, conversation_id)
         except self.queryset.model.DoesNotExist:
             logger.error(f"Context with id {context_id} not found.")
             return Response(data={"Error": "Context not found!"}, status=status.HTTP_404_NOT_FOUND)
-
-        # Define the system and human messages
-        system_message = ""
-        human_message = f""
-
-        # Construct the chat prompt template
-        prompt = ChatPromptTemplate.from_messages([("system", system_message), ("human", human_message)])
-
-        # Invoke the AI model to get the response
-        try:
-            ai_response = prompt | CHAT
-            response = ai_response.invoke({"text": context_data})
-            ai_response = response.content
-            logger.info("AI response successfully generated.")
-            logger.info(f"the response is {response}, {type(response)}")
-            
-        except Exception as e:
-            error_message = str(e)
-            logger.error(f"AI processing failed: {error_message}")
-            
-            if "Rate limit reached" in error_message and "tokens per minute (TPM)" in error_message:
-                # Extract the cooldown time from the error message
-                cooldown_match = re.search(r"Please try again in (\d+)m(\d+\.\d+)s", error_message)
-                if cooldown_match:
-                    minutes, seconds = cooldown_match.groups()
-                    cooldown_seconds = int(minutes) * 60 + float(seconds)
-                else:
-                    cooldown_seconds = 600
-
-                raise Throttled(
-                    detail={
-                        "error": "Token limit reached. Please try again later.",
-                        "cooldown_period": "10 minutes",
-                        "retry_after": int(cooldown_seconds)
-                    },
-                    wait=int(cooldown_seconds)
-                )
-            else:
-                return Response(
-                    data={"Error": f"AI processing failed: {error_message}"},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
+        except Conversation.DoesNotExist:
+            logger.error(f"Conversation with id {conversation_id} not found for context {context_id}.")
+            return Response(data={"Error": "Conversation not found!"}, status=status.HTTP_404_NOT_FOUND)
+        except LLMRateLimited as e:
+            return rate_limited_response(e)
+        except LLMError as e:
+            return Response(
+                data={"Error": f"AI processing failed: {e}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
 
         # Return the AI's response
         logger.info("Returning AI response to the client.")
-        return Response(data={"ai_response": ai_response}, status=status.HTTP_200_OK)
+        return Response(data={"ai_response": ai_response, "conversation_id": conversation.pk}, status=status.HTTP_200_OK)
 
 
-    @action(detail=False, methods=["POST"])
-    def page_summary(self, request):
+    @action(detail=True, methods=["POST"], permission_classes=[permissions.IsAuthenticated])
+    def add_links(self, request, pk=None):
+        # Adds links to an existing context, only the new pages are fetched
+        link_ids = request.data.get('link_ids')
+        if not link_ids:
+            return Response(data={"Error": "No link IDs provided"}, status=status.HTTP_400_BAD_REQUEST)
+        context = self.queryset.filter(pk=pk, user=request.user).first()
+        if context is None:
+            return Response(data={"Error": "Context not found!"}, status=status.HTTP_404_NOT_FOUND)
 
-        request_link = request.data.get('link')
-        concatenated_content = ""
+        if request.data.get('async'):
+            job = enqueue("add_context_links", {"context_id": context.pk, "link_ids": link_ids}, user=request.user)
+            return Response(data={"job_id": job.pk}, status=status.HTTP_202_ACCEPTED)
 
-        try:
-            # Fetch the HTML content of the page
-            response = requests.get(request_link)
-            response.raise_for_status()  # Ensure the request was successful
-            
-            # Parse the HTML content using BeautifulSoup
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            # Extract all the text from the HTML
-            page_text = soup.get_text(separator=' ', strip=True)
-            
-            # Concatenate the link with the parsed content
-            concatenated_content += f"Link: {request_link}, Parsed content: {page_text}, "
-        except Exception as e:
-            concatenated_content += f"Link: {request_link}, "
-            logger.info(f"Failed to process link {request_link}: {e}")
+        added = add_links_to_context(context, link_ids)
+        return Response(data={"context_id": context.pk, "added": added}, status=status.HTTP_200_OK)
+
+    @action(detail=True, methods=["POST"], permission_classes=[permissions.IsAuthenticated])
+    def remove_links(self, request, pk=None):
+        # Removes links from an existing context, nothing is fetched again
+        link_ids = request.data.get('link_ids')
+        if not link_ids:
+            return Response(data={"Error": "No link IDs provided"}, status=status.HTTP_400_BAD_REQUEST)
+        context = self.queryset.filter(pk=pk, user=request.user).first()
+        if context is None:
+            return Response(data={"Error": "Context not found!"}, status=status.HTTP_404_NOT_FOUND)
+        if context.segments.filter(verbatim=True).exists():
+            # Its text was stored as one piece, there is no telling which part came from which link
+            return Response(
+                data={"Error": "This context was created before links could be removed, create it again instead."},
+                status=status.HTTP_409_CONFLICT
+            )
 
-        context = concatenated_content
+        removed = remove_links_from_context(context, link_ids)
+        return Response(data={"context_id": context.pk, "removed": removed}, status=status.HTTP_200_OK)
 
-        # Define the system and human messages
-        system_message = ""
-        human_message = f""
+    @action(detail=False, methods=["POST"], permission_classes=[permissions.IsAuthenticated], throttle_classes=[SummaryLinksThrottle])
+    def page_summary(self, request):
+
+        request_link = request.data.get('link')
+        if not request_link:
+            return Response(data={"Error": "No link provided"}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Construct the chat prompt template
-        prompt = ChatPromptTemplate.from_messages([("system", system_message), ("human", human_message)])
+        if request.data.get('async'):
+            job = enqueue("page_summary", {"link": request_link}, user=request.user)
+            return Response(data={"job_id": job.pk}, status=status.HTTP_202_ACCEPTED)
 
-        # Invoke the AI model to get the response
         try:
-            ai_response = prompt | CHAT
-            response = ai_response.invoke({"text": context})
-            ai_response = response.content
-            logger.info("AI response successfully generated.")
-            logger.info(f"the response is {response}, {type(response)}")
-        except Exception as e:
-            error_message = str(e)
-            logger.error(f"AI processing failed: {error_message}")
-            
-            if "Rate limit reached" in error_message and "tokens per minute (TPM)" in error_message:
-                # Extract the cooldown time from the error message
-                cooldown_match = re.search(r"Please try again in (\d+)m(\d+\.\d+)s", error_message)
-                if cooldown_match:
-                    minutes, seconds = cooldown_match.groups()
-                    cooldown_seconds = int(minutes) * 60 + float(seconds)
-                else:
-                    cooldown_seconds = 600  # Default to 10 minutes if we can't parse the time
-
-                return Response(
-                    {
-                        "error": "Token limit reached. Please try again later.",
-                        "cooldown_period": "10 minutes",
-                        "retry_after": int(cooldown_seconds)
-                    },
-                    status=status.HTTP_429_TOO_MANY_REQUESTS
-                )
-            else:
-                return Response(
-                    data={"Error": f"AI processing failed: {error_message}"},
-                    status=status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
+            ai_response = summarize_page(request_link)
+        except LLMRateLimited as e:
+            return rate_limited_response(e)
+        except LLMError as e:
+            return Response(
+                data={"Error": f"AI processing failed: {e}"},
+                status=status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
 
         # Return the AI's response
         logger.info("Returning AI response to the client.")
         return Response(data={"ai_response": ai_response}, status=status.HTTP_200_OK)
+
+
+    @action(detail=False, methods=["POST"], permission_classes=[permissions.IsAuthenticated], throttle_classes=[SummaryLinksThrottle])
+    def page_summaries(self, request):
+        # {"links": [...]}, answered as NDJSON with one line per link in the order they finish,
+        # each carrying the link's index in the request
+        links = request.data.get('links')
+        if not isinstance(links, list) or not links or not all(isinstance(link, str) and link for link in links):
+            return Response(data={"Error": "No links provided"}, status=status.HTTP_400_BAD_REQUEST)
+        if len(links) > settings.PAGE_SUMMARY_BATCH_MAX_LINKS:
+            return Response(
+                data={"Error": f"At most {settings.PAGE_SUMMARY_BATCH_MAX_LINKS} links per request!"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        lines = (json.dumps(result) + "\n" for result in summarize_pages(links))
+        response = StreamingHttpResponse(lines, content_type="application/x-ndjson")
+        response["Cache-Control"] = "no-cache"
+        response["X-Accel-Buffering"] = "no"  # stop nginx from buffering the stream
+        return response
+
+    @action(detail=False, methods=["GET"], permission_classes=[permissions.IsAdminUser])
+    def llm_usage(self, request):
+        # Token and request budgets and what has been spent against them, by everybody, so admins only
+        return Response(data=LIMITER.usage(), status=status.HTTP_200_OK)
+
+
+class JobsView(mixins.RetrieveModelMixin, viewsets.GenericViewSet):
+    # Poll endpoint for anything started with "async": true, only the caller's own jobs
+    queryset = Job.objects.all()
+    serializer_class = JobSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return self.queryset.filter(user=self.request.user)